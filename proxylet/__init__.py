@@ -33,6 +33,53 @@ to a private fileserver, and return 404 for any other paths:
       return ("files.example.com",80,None)
     return None
 
+Checking each route in turn like this gets slow when there are many of
+them.  The proxylet.router.Router class builds a prefix trie from a set of
+relocators and plain host/port targets, and can be used as the mapper:
+
+  router = Router()
+  router.addRelocator(SVNRelocator("http://www.example.com/svn","http://svn.example.com/"))
+  router.addRoute("/files","files.example.com",80)
+  proxylet.serve(host,port,router)
+
+To spread requests over several replicas of a backend, map them to a
+proxylet.upstream.UpstreamGroup in place of a single host and port.  The
+group balances requests between its servers, checks their health in the
+background and ejects those that keep failing:
+
+  group = UpstreamGroup([("app1",8080),("app2",8080)],"least_outstanding")
+  router.addRoute("/app",group,None)
+
+The proxy runs on eventlet by default, but the proxylet.engines module
+also provides an engine based on asyncio (or trollius, under Python 2).
+Choose it when creating the server:
+
+  Server(host,port,mapper,engine="asyncio").serve()
+
+Responses to GET and HEAD requests can be cached in memory, following
+the Cache-Control, Expires, ETag and Vary headers, by giving the server a
+proxylet.cache.ResponseCache.  Concurrent requests for the same resource
+then share a single request to the upstream server:
+
+  Server(host,port,mapper,cache=ResponseCache(64*1024*1024)).serve()
+
+To make use of more than one CPU core, proxylet.prefork.PreforkServer runs
+the proxy in several worker processes sharing the same address:
+
+  PreforkServer(host,port,mapper,workers=4).serve()
+
+To find out where the time goes in slow requests, a proxylet.tracing.Tracer
+records when a sample of requests reach each stage of being proxied, and
+passes the timings to sinks such as a TraceFile for offline analysis:
+
+  tracer = Tracer([TraceFile("/var/log/proxylet.trace")],sample=0.01)
+  Server(host,port,mapper,tracer=tracer).serve()
+
+The proxylet.bench package benchmarks the proxy against local stand-in
+backends, reporting throughput, latency and memory use as JSON:
+
+  python -m proxylet.bench --concurrency 20 --duration 10 -o results.json
+
 """
 
 __ver_major__ = 0
@@ -43,17 +90,24 @@ __version__ = "%d.%d.%d%s" % (__ver_major__,__ver_minor__,
                               __ver_patch__,__ver_sub__)
 
 
-import sys
+import time
+import signal
 import traceback
 import socket
-from eventlet import api as evtapi
+from collections import deque
 from streams import *
+from engines import getEngine, useEngine, setNoDelay
+from pool import defaultPool, UpstreamLost, IDEMPOTENT_METHODS
+from metrics import routeLabel
+from timeouts import Timeout, Watchdog, TimedSocket, TimedStream, \
+                     defaultTimeouts
+from tracing import TracedStream
 
 
 def uspawn(func):
     """Decorator spawning a microthread for each call to a function."""
     def uspawner(*args,**kwds):
-        evtapi.spawn(func,*args,**kwds)
+        getEngine().spawn(func,*args,**kwds)
     uspawner.__name__ = func.__name__
     uspawner.__doc__ = func.__doc__
     return uspawner
@@ -67,79 +121,412 @@ class Dispatcher:
     the request to, as well as any rewriting to be performed.
 
     Different requests from the same socket may be proxied to different
-    servers.  All sockets are kept open until one is closed, at which point
-    all other sockets are closed as well.  This allows the proxy to be
-    compatible with HTTP keep-alive without implementing any details.
+    servers.  For each request a connection to the chosen server is checked
+    out of the given ConnectionPool (by default, the process-wide pool),
+    and it is returned once the response has been relayed.  If either the
+    client or a server closes its connection, the client connection is
+    closed once any pending responses have been sent.
+
+    Clients may pipeline requests, but at most 'max_pipeline' responses
+    will be outstanding at any time.  Once this limit is reached, no more
+    requests are read from the client until a response has been sent.
+
+    Response bodies that pass through without rewriting are relayed from
+    the server to the client through a single reusable buffer, rather than
+    being read into a new string for every block.
+
+    If a proxylet.metrics.Metrics object is given, statistics about each
+    request are recorded in it, and requests for its reserved path are
+    answered with the current metrics instead of being mapped.
+
+    If a proxylet.cache.ResponseCache is given, GET and HEAD requests are
+    answered from it where possible, and cacheable responses are stored
+    in it as they are sent to the client.  Concurrent requests for the
+    same resource share a single request to the upstream server.
+
+    Slow or idle clients and servers are timed out as described by the
+    given proxylet.timeouts.Timeouts object, or by the defaults given in
+    that module if it is not specified.
+
+    If a proxylet.tracing.Tracer is given, the time at which each sampled
+    request reaches each stage of being proxied is recorded in a Span,
+    which is passed to the tracer once the response has been sent.
+
+    Call drain() to have the dispatcher close the connection as soon as
+    the responses to any requests already received have been sent, or
+    abort() to close it immediately.  The function 'onfinish', if set, is
+    called with the dispatcher once its connection has been closed.
     """
 
-    def __init__(self,client,mapper):
+    onfinish = None
+
+    def __init__(self,client,mapper,pool=None,max_pipeline=8,metrics=None,
+                      cache=None,timeouts=None,tracer=None):
+        self.metrics = metrics
+        self.cache = cache
+        self.tracer = tracer
+        if timeouts is None:
+          timeouts = defaultTimeouts
+        self.timeouts = timeouts
+        self._sock = client
+        # Reads from the client are timed in the dispatch loop, and
+        # reads from upstream servers while processing responses.  Each
+        # loop's writes go the other way, and are timed separately.
+        self._watchdog = Watchdog()
+        self._upstreamWatchdog = Watchdog()
+        self._sendWatchdog = Watchdog()
+        self._sendWatchdog.expect(timeouts.send,"send",True)
+        self._upstreamSendWatchdog = Watchdog()
+        self._upstreamSendWatchdog.expect(timeouts.send,"send",True)
+        client = TimedSocket(client,self._watchdog,self._sendWatchdog)
+        if metrics is not None:
+          client = CountBytes(client)
+          metrics.recordConnect()
+        self._counter = client
         self.client = CallOnClose(client,self.onclose)
         self.mapper = mapper
-        self.servers = {}
+        if pool is None:
+          pool = defaultPool
+        self.pool = pool
         self._closed = False
+        self._finished = False
+        self._draining = False
+        # True while the dispatch loop is running, and waiting for a new
+        # request, respectively
+        self._dispatching = False
+        self._reading = False
+        self._upstream = None
+        # The upstream connection a request is being written to, if any
+        self._sending = None
         # To ensure responses are read and delivered in order, we
         # process them sequentially out of a queue.
-        self._responses = []
+        self._responses = deque()
         self._processingResps = False
+        # Each queued response holds one of these until it has been sent.
+        self._pipeline = getEngine().semaphore(max_pipeline)
+        # Responses are sent one at a time, so they can share a buffer
+        self._relayBuffer = bytearray(BLOCK_SIZE)
 
     @uspawn
     def dispatch(self):
         """Request dispatch loop."""
+        metrics = self.metrics
+        tracer = self.tracer
+        route = "none"
+        self._watchdog.thread = getEngine().current()
+        self._upstreamSendWatchdog.thread = self._watchdog.thread
+        self._dispatching = True
+        first = True
         try:
          while not self._closed:
+          # Wait for a free slot before reading the next request
+          self._pipeline.acquire()
+          if self._closed or self._draining:
+            self.onclose()
+            break
+          route = "none"
+          if metrics is not None:
+            bytesIn = self._counter.bytesIn
+          self._reading = True
+          self._expectRequest(first)
+          first = False
           try:
             req = HTTPRequest(self.client)
+          except Timeout, e:
+            self._timedOut(route,e.kind)
+            if e.kind == "header":
+              self._sendError(408,"Request Timeout",route,time.time())
+            self.onclose()
+            break
           except (IOError,socket.error):
+            self.onclose()
             break
-          # If an invalid request is received, send 400 Bad Request
-          # and close the connection immediately
+          finally:
+            self._reading = False
+          self._watchdog.cancel()
+          self._watchdog.expect(self.timeouts.body,"body",True)
+          if metrics is not None:
+            start = time.time()
+          # If an invalid request is received, send the error response
+          # for it and close the connection immediately
           if not req.valid:
-            resp = StringStream("HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
             self.onclose()
-            self.sendResponse(resp)
+            if metrics is not None:
+              metrics.recordError(route,"bad_request")
+            else:
+              start = None
+            self._sendError(req.error.status,req.error.reason,route,start)
             break
-          mapping = self.mapper(req)
-          if mapping is None:
-            content = "Not Found"
-            resp = StringStream("HTTP/1.1 404 Not Found\r\nContent-Length: %d\r\n\r\n%s" % (len(content),content))
+          span = None
+          if tracer is not None:
+            span = tracer.start(req)
+          if metrics is not None and req.reqURI == metrics.path:
+            content = metrics.render()
+            resp = StringStream("HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n%s" % (len(content),content))
             server = Nullify([])
+            upstream = None
+            code = 200
           else:
-            (host,port,rewriter) = mapping
-            port = int(port)
-            server = self._getServer(host,port)
-            resp = HTTPResponse(server)
-            if rewriter is not None:
-              (req,resp) = rewriter(req,resp)
-          self.sendResponse(resp)
-          self.sendRequest(req,server)
+            mapping = self.mapper(req)
+            if metrics is not None:
+              route = routeLabel(mapping)
+            if span is not None:
+              span.route = routeLabel(mapping)
+              span.mark("map")
+            key = cached = None
+            if mapping is not None and self.cache is not None:
+              (key,cached) = self._checkCache(req,route)
+              if span is not None:
+                span.mark("cache")
+            if mapping is None:
+              content = "Not Found"
+              resp = StringStream("HTTP/1.1 404 Not Found\r\nContent-Length: %d\r\n\r\n%s" % (len(content),content))
+              server = Nullify([])
+              upstream = None
+              code = 404
+            elif cached is not None:
+              (code,resp,keepAlive) = cached
+              server = Nullify([])
+              upstream = None
+              if not keepAlive:
+                self.onclose()
+            else:
+              creq = req
+              try:
+                (host,port,rewriter) = mapping
+                try:
+                  conn = self._getServer(host,port,req)
+                except Timeout, e:
+                  conn = None
+                  (code,reason) = (504,"Gateway Timeout")
+                  self._timedOut(route,e.kind)
+                except socket.error:
+                  conn = None
+                  (code,reason) = (502,"Bad Gateway")
+                  if metrics is not None:
+                    metrics.recordError(route,"upstream_connect")
+                if conn is None:
+                  resp = _errorResponse(code,reason)
+                  server = Nullify([])
+                  upstream = None
+                  self.onclose()
+                else:
+                  if metrics is not None and not conn.reused:
+                    metrics.recordUpstreamConnect(route)
+                  if req.reqMethod.upper() in IDEMPOTENT_METHODS:
+                    conn.allowReplay()
+                  server = TimedStream(conn,self._upstreamWatchdog,
+                                       self._upstreamSendWatchdog)
+                  server = CallOnClose(server,self.onclose)
+                  if span is not None:
+                    span.mark("connect")
+                    span.tags["reused"] = conn.reused
+                    server = TracedStream(server,span,"upstream")
+                  resp = HTTPResponse(server,req)
+                  # A client may be waiting for "100 Continue" before it
+                  # sends the body, so interim responses can't wait
+                  resp.interim = self.client
+                  upstream = (conn,resp)
+                  code = None
+                  if rewriter is not None:
+                    try:
+                      (req,resp) = rewriter(req,resp)
+                    except:
+                      conn.release(False)
+                      raise
+                  if key is not None:
+                    # Uncacheable bodies can still be relayed directly
+                    onskip = lambda r=resp,u=upstream[1]: self._setRelay(r,u)
+                    resp = self.cache.wrap(key,creq,resp,upstream[1],onskip)
+                  else:
+                    self._setRelay(resp,upstream[1])
+              finally:
+                # The key reserved by _checkCache() is handed over to the
+                # response by wrap(); if that didn't happen, release it
+                if key is not None:
+                  self.cache.abandon(key,creq)
+          if span is not None:
+            span.status = code
+          if metrics is None:
+            self.sendResponse(resp,upstream,None,span)
+          else:
+            self.sendResponse(resp,upstream,(route,start,code),span)
+          if upstream is not None:
+            self._sending = upstream[0]
+          try:
+            self.sendRequest(req,server)
+          except Timeout, e:
+            # The request can't be completed, so neither connection
+            # can be used any further.
+            self._timedOut(route,e.kind)
+            if upstream is not None:
+              if self._upstream is upstream[0]:
+                self._shutdown(upstream[0].sock,self._upstreamWatchdog)
+              else:
+                self._shutdown(upstream[0].sock)
+            self.onclose()
+            break
+          finally:
+            self._sending = None
+          if upstream is not None:
+            self._requestSent(upstream[0])
+          if span is not None:
+            span.mark("request_sent")
+          self._watchdog.cancel()
+          if metrics is not None:
+            metrics.recordRequest(route,self._counter.bytesIn - bytesIn)
         except:
-          (_,ex,tb) = sys.exc_info()
-          traceback.print_tb(tb)
-          print ex
+          traceback.print_exc()
+          if metrics is not None:
+            metrics.recordError(route,"dispatch")
+          self.onclose()
+        self._dispatching = False
         # Ensure all responses have been written, before closing
         self.processResponses()
 
-    def _getServer(self,host,port):
-        destn = (host,port)
-        try:
-          return self.servers[destn]
-        except KeyError:
-          server = evtapi.connect_tcp(destn)
-          server = CallOnClose(server,self.onclose)
-          self.servers[destn] = server
-          return server
+    def _checkCache(self,req,route):
+        """Look the request up in the cache, returning (key,cached).
+
+        The key must be taken before the request is rewritten, so that it
+        refers to the URI requested by the client.  It is None if the
+        response can't be cached.  On a miss, this waits to follow any
+        response for the same key that is already being fetched.  Then
+        'cached' is the (status,stream,keepAlive) tuple for the response
+        to send, or None if it must be fetched from upstream.
+        """
+        cache = self.cache
+        key = cache.keyFor(req)
+        if key is None:
+          return (None,None)
+        result = "hit"
+        cached = cache.lookup(key,req)
+        if cached is None:
+          result = "collapsed"
+          cached = cache.follow(key,req)
+          if cached is None:
+            result = "miss"
+        if self.metrics is not None:
+          self.metrics.recordCacheLookup(route,result)
+        return (key,cached)
+
+    def _expectRequest(self,first):
+        """Set the timeouts for reading the next request.
+
+        The first request must arrive within the header timeout.  After
+        that, the keep-alive timeout applies until the next request starts
+        to arrive, but only once all pending responses have been sent.
+        """
+        watchdog = self._watchdog
+        timeouts = self.timeouts
+        watchdog.cancel()
+        # A pipelined request may already have started to arrive
+        if first or getattr(self._sock,"recvbuffer",""):
+          watchdog.expect(timeouts.header,"header")
+        else:
+          watchdog.afterData(timeouts.header,"header")
+          if not (self._responses or self._processingResps):
+            watchdog.expect(timeouts.keepalive,"keepalive")
+
+    def _requestSent(self,conn):
+        """Start the first byte timeout, if the response is awaited.
+
+        The timeout only counts once the whole request has been sent, so
+        that a slow upload doesn't count against the upstream server.  If
+        the response isn't being processed yet, it starts when it is.
+        """
+        watchdog = self._upstreamWatchdog
+        if self._upstream is conn and watchdog.pending is not None:
+          watchdog.expect(self.timeouts.first_byte,"first_byte")
+
+    def _timedOut(self,route,kind):
+        if self.metrics is not None:
+          self.metrics.recordTimeout(route,kind)
+
+    def _sendError(self,code,reason,route,start):
+        """Send an error response, after which the connection is closed."""
+        resp = _errorResponse(code,reason)
+        if self.metrics is not None:
+          self.sendResponse(resp,None,(route,start,code))
+        else:
+          self.sendResponse(resp)
+
+    def _setRelay(self,resp,uresp):
+        """Relay the upstream body straight to the client, if possible.
+
+        This is only done when the upstream response is written to the
+        client directly, or through a HTTPRewriter that doesn't touch the
+        body; otherwise the body has to be yielded for further processing.
+        """
+        if isinstance(resp,HTTPRewriter):
+          resp = resp.stream
+        if resp is uresp:
+          uresp.relay = self.client
+          uresp.relayBuffer = self._relayBuffer
+
+    def _getServer(self,host,port,req):
+        timeout = self.timeouts.connect
+        # The host may be an UpstreamGroup, which picks a server itself
+        if port is None:
+          return host.checkout(self.pool,req,timeout)
+        return self.pool.checkout((host,int(port)),timeout)
 
     def onclose(self):
         self._closed = True
 
     def doclose(self):
-        self.client.close()
-        for s in self.servers:
-          self.servers[s].close()
-
-    def sendResponse(self,resp):
-        """Queue a response object for processing."""
-        self._responses.append(resp)
+        """Close the client connection, once nothing is reading from it."""
+        if self._finished:
+          return
+        if self._dispatching:
+          # Closing a socket while another thread waits on it may never
+          # return, so wake the dispatch loop and leave the rest to it.
+          self._shutdown(self._sock,self._watchdog)
+          return
+        self._finished = True
+        try:
+          if self.metrics is not None:
+            self.metrics.recordDisconnect()
+          if self.onfinish is not None:
+            self.onfinish(self)
+        finally:
+          self.client.close()
+
+    def drain(self):
+        """Close the connection once outstanding responses have been sent."""
+        self._draining = True
+        if self._reading and not (self._responses or self._processingResps):
+          self._shutdown(self._sock,self._watchdog)
+
+    def abort(self):
+        """Close the connection immediately, along with any upstream one."""
+        self._draining = True
+        self.onclose()
+        if self._upstream is not None:
+          self._shutdown(self._upstream.sock,self._upstreamWatchdog)
+        self._shutdown(self._sock,self._watchdog)
+
+    def _shutdown(self,sock,watchdog=None):
+        # Shutting the socket down wakes up anything blocked reading it,
+        # but the thread timed by 'watchdog' may need waking explicitly
+        try:
+          sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+          pass
+        if watchdog is not None:
+          watchdog.wake(IOError("connection shut down"))
+
+    def sendResponse(self,resp,upstream=None,sample=None,span=None):
+        """Queue a response object for processing.
+
+        If the response is being read from an upstream server, 'upstream'
+        should give the (PooledConnection,HTTPResponse) pair so that the
+        connection can be released once the response has been relayed.
+        If metrics are being recorded, 'sample' gives the route, the time
+        at which the request was received, and the status code (or None
+        to take it from the upstream response).  If the request is being
+        traced, 'span' gives its Span.
+        """
+        self._responses.append((resp,upstream,sample,span))
         # The processing loop may have terminated, make sure it starts again
         self.processResponses()
 
@@ -152,16 +539,122 @@ class Dispatcher:
         if self._processingResps:
           return
         self._processingResps = True
+        watchdog = self._upstreamWatchdog
+        watchdog.thread = getEngine().current()
+        self._sendWatchdog.thread = watchdog.thread
         while self._responses:
-          resp = self._responses.pop(0)        
-          for ln in resp:
-            try:
-              self.client.write(ln)
-            except (IOError,socket.error):
-              break
+          (resp,upstream,sample,span) = self._responses.popleft()
+          if upstream is not None:
+            self._upstream = upstream[0]
+            watchdog.afterData(self.timeouts.body,"body",True)
+            if self._sending is not upstream[0]:
+              watchdog.expect(self.timeouts.first_byte,"first_byte")
+          try:
+            if sample is None and span is None:
+              for ln in resp:
+                self.client.write(ln)
+            else:
+              self._sendMeasured(resp,upstream,sample,span)
+          except Timeout, e:
+            # Nothing has been sent if the response never started
+            self.onclose()
+            if sample is not None:
+              self._timedOut(sample[0],e.kind)
+            if span is not None:
+              span.error = e.kind
+            if e.kind == "first_byte":
+              self._sendUpstreamError(504,"Gateway Timeout",sample)
+          except UpstreamLost:
+            # The request may have reached the server, so it isn't resent
+            self.onclose()
+            if sample is not None:
+              self.metrics.recordError(sample[0],"upstream_lost")
+            if span is not None:
+              span.error = "upstream_lost"
+            self._sendUpstreamError(502,"Bad Gateway",sample)
+          except (IOError,socket.error):
+            # The response couldn't be relayed in full, so there's no
+            # way to keep the connection in a consistent state.
+            self.onclose()
+            if sample is not None:
+              self.metrics.recordError(sample[0],"relay")
+            if span is not None:
+              span.error = "relay"
+          finally:
+            watchdog.cancel()
+            self._upstream = None
+            if upstream is not None:
+              (conn,uresp) = upstream
+              conn.release(uresp.canReuse(),getattr(uresp,"respStatus",None))
+            self._pipeline.release()
+            if span is not None:
+              if span.status is None and upstream is not None:
+                span.status = getattr(upstream[1],"respStatus",None)
+              self.tracer.finish(span)
           if self._closed:
             self.doclose()
         self._processingResps = False
+        if self._reading and self._watchdog.pending is not None:
+          # The client is idle, waiting for another request
+          self._watchdog.expect(self.timeouts.keepalive,"keepalive")
+        if self._draining and not self._closed:
+          # Wake the dispatch loop, which is waiting for another request
+          self.onclose()
+          self._shutdown(self._sock,self._watchdog)
+        if self._closed:
+          self.doclose()
+
+    def _sendUpstreamError(self,code,reason,sample):
+        """Send an error response in place of an upstream response."""
+        data = _errorResponse(code,reason).read()
+        try:
+          self.client.write(data)
+        except (IOError,socket.error):
+          return
+        if sample is not None:
+          (route,start,_) = sample
+          self.metrics.recordResponse(route,code,start,len(data))
+
+    def _sendMeasured(self,resp,upstream,sample,span=None):
+        """Send a response, recording metrics for it and/or tracing it.
+
+        Either of 'sample' and 'span' may be None.  When tracing, the time
+        spent producing the response, less the time spent reading it from
+        upstream and writing it to the client, is added as "rewrite".
+        """
+        client = self.client
+        if sample is not None:
+          (route,start,code) = sample
+          metrics = self.metrics
+          bytesOut = self._counter.bytesOut
+        if span is not None:
+          span.mark("dequeue")
+          client = TracedStream(client,span,"client")
+          if upstream is not None and upstream[1].relay is self.client:
+            upstream[1].relay = client
+          read = span.totals.get("upstream_read",0.0)
+          begin = time.time()
+        lines = iter(resp)
+        for ln in lines:
+          if span is not None:
+            span.mark("response_head")
+          client.write(ln)
+          if span is not None:
+            span.mark("first_write")
+          if sample is not None:
+            metrics.recordFirstByte(route,start)
+          break
+        for ln in lines:
+          client.write(ln)
+        if span is not None:
+          elapsed = time.time() - begin
+          elapsed -= span.totals.get("client_write",0.0)
+          elapsed -= span.totals.get("upstream_read",0.0) - read
+          span.add("rewrite",elapsed)
+        if sample is not None:
+          if code is None:
+            code = upstream[1].respStatus
+          metrics.recordResponse(route,code,start,self._counter.bytesOut - bytesOut)
 
 
 class Server:
@@ -174,27 +667,167 @@ class Server:
     Here host and port specify where to bind the server, and mapper is a
     function that takes a HTTPRequest object, and returns a 3-tuple giving
     the destination host, destination port, and a rewriting function (or
-    None, if no rewriting is required).
+    None, if no rewriting is required).  Connections to the destination
+    servers are taken from the given ConnectionPool, or from the shared
+    process-wide pool if it is not specified.  Each client may have up to
+    'max_pipeline' pipelined requests awaiting a response.  If 'metrics'
+    is given, it should be a proxylet.metrics.Metrics object in which to
+    record statistics; these can be fetched from the path "metrics.path".
+    If 'cache' is given, it should be a proxylet.cache.ResponseCache in
+    which to store responses to GET and HEAD requests.  The timeouts for
+    each connection may be given as a proxylet.timeouts.Timeouts object.
+    If 'tracer' is given, it should be a proxylet.tracing.Tracer to which
+    the timings of a sample of requests are reported.
 
     To run the server, call its "serve" method.  It can be halted by
-    calling the "halt" method.
+    calling the "halt" method, which stops accepting new connections but
+    leaves existing ones alone, or by the "drain" method, which also closes
+    existing connections once their current responses have been sent.
+    By default "serve" binds a new listening socket, but an existing one
+    may be passed in instead.
+
+    The server runs on the event loop of the given 'engine', which may be
+    given as the name of one of the engines in proxylet.engines (such as
+    "eventlet" or "asyncio") or as an engine object.  This becomes the
+    engine for the whole process.  By default the current engine is used,
+    which is eventlet unless another has been chosen.
+
+    The mapper can be replaced at any time by calling "setMapper", and the
+    methods "reloadOnSignal" and "drainOnSignal" arrange for a new mapper
+    to be loaded or for the server to be drained when a signal arrives.
     """
 
-    def __init__(self,host,port,mapper):
+    def __init__(self,host,port,mapper,pool=None,max_pipeline=8,metrics=None,
+                      engine=None,cache=None,timeouts=None,tracer=None):
+        if engine is None:
+          engine = getEngine()
+        else:
+          engine = useEngine(engine)
+        self.engine = engine
         self.host = host
         self.port = int(port)
         self.mapper = mapper
+        self.pool = pool
+        self.max_pipeline = max_pipeline
+        self.metrics = metrics
+        self.cache = cache
+        self.timeouts = timeouts
+        self.tracer = tracer
+        self._running = False
+        self._accepting = None
+        self._haltTimer = None
+        self._deadline = None
+        self._dispatchers = set()
 
     def halt(self):
+        """Stop accepting new connections."""
         self._running = False
+        # Interrupt the serving greenthread if it's waiting in accept()
+        if self._accepting is not None and self._haltTimer is None:
+          self._haltTimer = self.engine.interrupt(self._accepting,_Halt())
+
+    def drain(self,timeout=30):
+        """Stop serving, after letting in-flight responses finish.
+
+        New connections are no longer accepted, and each open connection
+        is closed once the responses to any requests already received have
+        been sent.  Connections still open after 'timeout' seconds are
+        closed regardless.  The "serve" method returns once all connections
+        have been closed.
+        """
+        self._deadline = time.time() + timeout
+        for d in list(self._dispatchers):
+          d.drain()
+        self.halt()
+
+    def setMapper(self,mapper):
+        """Replace the mapper used for all subsequent requests.
+
+        This takes effect immediately for existing connections as well as
+        new ones.  No other greenthread can run during the switch, so each
+        request is mapped entirely by either the old or the new mapper.
+        Any cached responses are discarded, since they may have come from
+        servers that the new mapper no longer uses.
+        """
+        self.mapper = mapper
+        if self.cache is not None:
+          self.cache.clear()
+        for d in self._dispatchers:
+          d.mapper = mapper
+
+    def reloadOnSignal(self,loader,signum=signal.SIGHUP):
+        """Replace the mapper with the result of loader() on a signal.
+
+        If the loader raises an error, it is printed and the existing
+        mapper is kept.
+        """
+        def onSignal(signum,frame):
+            try:
+              mapper = loader()
+            except Exception:
+              traceback.print_exc()
+            else:
+              self.setMapper(mapper)
+        signal.signal(signum,onSignal)
+
+    def drainOnSignal(self,timeout=30,signum=signal.SIGTERM):
+        """Drain the server when the given signal is received."""
+        signal.signal(signum,lambda signum,frame: self.drain(timeout))
 
-    def serve(self):
+    def listen(self):
+        """Create the listening socket for the server."""
+        return self.engine.listen((self.host,self.port))
+
+    def serve(self,listener=None):
+        return self.engine.run(self._serve,listener)
+
+    def _serve(self,listener):
         self._running = True
-        socket = evtapi.tcp_listener((self.host,self.port))
-        while self._running:
-          client, _ = socket.accept()
-          Dispatcher(client,self.mapper).dispatch()
-        socket.close()
+        if listener is None:
+          listener = self.listen()
+        try:
+          while self._running:
+            self._accepting = self.engine.current()
+            try:
+              client, _ = listener.accept()
+            except _Halt:
+              break
+            finally:
+              self._accepting = None
+            if not self._running:
+              client.close()
+              break
+            setNoDelay(client)
+            d = Dispatcher(client,self.mapper,self.pool,self.max_pipeline,
+                           self.metrics,self.cache,self.timeouts,self.tracer)
+            d.onfinish = self._dispatchers.discard
+            self._dispatchers.add(d)
+            d.dispatch()
+        finally:
+          if self._haltTimer is not None:
+            self._haltTimer.cancel()
+            self._haltTimer = None
+          listener.close()
+        if self._deadline is not None:
+          self._finishDrain()
+        if self.tracer is not None:
+          self.tracer.flush()
+
+    def _finishDrain(self):
+        while self._dispatchers and time.time() < self._deadline:
+          self.engine.sleep(0.1)
+        for d in list(self._dispatchers):
+          d.abort()
+        self._deadline = None
+
+
+def _errorResponse(code,reason):
+    """Make an empty error response, closing the connection."""
+    return StringStream("HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % (code,reason))
+
+
+class _Halt(Exception):
+    """Raised in the serving greenthread to interrupt accept()."""
 
 
 def serve(host,port,mapper):
@@ -203,6 +836,8 @@ def serve(host,port,mapper):
     s.serve()
 
 
+_demo_router = None
+
 def _demo_mapper(req):
     """Simple demonstration mapper function, also for testing purposes.
     Proxies the following:
@@ -210,17 +845,16 @@ def _demo_mapper(req):
         * /g/        :   google website
         * /morph/    :   morph SVN repo
     """
-    from relocate import DrupalRelocator, DAVRelocator, SVNRelocator, Relocator
-    rfk = Relocator("http://localhost:8080/rfk","http://www.rfk.id.au/")
-    goog = Relocator("http://localhost:8080/g","http://www.google.com/")
-    svn = SVNRelocator("http://localhost:8080/svn","http://sphericalmatrix.com/svn/morph")
-    if svn.matchesLocal(req.reqURI):
-      return svn.mapping
-    if rfk.matchesLocal(req.reqURI):
-      return rfk.mapping
-    if goog.matchesLocal(req.reqURI):
-      return goog.mapping
-    return None
+    global _demo_router
+    if _demo_router is None:
+      from relocate import DrupalRelocator, DAVRelocator, SVNRelocator, Relocator
+      from router import Router
+      router = Router()
+      router.addRelocator(Relocator("http://localhost:8080/rfk","http://www.rfk.id.au/"),True)
+      router.addRelocator(Relocator("http://localhost:8080/g","http://www.google.com/"),True)
+      router.addRelocator(SVNRelocator("http://localhost:8080/svn","http://sphericalmatrix.com/svn/morph"),True)
+      _demo_router = router
+    return _demo_router(req)
 
 def _demo():
     serve('',8080,_demo_mapper)
@@ -0,0 +1,194 @@
+"""
+
+  proxylet.bench:  reproducible load and latency benchmarks for proxylet
+
+This package measures the throughput and latency of proxylet against local
+stand-in backends (see proxylet.bench.backends).  For each scenario, the
+backend and a proxylet.Server are started in separate processes, and the
+load generator in proxylet.bench.loadgen drives the proxy over keep-alive
+connections.  The following scenarios are available:
+
+    * passthrough:  plain proxying of static and chunked bodies
+    * slow:         responses trickling in from the backend, mixed with
+                    small static ones, so many are in flight at once
+    * relocate:     a Relocator rewriting request and redirect headers
+    * svn:          a SVNRelocator rewriting PROPFIND and REPORT bodies
+
+Run the benchmarks from the command line like so:
+
+    python -m proxylet.bench --concurrency 20 --duration 10 -o results.json
+
+For every scenario the requests per second, the p50/p99 latency, the body
+bytes received per second and the peak resident memory of the proxy
+process are reported.  Results are written out as JSON, so that the
+output of different runs can be compared.
+
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import subprocess
+import optparse
+
+import proxylet
+
+
+#  The requests sent in each scenario, as (method,path,headers,body).
+_propfind = '<?xml version="1.0" encoding="utf-8"?>\n' \
+            '<D:propfind xmlns:D="DAV:"><D:allprop/></D:propfind>\n'
+_report = '<?xml version="1.0" encoding="utf-8"?>\n' \
+          '<S:update-report xmlns:S="svn:"><S:src-path>/svn/trunk</S:src-path>' \
+          '<S:entry rev="1"></S:entry></S:update-report>\n'
+
+SCENARIOS = {
+  "passthrough": [("GET","/static/1024",[],""),
+                  ("GET","/static/65536",[],""),
+                  ("GET","/chunked/16",[],""),
+                  ("GET","/static/1048576",[],"")],
+  "slow": [("GET","/drip/20",[],""),
+           ("GET","/static/1024",[],"")],
+  "relocate": [("GET","/app/static/1024",[],""),
+               ("GET","/app/redirect/1024",[],""),
+               ("GET","/app/static/65536",[],"")],
+  "svn": [("PROPFIND","/svn/dav/200",[("Depth","1"),
+                                      ("Content-Type","text/xml")],_propfind),
+          ("REPORT","/svn/dav/200",[("Content-Type","text/xml")],_report)],
+}
+
+
+def makeMapper(scenario,port,backendPort):
+    """Build the mapper used by the proxy for the named scenario."""
+    from proxylet.router import Router
+    from proxylet.relocate import Relocator, SVNRelocator
+    router = Router()
+    if scenario in ("passthrough","slow"):
+      router.addRoute("/","127.0.0.1",backendPort)
+    elif scenario == "relocate":
+      router.addRelocator(Relocator("http://127.0.0.1:%d/app" % (port,),
+                                    "http://127.0.0.1:%d/origin" % (backendPort,)),True)
+    elif scenario == "svn":
+      router.addRelocator(SVNRelocator("http://127.0.0.1:%d/svn" % (port,),
+                                       "http://127.0.0.1:%d/repo" % (backendPort,)),True)
+    else:
+      raise ValueError("unknown scenario: %r" % (scenario,))
+    return router
+
+
+def serveProxy(port,backendPort,scenario,engine=None):
+    """Run a proxylet.Server for the named scenario, forever."""
+    mapper = makeMapper(scenario,port,backendPort)
+    proxylet.Server("127.0.0.1",port,mapper,engine=engine).serve()
+
+
+def runScenario(scenario,port=18600,concurrency=10,duration=10.0,warmup=1.0,
+                engine=None):
+    """Benchmark a single scenario, returning a dict of results.
+
+    The proxy is run on the named 'engine' from proxylet.engines.
+    """
+    from proxylet.bench.loadgen import LoadGenerator
+    backendPort = port + 1
+    backend = _spawn("from proxylet.bench import backends; "
+                     "backends.serve(%d)" % (backendPort,))
+    proxy = None
+    try:
+      proxy = _spawn("from proxylet.bench import serveProxy; "
+                     "serveProxy(%d,%d,%r,%r)" % (port,backendPort,scenario,engine))
+      _waitForPort(backendPort)
+      _waitForPort(port)
+      load = LoadGenerator("127.0.0.1",port,SCENARIOS[scenario],
+                           concurrency,duration,warmup)
+      results = load.run()
+      results["scenario"] = scenario
+      results["engine"] = engine or "eventlet"
+      results["peak_rss_kb"] = _getPeakRSS(proxy.pid)
+    finally:
+      for proc in (proxy,backend):
+        if proc is not None:
+          proc.terminate()
+          proc.wait()
+    return results
+
+
+def _spawn(code):
+    """Run the given python code in a child process."""
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(proxylet.__file__)))
+    path = env.get("PYTHONPATH")
+    if path:
+      env["PYTHONPATH"] = root + os.pathsep + path
+    else:
+      env["PYTHONPATH"] = root
+    return subprocess.Popen([sys.executable,"-c",code],env=env)
+
+
+def _waitForPort(port,timeout=10.0):
+    end = time.time() + timeout
+    while True:
+      try:
+        sock = socket.create_connection(("127.0.0.1",port))
+      except socket.error:
+        if time.time() > end:
+          raise
+        time.sleep(0.05)
+      else:
+        sock.close()
+        return
+
+
+def _getPeakRSS(pid):
+    """Get the peak resident memory of a process in KiB, if possible."""
+    try:
+      f = open("/proc/%d/status" % (pid,))
+    except IOError:
+      return None
+    try:
+      for ln in f:
+        if ln.startswith("VmHWM:"):
+          return int(ln.split()[1])
+    finally:
+      f.close()
+    return None
+
+
+def main(argv=None):
+    """Command-line entry point."""
+    op = optparse.OptionParser(usage="%prog [options] [scenario ...]")
+    op.add_option("-c","--concurrency",type="int",default=10,
+                  help="number of concurrent keep-alive clients")
+    op.add_option("-d","--duration",type="float",default=10.0,
+                  help="seconds to measure each scenario for")
+    op.add_option("-w","--warmup",type="float",default=1.0,
+                  help="seconds of unmeasured load before each run")
+    op.add_option("-p","--port",type="int",default=18600,
+                  help="port for the proxy; the backend uses the next one")
+    op.add_option("-e","--engine",default=None,
+                  help="event loop engine for the proxy (default eventlet)")
+    op.add_option("-o","--output",default=None,
+                  help="file to write the JSON results to (default stdout)")
+    (opts,args) = op.parse_args(argv)
+    scenarios = args or sorted(SCENARIOS)
+    for scenario in scenarios:
+      if scenario not in SCENARIOS:
+        op.error("unknown scenario: %s" % (scenario,))
+    results = []
+    for scenario in scenarios:
+      results.append(runScenario(scenario,opts.port,opts.concurrency,
+                                 opts.duration,opts.warmup,opts.engine))
+    report = {"proxylet": proxylet.__version__,
+              "python": sys.version.split()[0],
+              "timestamp": time.time(),
+              "results": results}
+    out = json.dumps(report,indent=2,sort_keys=True)
+    if opts.output is None:
+      print out
+    else:
+      f = open(opts.output,"w")
+      try:
+        f.write(out + "\n")
+      finally:
+        f.close()
+
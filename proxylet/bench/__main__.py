@@ -0,0 +1,2 @@
+from proxylet.bench import main
+main()
@@ -0,0 +1,156 @@
+"""
+
+  proxylet.bench.backends:  stand-in origin servers for benchmarking
+
+This module implements a small keep-alive HTTP server producing synthetic
+responses, so that proxylet can be benchmarked without any real backend.
+The kind of response is chosen by the first recognised segment of the
+request path, so any prefix may be put in front of it by a Relocator:
+
+    * /static/<size>:   a plain body of <size> bytes, with Content-Length
+    * /chunked/<n>:     <n> chunks of 4096 bytes, with chunked encoding
+    * /drip/<n>:        <n> chunks of 64 bytes, sent 10ms apart
+    * /redirect/<size>: a 302 redirect to /static/<size> under the same
+                        prefix, given as an absolute URL
+    * /dav/<n>:         a WebDAV multistatus document with <n> entries,
+                        as for a PROPFIND; a REPORT request instead gets
+                        a Subversion update report with <n> directories
+
+Run it with "serve(port)", which never returns.
+
+"""
+
+import socket
+from eventlet import api as evtapi
+
+from proxylet.streams import StreamWrapper, HTTPRequest
+
+
+CHUNK_SIZE = 4096
+DRIP_SIZE = 64
+DRIP_DELAY = 0.01
+
+#  Cache of the generated static bodies, keyed by size.
+_static = {}
+
+
+def serve(port,host="127.0.0.1"):
+    """Serve synthetic responses on the given port, forever."""
+    sock = evtapi.tcp_listener((host,int(port)),backlog=1024)
+    while True:
+      (client,_) = sock.accept()
+      evtapi.spawn(_handle,client,int(port))
+
+
+def _handle(client,port):
+    stream = StreamWrapper(client)
+    try:
+      while True:
+        try:
+          req = HTTPRequest(stream)
+        except (IOError,socket.error):
+          break
+        if not req.valid:
+          break
+        for _ in req.body:
+          pass
+        conn = [c.lower() for c in req.fields.getlist("Connection")]
+        keepAlive = "close" not in conn
+        if req.reqProtocol.upper() == "HTTP/1.0":
+          keepAlive = "keep-alive" in conn
+        _respond(stream,req,port,keepAlive)
+        if not keepAlive:
+          break
+    except socket.error:
+      pass
+    client.close()
+
+
+def _respond(stream,req,port,keepAlive):
+    (prefix,kind,arg) = _parsePath(req.reqURI)
+    head = ["HTTP/1.1 200 OK\r\n"]
+    if not keepAlive:
+      head.append("Connection: close\r\n")
+    if kind == "static":
+      _sendBody(stream,head,"application/octet-stream",_getStatic(arg))
+    elif kind == "redirect":
+      head[0] = "HTTP/1.1 302 Found\r\n"
+      head.append("Location: http://127.0.0.1:%d%s/static/%d\r\n" % (port,prefix,arg))
+      _sendBody(stream,head,"text/plain","")
+    elif kind == "dav":
+      head[0] = "HTTP/1.1 207 Multi-Status\r\n"
+      if req.reqMethod.upper() == "REPORT":
+        body = _svnReport(prefix,arg)
+      else:
+        body = _davMultistatus(prefix,arg)
+      _sendBody(stream,head,'text/xml; charset="utf-8"',body)
+    elif kind in ("chunked","drip"):
+      head.append("Content-Type: application/octet-stream\r\n")
+      head.append("Transfer-Encoding: chunked\r\n\r\n")
+      stream.write("".join(head))
+      if kind == "chunked":
+        data = "%x\r\n%s\r\n" % (CHUNK_SIZE,"c" * CHUNK_SIZE)
+        for _ in xrange(arg):
+          stream.write(data)
+      else:
+        data = "%x\r\n%s\r\n" % (DRIP_SIZE,"d" * DRIP_SIZE)
+        for _ in xrange(arg):
+          stream.write(data)
+          evtapi.sleep(DRIP_DELAY)
+      stream.write("0\r\n\r\n")
+    else:
+      head[0] = "HTTP/1.1 404 Not Found\r\n"
+      _sendBody(stream,head,"text/plain","Not Found")
+
+
+def _sendBody(stream,head,ctype,body):
+    head.append("Content-Type: %s\r\n" % (ctype,))
+    head.append("Content-Length: %d\r\n\r\n" % (len(body),))
+    stream.write("".join(head) + body)
+
+
+def _parsePath(path):
+    """Split a request path into (prefix,kind,arg)."""
+    segs = path.split("?",1)[0].split("/")
+    for i in xrange(len(segs) - 1):
+      if segs[i] in ("static","chunked","drip","redirect","dav"):
+        try:
+          arg = int(segs[i+1])
+        except ValueError:
+          break
+        return ("/".join(segs[:i]),segs[i],arg)
+    return (path,None,None)
+
+
+def _getStatic(size):
+    try:
+      return _static[size]
+    except KeyError:
+      body = _static[size] = "x" * size
+      return body
+
+
+def _davMultistatus(prefix,n):
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n',
+           '<D:multistatus xmlns:D="DAV:">\n']
+    for i in xrange(n):
+      out.append('<D:response><D:href>%s/trunk/file%d.txt</D:href>'
+                 '<D:propstat><D:prop><D:getcontentlength>%d'
+                 '</D:getcontentlength></D:prop>'
+                 '<D:status>HTTP/1.1 200 OK</D:status></D:propstat>'
+                 '</D:response>\n' % (prefix,i,i))
+    out.append('</D:multistatus>\n')
+    return "".join(out)
+
+
+def _svnReport(prefix,n):
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n',
+           '<S:update-report xmlns:S="svn:" xmlns:D="DAV:" send-all="true">\n',
+           '<S:target-revision rev="1"/>\n',
+           '<S:open-directory rev="1">\n']
+    for i in xrange(n):
+      out.append('<S:add-directory name="dir%d" bc-url="%s/!svn/bc/1/dir%d">'
+                 '<D:checked-in><D:href>%s/!svn/ver/1/dir%d</D:href>'
+                 '</D:checked-in></S:add-directory>\n' % (i,prefix,i,prefix,i))
+    out.append('</S:open-directory>\n</S:update-report>\n')
+    return "".join(out)
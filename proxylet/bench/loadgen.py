@@ -0,0 +1,138 @@
+"""
+
+  proxylet.bench.loadgen:  concurrent keep-alive HTTP load generator
+
+The LoadGenerator class opens a number of keep-alive connections to the
+server under test, and sends requests over each of them back-to-back for
+a fixed length of time.  The requests are taken in turn from a fixed list,
+so that repeated runs send the same mix of requests.
+
+"""
+
+import time
+import math
+import socket
+from eventlet import api as evtapi
+from eventlet import coros
+
+from proxylet.streams import StreamWrapper, HTTPResponse
+
+
+class LoadGenerator(object):
+    """Drive a HTTP server with concurrent keep-alive clients.
+
+    'requests' is a list of (method,path,headers,body) tuples, where
+    headers is a list of (name,value) pairs.  Each of the 'concurrency'
+    clients cycles through it, starting at a different offset.  Results
+    are only recorded for requests started after the first 'warmup'
+    seconds, and the run lasts for 'duration' seconds after that.
+    """
+
+    def __init__(self,host,port,requests,concurrency=10,duration=10.0,warmup=1.0):
+        self.host = host
+        self.port = int(port)
+        self.requests = [self._format(*r) for r in requests]
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+
+    def _format(self,method,path,headers,body):
+        lines = ["%s %s HTTP/1.1\r\n" % (method,path)]
+        lines.append("Host: %s:%d\r\n" % (self.host,self.port))
+        for (name,value) in headers:
+          lines.append("%s: %s\r\n" % (name,value))
+        lines.append("Content-Length: %d\r\n\r\n" % (len(body),))
+        lines.append(body)
+        return "".join(lines)
+
+    def run(self):
+        """Run the load, returning a dict of results."""
+        self._latencies = []
+        self._bytes = 0
+        self._errors = 0
+        self._connects = 0
+        self._running = self.concurrency
+        self._done = coros.event()
+        now = time.time()
+        self._start = now + self.warmup
+        self._end = self._start + self.duration
+        for i in xrange(self.concurrency):
+          evtapi.spawn(self._client,i)
+        self._done.wait()
+        return self._results()
+
+    def _client(self,offset):
+        try:
+          conn = None
+          n = offset
+          reqs = self.requests
+          while True:
+            started = time.time()
+            if started >= self._end:
+              break
+            try:
+              if conn is None:
+                conn = self._connect()
+              (nbytes,reusable) = self._send(conn,reqs[n % len(reqs)])
+            except (IOError,socket.error):
+              if started >= self._start:
+                self._errors += 1
+              if conn is not None:
+                conn.close()
+                conn = None
+              # Don't spin if the server is refusing connections
+              evtapi.sleep(0.01)
+              continue
+            if started >= self._start:
+              self._latencies.append(time.time() - started)
+              self._bytes += nbytes
+            if not reusable:
+              conn.close()
+              conn = None
+            n += 1
+          if conn is not None:
+            conn.close()
+        finally:
+          self._running -= 1
+          if self._running == 0:
+            self._done.send(True)
+
+    def _connect(self):
+        self._connects += 1
+        return StreamWrapper(evtapi.connect_tcp((self.host,self.port)))
+
+    def _send(self,conn,request):
+        conn.write(request)
+        resp = HTTPResponse(conn)
+        resp.parse()
+        if resp.respStatus is None or resp.respStatus >= 500:
+          raise IOError("bad response status: %r" % (resp.respStatus,))
+        nbytes = 0
+        for data in resp.body:
+          nbytes += len(data)
+        return (nbytes,resp.canReuse())
+
+    def _results(self):
+        lats = sorted(self._latencies)
+        count = len(lats)
+        elapsed = self.duration
+        results = {"requests": count,
+                   "errors": self._errors,
+                   "connections": self._connects,
+                   "concurrency": self.concurrency,
+                   "duration": elapsed,
+                   "req_per_sec": count / float(elapsed),
+                   "bytes_per_sec": self._bytes / float(elapsed),
+                   "latency_ms": None}
+        if count:
+          results["latency_ms"] = {"mean": 1000 * sum(lats) / count,
+                                   "p50": 1000 * _percentile(lats,50),
+                                   "p99": 1000 * _percentile(lats,99),
+                                   "max": 1000 * lats[-1]}
+        return results
+
+
+def _percentile(values,pct):
+    """Nearest-rank percentile of a sorted list."""
+    idx = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0,min(idx,len(values) - 1))]
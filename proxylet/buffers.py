@@ -0,0 +1,129 @@
+"""
+
+  proxylet.buffers:  buffering message bodies in memory or on disk
+
+Most bodies are streamed through the proxy a block at a time, but some must
+be read in full before any of them can be sent, such as a rewritten body
+whose new Content-Length has to be known up front.  Holding these in memory
+would let a few large responses exhaust it, so they are collected in a
+SpoolBuffer instead.  This keeps up to 'threshold' bytes in memory, and
+beyond that moves the data into an anonymous temporary file, which is read
+back through mmap when the body is sent.
+
+The total held in memory by all the buffers in the process is also limited,
+by the MemoryBudget in 'memoryBudget'.  Once that is used up, new data goes
+straight to disk whatever its size.  The limit can be changed with:
+
+    proxylet.buffers.memoryBudget.limit = 16 * 1024 * 1024
+
+"""
+
+import mmap
+import tempfile
+
+
+#  Bytes that a single buffer may hold in memory before spilling to disk.
+SPOOL_THRESHOLD = 1024 * 1024
+
+#  Bytes that all buffers together may hold in memory.
+MEMORY_LIMIT = 64 * 1024 * 1024
+
+#  Size of the blocks in which spilled data is read back.
+READ_SIZE = 64 * 1024
+
+
+class MemoryBudget(object):
+    """Limit on the number of bytes held in memory by a set of buffers."""
+
+    def __init__(self,limit=MEMORY_LIMIT):
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self,nbytes):
+        """Try to reserve 'nbytes', returning whether they were granted."""
+        if self.limit is not None and self.used + nbytes > self.limit:
+          return False
+        self.used += nbytes
+        return True
+
+    def release(self,nbytes):
+        self.used -= nbytes
+
+
+#  The budget shared by all buffers that aren't given one.
+memoryBudget = MemoryBudget()
+
+
+class SpoolBuffer(object):
+    """Buffer that holds data in memory and spills it to disk when large.
+
+    Data is added with write(), and iterating over the buffer gives it back
+    in blocks.  The buffer can only be iterated once; it is closed when the
+    iteration finishes, releasing its memory and deleting the file.  The
+    total number of bytes written is available as 'size'.
+    """
+
+    def __init__(self,threshold=SPOOL_THRESHOLD,budget=None):
+        if budget is None:
+          budget = memoryBudget
+        self.threshold = threshold
+        self.budget = budget
+        self.size = 0
+        self.file = None
+        self._chunks = []
+        self._reserved = 0
+
+    def __len__(self):
+        return self.size
+
+    def spilled(self):
+        return self.file is not None
+
+    def write(self,data):
+        if not data:
+          return
+        n = len(data)
+        self.size += n
+        if self.file is None:
+          if self._reserved + n <= self.threshold and self.budget.reserve(n):
+            self._reserved += n
+            self._chunks.append(data)
+            return
+          self._spill()
+        self.file.write(data)
+
+    def _spill(self):
+        self.file = tempfile.TemporaryFile(prefix="proxylet-")
+        for chunk in self._chunks:
+          self.file.write(chunk)
+        self._chunks = []
+        self._release()
+
+    def _release(self):
+        if self._reserved:
+          self.budget.release(self._reserved)
+          self._reserved = 0
+
+    def __iter__(self):
+        try:
+          if self.file is None:
+            chunks = self._chunks
+            self._chunks = []
+            for chunk in chunks:
+              yield chunk
+          elif self.size:
+            self.file.flush()
+            data = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+            try:
+              for pos in xrange(0,self.size,READ_SIZE):
+                yield data[pos:pos+READ_SIZE]
+            finally:
+              data.close()
+        finally:
+          self.close()
+
+    def close(self):
+        self._chunks = []
+        self._release()
+        if self.file is not None:
+          self.file.close()
@@ -0,0 +1,697 @@
+"""
+
+  proxylet.cache:  in-memory cache of responses to GET and HEAD requests
+
+A ResponseCache sits between the Dispatcher and the upstream servers, and
+answers repeated requests for cacheable resources without contacting the
+backend at all.  Pass one to the Server to enable it:
+
+    cache = ResponseCache(64 * 1024 * 1024)
+    Server(host,port,mapper,cache=cache).serve()
+
+Responses are stored as they are sent to the client, after any rewriting,
+so serving a hit costs little more than writing out a string.  Only
+responses with an explicit freshness lifetime are stored, as given by the
+"s-maxage" or "max-age" directives of Cache-Control or by the Expires
+header.  Responses marked "no-store", "no-cache" or "private", those
+setting cookies and those with "Vary: *" are never stored, and neither
+are responses to requests carrying credentials or asking for a range.
+If a response varies on request headers, a separate copy is stored for
+each combination of their values.
+
+Clients can skip the cache by sending "Cache-Control: no-cache" or limit
+the age of the response with "max-age".  Conditional requests are answered
+from the cache with "304 Not Modified" when the stored ETag (for
+If-None-Match) or Last-Modified date (for If-Modified-Since) allows.  A
+request with any other method discards the stored responses for its URI.
+
+Entries are evicted in least-recently-used order to keep the total size
+of the stored responses within a budget of 'size' bytes.
+
+Concurrent misses for the same resource are collapsed into a single
+upstream request.  While a GET is being fetched, further GETs for the
+same key wait for its headers; if the response turns out to be cacheable,
+they follow it, receiving the body as it streams in rather than waiting
+for it to be stored.  Otherwise they go upstream as usual.  If the fetch
+fails part-way through, the connections of the followers are closed too,
+just as the client's would be.  Each block of the body is kept only until
+every follower has sent it, and a follower that falls more than 'max_lag'
+bytes behind is dropped, closing its connection.
+
+"""
+
+import time
+import weakref
+from email.utils import parsedate_tz, mktime_tz
+
+from lru import SizedLRUCache
+from streams import GeneratorStream, StringStream, _isHTTP11
+from engines import getEngine
+
+
+#  Status codes of responses that may be stored.
+CACHEABLE_STATUS = (200,203,300,301,404,410)
+
+#  Headers that apply to a single connection, and are not stored.
+HOP_BY_HOP = ("connection","keep-alive","proxy-authenticate",
+              "proxy-authorization","te","trailer","trailers",
+              "transfer-encoding","upgrade","content-length","age")
+
+#  Headers sent along with a "304 Not Modified" response.
+NOT_MODIFIED_HEADERS = ("cache-control","content-location","date","etag",
+                        "expires","vary","last-modified")
+
+#  Maximum number of variants stored for a single URI.
+MAX_VARIANTS = 8
+
+
+class ResponseCache(object):
+    """Byte-budgeted LRU cache of responses to GET and HEAD requests.
+
+    At most 'size' bytes of responses are stored, and responses with
+    bodies larger than 'max_entry' bytes are passed through unstored.
+    Entries are keyed by the Host header and URI of the request as sent
+    by the client, so the cache must be cleared if the mapping of URIs
+    to upstream servers changes; the Server does this in setMapper().
+    At most 'max_lag' bytes of a response being fetched are held for
+    requests following it; this should be no less than 'max_entry'.
+    """
+
+    def __init__(self,size=64*1024*1024,max_entry=1024*1024,
+                      max_lag=4*1024*1024):
+        self.size = size
+        self.max_entry = max_entry
+        self.max_lag = max_lag
+        # Maps keys to lists of CacheEntry objects, one for each variant
+        self._entries = SizedLRUCache(size,_sizeofVariants)
+        # Maps keys to the Inflight object for a GET being fetched
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def invalidate(self,key):
+        """Discard all stored responses for the given key."""
+        self._entries.pop(key)
+
+    def keyFor(self,req):
+        """Get the cache key for a request, or None if it can't be cached.
+
+        Requests with methods other than GET and HEAD invalidate the
+        stored responses for their URI, as they may change the resource.
+        """
+        key = (req.fields.get("Host","").lower(),req.reqURI)
+        method = req.reqMethod.upper()
+        if method not in ("GET","HEAD"):
+          self.invalidate(key)
+          return None
+        fields = req.fields
+        if "Authorization" in fields or "Range" in fields:
+          return None
+        if "no-store" in _directives(fields.getlist("Cache-Control")):
+          return None
+        return key
+
+    def lookup(self,key,req):
+        """Find a stored response to the given request.
+
+        If there is a fresh response acceptable to the client, this
+        returns a tuple (status,stream,keepAlive) giving the status code,
+        a stream of the response to send, and whether the connection can
+        be kept open afterwards; otherwise it returns None.
+        """
+        if _noCache(req):
+          return None
+        variants = self._entries.get(key)
+        if not variants:
+          return None
+        for entry in variants:
+          if entry.matches(req):
+            break
+        else:
+          return None
+        now = time.time()
+        if now >= entry.expires:
+          variants = [v for v in variants if v is not entry]
+          if variants:
+            self._entries.put(key,variants)
+          else:
+            self.invalidate(key)
+          return None
+        age = entry.age(now)
+        cc = _directives(req.fields.getlist("Cache-Control"))
+        maxAge = _parseSeconds(cc.get("max-age"))
+        if maxAge is not None and age > maxAge:
+          return None
+        keepAlive = req.keepAlive()
+        if entry.notModified(req):
+          data = entry.render(age,keepAlive,False,True)
+          return (304,StringStream(data),keepAlive)
+        data = entry.render(age,keepAlive,req.reqMethod.upper() != "HEAD")
+        return (entry.status,StringStream(data),keepAlive)
+
+    def follow(self,key,req):
+        """Follow a response to the same key that is being fetched.
+
+        If a GET for this key is in progress, this waits until its headers
+        have arrived.  If the response can be shared with this request,
+        the result is as for lookup(), with the body being streamed as it
+        arrives.  Otherwise, or if there's nothing to follow, it is None.
+
+        If there's nothing to follow and this is a GET, the key is reserved
+        for this request, so that others can follow it from the moment it
+        is sent upstream.  The request must then be passed to wrap(), and
+        to abandon() whether or not that succeeded.
+        """
+        if _noCache(req):
+          return None
+        inflight = self._inflight.get(key)
+        if inflight is None:
+          if req.reqMethod.upper() == "GET":
+            self._inflight[key] = Inflight(req)
+          return None
+        if not inflight.joinable:
+          return None
+        # The follower is attached from the start, so that none of the
+        # body can be discarded before it is sent.
+        follower = Follower(inflight,req)
+        try:
+          entry = inflight.waitForHeaders()
+          if entry is None or not entry.matches(req):
+            return None
+          keepAlive = req.keepAlive()
+          if entry.notModified(req):
+            data = entry.render(entry.age(time.time()),keepAlive,False,True)
+            return (304,StringStream(data),keepAlive)
+          follower.setFraming(req)
+          (result,follower) = (follower,None)
+          return (entry.status,result,result.keepAlive)
+        finally:
+          if follower is not None:
+            follower.close()
+
+    def wrap(self,key,req,resp,uresp,onskip=None):
+        """Wrap a response to a request, to store a copy when it's sent.
+
+        Here 'resp' is the response stream that will be sent to the client,
+        and 'uresp' is the underlying HTTPResponse from the upstream server.
+        If the key was reserved for this request by follow(), it is handed
+        over to the returned stream, and other requests may follow it until
+        the response has been sent.  Should the stream be discarded without
+        being sent, the key is released when it is garbage collected.
+        """
+        inflight = self._inflight.get(key)
+        if inflight is None or inflight.owner is not req:
+          return CachingStream(resp,self,key,req,uresp,onskip)
+        inflight.owner = None
+        stream = CachingStream(resp,self,key,req,uresp,onskip,inflight)
+        inflight.sender = weakref.ref(stream,lambda ref:
+                                        self._abandonInflight(key,inflight))
+        return stream
+
+    def abandon(self,key,req):
+        """Release the key if still reserved for the given request."""
+        inflight = self._inflight.get(key)
+        if inflight is not None and inflight.owner is req:
+          self._abandonInflight(key,inflight)
+
+    def _abandonInflight(self,key,inflight):
+        if not inflight.done:
+          inflight.fail()
+        self._finishInflight(key,inflight)
+
+    def _finishInflight(self,key,inflight):
+        if self._inflight.get(key) is inflight:
+          del self._inflight[key]
+
+    def _freshness(self,req,resp):
+        """Check whether a response can be stored.
+
+        Returns the time at which the response expires and its age when
+        it was received, or None if the response can't be stored.
+        """
+        if req.reqMethod.upper() != "GET":
+          return None
+        if resp.respStatus not in CACHEABLE_STATUS or resp._interim:
+          return None
+        fields = resp.fields
+        cc = _directives(fields.getlist("Cache-Control"))
+        if "no-store" in cc or "no-cache" in cc or "private" in cc:
+          return None
+        if "Set-Cookie" in fields:
+          return None
+        if "*" in fields.getlist("Vary"):
+          return None
+        cl = fields.get("Content-Length")
+        if cl is not None and cl.isdigit() and int(cl) > self.max_entry:
+          return None
+        now = time.time()
+        lifetime = _parseSeconds(cc.get("s-maxage"))
+        if lifetime is None:
+          lifetime = _parseSeconds(cc.get("max-age"))
+        if lifetime is None:
+          expires = _parseDate(fields.get("Expires"))
+          if expires is None:
+            return None
+          date = _parseDate(fields.get("Date"))
+          if date is None:
+            date = now
+          lifetime = expires - date
+        initialAge = _parseSeconds(fields.get("Age")) or 0
+        if lifetime <= initialAge:
+          return None
+        return (now + lifetime - initialAge,initialAge)
+
+    def _store(self,key,entry):
+        variants = self._entries.get(key)
+        if variants is None:
+          variants = []
+        else:
+          variants = [v for v in variants if v.vary != entry.vary]
+        variants.append(entry)
+        del variants[:-MAX_VARIANTS]
+        self._entries.put(key,variants)
+
+
+class CacheEntry(object):
+    """A single stored response.
+
+    The status line and headers are formatted when the entry is created,
+    leaving only the framing and Age headers to be added when it is sent.
+    The body is filled in once it has been received.
+    """
+
+    def __init__(self,req,resp,expires,initialAge):
+        self.status = resp.respStatus
+        self.body = None
+        self.expires = expires
+        self.initialAge = initialAge
+        self.stored = time.time()
+        fields = resp.fields
+        self.etag = fields.get("ETag")
+        self.lastModified = _parseDate(fields.get("Last-Modified"))
+        # The request headers named by Vary, and the values they had
+        self.vary = tuple([(nm.lower(),req.fields.get(nm)) for nm in fields.getlist("Vary")])
+        # Headers named in the Connection header are hop-by-hop too
+        skip = set(HOP_BY_HOP)
+        skip.update([c.lower() for c in fields.getlist("Connection")])
+        head = ["HTTP/1.1 %d %s\r\n" % (self.status,resp.respReason)]
+        notModified = ["HTTP/1.1 304 Not Modified\r\n"]
+        for (name,value) in fields:
+          lname = name.lower()
+          if lname not in skip:
+            head.append("%s: %s\r\n" % (name,value))
+            if lname in NOT_MODIFIED_HEADERS:
+              notModified.append("%s: %s\r\n" % (name,value))
+        self.head = "".join(head)
+        self.notModifiedHead = "".join(notModified)
+
+    def _getSize(self):
+        return len(self.head) + len(self.notModifiedHead) + len(self.body)
+    size = property(_getSize)
+
+    def age(self,now):
+        return int(now - self.stored) + self.initialAge
+
+    def matches(self,req):
+        """Check whether this variant was stored for a matching request."""
+        fields = req.fields
+        for (name,value) in self.vary:
+          if fields.get(name) != value:
+            return False
+        return True
+
+    def notModified(self,req):
+        """Check whether a conditional request can be answered with 304."""
+        fields = req.fields
+        tags = fields.getlist("If-None-Match")
+        if tags:
+          if self.etag is None:
+            return False
+          if "*" in tags:
+            return True
+          # GET and HEAD use the weak comparison function
+          etag = _weakTag(self.etag)
+          for tag in tags:
+            if _weakTag(tag) == etag:
+              return True
+          return False
+        since = _parseDate(fields.get("If-Modified-Since"))
+        if since is None or self.lastModified is None:
+          return False
+        return self.lastModified <= since
+
+    def render(self,age,keepAlive=True,body=True,notModified=False):
+        """Format the stored response for sending, given its current age."""
+        if notModified:
+          out = [self.notModifiedHead]
+        else:
+          out = [self.head,"Content-Length: %d\r\n" % (len(self.body),)]
+        out.append("Age: %d\r\n" % (age,))
+        if not keepAlive:
+          out.append("Connection: close\r\n")
+        out.append("\r\n")
+        if body and not notModified:
+          out.append(self.body)
+        return "".join(out)
+
+
+class Inflight(object):
+    """A GET response being fetched, which other requests may follow.
+
+    Once the headers have arrived, 'entry' gives the CacheEntry that will
+    be stored, or None if the response can't be shared.  The blocks of the
+    body are appended to 'blocks' as they are sent, and 'done' or 'failed'
+    is set at the end.  Followers block in wait() for any of these changes.
+    Each attached Follower records in 'pos' the index in the body of the
+    next block it will send.  Once no more followers can join, blocks that
+    all of them have sent are discarded, 'first' giving the index of the
+    first block kept.  Until its response is being sent, 'owner' is the
+    request fetching it; after that, 'sender' is a weak reference to the
+    CachingStream sending the response.
+    """
+
+    def __init__(self,owner=None):
+        self.owner = owner
+        self.sender = None
+        self.decided = False
+        self.entry = None
+        self.length = None
+        self.blocks = []
+        self.first = 0
+        # Total size of the body so far, and of the blocks kept
+        self.size = 0
+        self.buffered = 0
+        self.done = False
+        self.failed = False
+        # Cleared once the body has outgrown the cache, so that its
+        # blocks need only be kept for the followers already attached
+        self.joinable = True
+        self.followers = set()
+        self._waiters = []
+
+    def wait(self):
+        sem = getEngine().semaphore(0)
+        self._waiters.append(sem)
+        sem.acquire()
+
+    def wake(self):
+        (waiters,self._waiters) = (self._waiters,[])
+        for sem in waiters:
+          sem.release()
+
+    def waitForHeaders(self):
+        while not self.decided:
+          self.wait()
+        return self.entry
+
+    def decide(self,entry,length=None):
+        self.decided = True
+        self.entry = entry
+        self.length = length
+        if entry is None:
+          self.joinable = False
+        self.wake()
+
+    def attach(self,follower):
+        follower.pos = self.first
+        self.followers.add(follower)
+
+    def detach(self,follower):
+        if follower in self.followers:
+          self.followers.remove(follower)
+          self._trim()
+
+    def append(self,data,limit,maxLag):
+        self.size += len(data)
+        if self.size > limit:
+          self.joinable = False
+        self.blocks.append(data)
+        self.buffered += len(data)
+        self._trim()
+        # Detach the followers furthest behind until few enough blocks
+        # are kept; they fail when they next try to send a block.
+        while self.buffered > maxLag and self.followers:
+          for follower in list(self.followers):
+            if follower.pos <= self.first:
+              self.followers.remove(follower)
+          self._trim()
+        self.wake()
+
+    def advance(self,follower):
+        """Move a follower past the block it has just taken."""
+        follower.pos += 1
+        if follower.pos == self.first + 1:
+          self._trim()
+
+    def _trim(self):
+        """Discard the blocks that every follower has sent."""
+        if self.joinable:
+          return
+        if self.followers:
+          low = min([follower.pos for follower in self.followers])
+        else:
+          low = self.first + len(self.blocks)
+        count = low - self.first
+        if count > 0:
+          self.buffered -= sum([len(data) for data in self.blocks[:count]])
+          del self.blocks[:count]
+          self.first = low
+
+    def finish(self):
+        self.done = True
+        self.joinable = False
+        self.wake()
+
+    def fail(self):
+        if not self.decided:
+          self.decide(None)
+        self.failed = True
+        self.joinable = False
+        self.wake()
+
+
+class CachingStream(GeneratorStream):
+    """Pass a response through unchanged, storing a copy in a ResponseCache.
+
+    Whether the response can be stored is decided once its headers have
+    been sent.  If it can't, the function 'onskip' is called before any
+    of the body is read, so that the body can be relayed directly instead.
+    Otherwise the body is collected as it is sent, and the response is
+    stored once it has been sent in full.  Progress is published to the
+    given Inflight object, if any, for other requests to follow.
+    """
+
+    __slots__ = ("cache","key","request","response","onskip","inflight",
+                 "__weakref__")
+
+    def __init__(self,stream,cache,key,request,response,onskip=None,
+                      inflight=None):
+        GeneratorStream.__init__(self,stream)
+        self.cache = cache
+        self.key = key
+        self.request = request
+        self.response = response
+        self.onskip = onskip
+        self.inflight = inflight
+
+    def _generateLines(self):
+        inflight = self.inflight
+        try:
+          for ln in self._sendResponse():
+            yield ln
+        finally:
+          # If sending stopped early, the followers can't be completed
+          if inflight is not None:
+            if not inflight.done:
+              inflight.fail()
+            self.cache._finishInflight(self.key,inflight)
+
+    def _sendResponse(self):
+        lines = iter(self.stream)
+        resp = self.response
+        inflight = self.inflight
+        # Any interim responses come first, then the status line and the
+        # headers; the response is parsed once the first line is read.
+        count = 0
+        for ln in lines:
+          yield ln
+          count += 1
+          if count >= len(resp._interim) + 2:
+            break
+        freshness = self.cache._freshness(self.request,resp)
+        if freshness is None:
+          if inflight is not None:
+            inflight.decide(None)
+          if self.onskip is not None:
+            self.onskip()
+          for ln in lines:
+            yield ln
+          return
+        entry = CacheEntry(self.request,resp,freshness[0],freshness[1])
+        if inflight is not None:
+          length = resp.fields.get("Content-Length")
+          if resp.chunked or length is None or not length.isdigit():
+            length = None
+          inflight.decide(entry,length)
+        # The body is about to be read, so the decoded and rewritten data
+        # can be collected by wrapping it.
+        body = []
+        resp.body = self._collect(resp.body,body)
+        for ln in lines:
+          yield ln
+        if len(body) == 1 and resp.complete and resp._delimited:
+          if not resp.trailers:
+            entry.body = body[0]
+            self.cache._store(self.key,entry)
+        if inflight is not None:
+          inflight.finish()
+
+    def _collect(self,body,out):
+        """Yield the blocks of the body, collecting them in 'out'.
+
+        Once the body grows beyond the cache's limit, collection stops
+        and 'out' is emptied; at the end it holds a single string.
+        """
+        inflight = self.inflight
+        limit = self.cache.max_entry
+        size = 0
+        for data in body:
+          if out is not None:
+            size += len(data)
+            if size > limit:
+              del out[:]
+              out = None
+            else:
+              out.append(data)
+          if inflight is not None:
+            inflight.append(data,limit,self.cache.max_lag)
+          yield data
+        if out is not None:
+          out[:] = ["".join(out)]
+
+
+class Follower(GeneratorStream):
+    """Response stream following an Inflight response for another request.
+
+    The body is sent with the same Content-Length as the original if it
+    had one, otherwise with chunked encoding to HTTP/1.1 clients or by
+    closing the connection for earlier ones; setFraming() decides which
+    once the headers have arrived.  The follower is attached to the
+    Inflight response from creation until it is closed or finishes.  If
+    the original fails, or this falls too far behind it, an IOError is
+    raised, so that this connection is closed as well.
+    """
+
+    __slots__ = ("inflight","head","keepAlive","chunked","pos")
+
+    def __init__(self,inflight,request):
+        GeneratorStream.__init__(self,None)
+        self.inflight = inflight
+        self.head = request.reqMethod.upper() == "HEAD"
+        self.keepAlive = request.keepAlive()
+        self.chunked = False
+        inflight.attach(self)
+
+    def setFraming(self,request):
+        if self.inflight.length is None and not self.head:
+          if _isHTTP11(request.reqProtocol):
+            self.chunked = True
+          else:
+            self.keepAlive = False
+
+    def close(self):
+        self._lines.close()
+        self.inflight.detach(self)
+
+    def _generateLines(self):
+        inflight = self.inflight
+        try:
+          if self.pos < inflight.first:
+            raise IOError("followed response is no longer available")
+          entry = inflight.entry
+          out = [entry.head]
+          if inflight.length is not None:
+            out.append("Content-Length: %s\r\n" % (inflight.length,))
+          elif self.chunked:
+            out.append("Transfer-Encoding: chunked\r\n")
+          out.append("Age: %d\r\n" % (entry.age(time.time()),))
+          if not self.keepAlive:
+            out.append("Connection: close\r\n")
+          out.append("\r\n")
+          yield "".join(out)
+          if self.head:
+            return
+          while True:
+            while self.pos < inflight.first + len(inflight.blocks):
+              if self.pos < inflight.first:
+                raise IOError("follower fell too far behind the response")
+              data = inflight.blocks[self.pos - inflight.first]
+              inflight.advance(self)
+              if self.chunked:
+                yield "%x\r\n%s\r\n" % (len(data),data)
+              else:
+                yield data
+            if inflight.done:
+              break
+            if inflight.failed:
+              raise IOError("followed response failed")
+            inflight.wait()
+          if self.chunked:
+            yield "0\r\n\r\n"
+        finally:
+          inflight.detach(self)
+
+
+def _sizeofVariants(variants):
+    return sum([entry.size for entry in variants])
+
+
+def _noCache(req):
+    """Check whether the client asked for the cache to be bypassed."""
+    fields = req.fields
+    if "no-cache" in _directives(fields.getlist("Cache-Control")):
+      return True
+    return "no-cache" in [p.lower() for p in fields.getlist("Pragma")]
+
+
+def _directives(values):
+    """Parse the elements of a Cache-Control header into a dict."""
+    directives = {}
+    for elem in values:
+      (name,_,value) = elem.partition("=")
+      directives[name.strip().lower()] = value.strip().strip('"')
+    return directives
+
+
+def _parseSeconds(value):
+    """Parse a delta-seconds value, giving None if it is invalid."""
+    if value is None:
+      return None
+    value = value.strip()
+    if not value.isdigit():
+      return None
+    return int(value)
+
+
+def _parseDate(value):
+    """Parse a HTTP date into a timestamp, giving None if it is invalid."""
+    if value is None:
+      return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+      return None
+    try:
+      return mktime_tz(parsed)
+    except (ValueError,OverflowError):
+      return None
+
+
+def _weakTag(tag):
+    tag = tag.strip()
+    if tag.startswith("W/"):
+      tag = tag[2:]
+    return tag
@@ -0,0 +1,397 @@
+"""
+
+  proxylet.engines:  pluggable event loops for proxylet
+
+The proxy is written as straight-line code running in lightweight threads,
+with the event loop hidden behind a small interface: spawning threads,
+sleeping, timers, semaphores, and opening and accepting connections.  An
+engine implements this interface for a particular event loop.  The
+following engines are available:
+
+    * eventlet:  the eventlet.api hub; this is the default
+    * asyncio:   an asyncio event loop, or trollius under Python 2
+
+The asyncio engine runs each thread in a greenlet.  Whenever a thread has
+to wait for IO, it hands the operation to the event loop as a future and
+switches back to the loop, which resumes the thread once the future is
+done.  The same mappers and rewriters therefore run unchanged on either
+kind of loop.  Writes wait until the data has been accepted by the socket,
+so slow clients apply backpressure all the way back to the upstream server.
+
+Messages are written in a few large pieces, such as a head followed by
+its body, so Nagle's algorithm would only hold back the last piece until
+the previous one is acknowledged.  Connections made by an engine, and
+those accepted by the Server, therefore have TCP_NODELAY set.
+
+There is a single current engine for each process, which should be chosen
+before anything is served:
+
+    proxylet.Server(host,port,mapper,engine="asyncio").serve()
+
+"""
+
+import errno
+import socket
+from collections import deque
+
+
+class EventletEngine(object):
+    """Engine running on the eventlet.api hub."""
+
+    name = "eventlet"
+
+    def __init__(self):
+        from eventlet import api, coros, greenio
+        self._api = api
+        self._coros = coros
+        self._greenio = greenio
+
+    def run(self,func,*args,**kwds):
+        """Call func in the current thread, returning its result."""
+        return func(*args,**kwds)
+
+    def spawn(self,func,*args,**kwds):
+        return self._api.spawn(func,*args,**kwds)
+
+    def sleep(self,seconds=0):
+        self._api.sleep(seconds)
+
+    def current(self):
+        return self._api.getcurrent()
+
+    def interrupt(self,thread,exc):
+        """Raise exc in the given thread, which must be blocked.
+
+        This returns an object whose cancel() method will prevent the
+        exception from being raised, if it hasn't been already.
+        """
+        return self._api.call_after_global(0,thread.throw,exc)
+
+    def callLater(self,seconds,func,*args):
+        """Call func in the event loop after 'seconds'.
+
+        Like interrupt(), this returns an object with a cancel() method.
+        """
+        return self._api.call_after_global(seconds,func,*args)
+
+    def semaphore(self,count):
+        return self._coros.semaphore(count)
+
+    def connect(self,address):
+        sock = self._api.connect_tcp(address)
+        setNoDelay(sock)
+        return sock
+
+    def listen(self,address,backlog=50):
+        return self._api.tcp_listener(address,backlog)
+
+    def wrapListener(self,sock):
+        """Wrap an existing listening socket for use with this engine."""
+        return self._greenio.GreenSocket(sock)
+
+
+class AsyncioEngine(object):
+    """Engine running threads as greenlets on an asyncio event loop.
+
+    If 'loop' is not given, a new event loop is created.
+    """
+
+    name = "asyncio"
+
+    def __init__(self,loop=None):
+        import greenlet
+        self._greenlet = greenlet
+        self.asyncio = _importAsyncio()
+        if loop is None:
+          loop = self.asyncio.new_event_loop()
+        self.loop = loop
+        # The greenlet that runs the event loop
+        self._hub = greenlet.getcurrent()
+
+    def run(self,func,*args,**kwds):
+        """Run func in a new thread, driving the loop until it returns."""
+        loop = self.loop
+        self._hub = self._greenlet.getcurrent()
+        outcome = []
+        def main():
+            try:
+              outcome.append((True,func(*args,**kwds)))
+            except BaseException, e:
+              outcome.append((False,e))
+            loop.stop()
+        self.spawn(main)
+        loop.run_forever()
+        (ok,value) = outcome[0]
+        if not ok:
+          raise value
+        return value
+
+    def spawn(self,func,*args,**kwds):
+        g = self._greenlet.greenlet(func,self._hub)
+        self.loop.call_soon(lambda: g.switch(*args,**kwds))
+        return g
+
+    def wait(self,future):
+        """Block the current thread until the given future is done.
+
+        Coroutines are accepted too, and are scheduled as tasks.  If the
+        thread is interrupted while waiting, the future is cancelled.
+        """
+        current = self._greenlet.getcurrent()
+        if current is self._hub:
+          raise RuntimeError("cannot block in the event loop")
+        future = self.asyncio.ensure_future(future,loop=self.loop)
+        def resume(f):
+            current.switch()
+        future.add_done_callback(resume)
+        try:
+          self._hub.switch()
+        except:
+          future.remove_done_callback(resume)
+          future.cancel()
+          raise
+        return future.result()
+
+    def newFuture(self):
+        return self.asyncio.Future(loop=self.loop)
+
+    def sleep(self,seconds=0):
+        future = self.newFuture()
+        handle = self.loop.call_later(seconds,_setResult,future)
+        try:
+          self.wait(future)
+        finally:
+          handle.cancel()
+
+    def current(self):
+        return self._greenlet.getcurrent()
+
+    def interrupt(self,thread,exc):
+        # This may be called from a signal handler, so wake up the loop
+        return self.loop.call_soon_threadsafe(thread.throw,exc)
+
+    def callLater(self,seconds,func,*args):
+        return self.loop.call_later(seconds,func,*args)
+
+    def semaphore(self,count):
+        return _Semaphore(self,count)
+
+    def connect(self,address):
+        (host,port) = address
+        infos = self.wait(self.loop.getaddrinfo(host,port,type=socket.SOCK_STREAM))
+        (family,type,proto,_,addr) = infos[0]
+        sock = socket.socket(family,type,proto)
+        sock.setblocking(False)
+        try:
+          self.wait(self.loop.sock_connect(sock,addr))
+        except socket.error:
+          sock.close()
+          raise
+        except EnvironmentError, e:
+          # trollius raises OSError for failed connects; report them
+          # as socket errors, like the eventlet engine does.
+          sock.close()
+          raise socket.error(e.errno,e.strerror)
+        except:
+          sock.close()
+          raise
+        setNoDelay(sock)
+        return AsyncioSocket(self,sock)
+
+    def listen(self,address,backlog=50):
+        sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        sock.bind(address)
+        sock.listen(backlog)
+        return self.wrapListener(sock)
+
+    def wrapListener(self,sock):
+        return AsyncioSocket(self,sock)
+
+
+def _setResult(future,result=None):
+    if not future.done():
+      future.set_result(result)
+
+
+class _Semaphore(object):
+    """Counting semaphore for threads of an AsyncioEngine."""
+
+    def __init__(self,engine,count):
+        self.engine = engine
+        self.counter = count
+        self._waiters = deque()
+
+    def acquire(self):
+        while self.counter <= 0:
+          future = self.engine.newFuture()
+          self._waiters.append(future)
+          try:
+            self.engine.wait(future)
+          except:
+            # Pass on a wakeup that we won't be using
+            if future.done() and not future.cancelled():
+              self._wakeOne()
+            raise
+        self.counter -= 1
+        return True
+
+    def release(self):
+        self.counter += 1
+        self._wakeOne()
+
+    def _wakeOne(self):
+        while self._waiters:
+          future = self._waiters.popleft()
+          if not future.done():
+            future.set_result(None)
+            break
+
+
+class AsyncioSocket(object):
+    """Socket whose blocking methods wait on an AsyncioEngine's loop.
+
+    This provides the subset of the socket interface used by proxylet.
+    Each operation is first tried directly on the non-blocking socket, so
+    the event loop is only involved when the socket isn't ready.  Data
+    left over by readline() is kept in 'recvbuffer', as for eventlet.
+    """
+
+    def __init__(self,engine,sock):
+        self.engine = engine
+        self.fd = sock
+        sock.setblocking(False)
+        self.recvbuffer = ""
+        self._pending = set()
+
+    def fileno(self):
+        return self.fd.fileno()
+
+    def setblocking(self,flag):
+        # The underlying socket must always be non-blocking
+        pass
+
+    def setsockopt(self,level,option,value):
+        self.fd.setsockopt(level,option,value)
+
+    def _wait(self,future):
+        future = self.engine.asyncio.ensure_future(future,loop=self.engine.loop)
+        self._pending.add(future)
+        try:
+          return self.engine.wait(future)
+        except self.engine.asyncio.CancelledError:
+          raise socket.error(errno.EBADF,"socket closed while waiting")
+        except socket.error:
+          raise
+        except EnvironmentError, e:
+          # As for connect(), trollius raises OSError on failures
+          raise socket.error(e.errno,e.strerror)
+        finally:
+          self._pending.discard(future)
+
+    def recv(self,size):
+        buf = self.recvbuffer
+        if buf:
+          (data,self.recvbuffer) = (buf[:size],buf[size:])
+          return data
+        try:
+          return self.fd.recv(size)
+        except socket.error, e:
+          if e.args[0] not in _WOULDBLOCK:
+            raise
+        return self._wait(self.engine.loop.sock_recv(self.fd,size))
+
+    def recv_into(self,buf,size=0):
+        try:
+          return self.fd.recv_into(buf,size)
+        except socket.error, e:
+          if e.args[0] not in _WOULDBLOCK:
+            raise
+        loop = self.engine.loop
+        if hasattr(loop,"sock_recv_into"):
+          return self._wait(loop.sock_recv_into(self.fd,buf))
+        data = self._wait(loop.sock_recv(self.fd,size or len(buf)))
+        buf[:len(data)] = data
+        return len(data)
+
+    def sendall(self,data):
+        try:
+          sent = self.fd.send(data)
+        except socket.error, e:
+          if e.args[0] not in _WOULDBLOCK:
+            raise
+          sent = 0
+        if sent < len(data):
+          if isinstance(data,memoryview):
+            data = data.tobytes()
+          self._wait(self.engine.loop.sock_sendall(self.fd,data[sent:]))
+
+    def accept(self):
+        try:
+          (sock,addr) = self.fd.accept()
+        except socket.error, e:
+          if e.args[0] not in _WOULDBLOCK:
+            raise
+          (sock,addr) = self._wait(self.engine.loop.sock_accept(self.fd))
+        return (AsyncioSocket(self.engine,sock),addr)
+
+    def shutdown(self,how):
+        self.fd.shutdown(how)
+
+    def close(self):
+        for future in list(self._pending):
+          future.cancel()
+        # A cancelled operation may have left the socket registered with
+        # the loop, which would confuse a new socket given the same fd.
+        try:
+          fd = self.fd.fileno()
+        except socket.error:
+          return
+        loop = self.engine.loop
+        loop.remove_reader(fd)
+        loop.remove_writer(fd)
+        self.fd.close()
+
+
+_WOULDBLOCK = (errno.EAGAIN,errno.EWOULDBLOCK)
+
+
+def setNoDelay(sock):
+    """Have small writes to a TCP socket sent without delay."""
+    try:
+      sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    except socket.error:
+      # Not a TCP socket
+      pass
+
+
+def _importAsyncio():
+    try:
+      import asyncio
+    except ImportError:
+      import trollius as asyncio
+    return asyncio
+
+
+#  Factories for the engines that can be selected by name.
+ENGINES = {"eventlet": EventletEngine,
+           "asyncio": AsyncioEngine}
+
+_current = None
+
+
+def getEngine():
+    """Get the current engine, which is an EventletEngine by default."""
+    global _current
+    if _current is None:
+      _current = EventletEngine()
+    return _current
+
+
+def useEngine(engine):
+    """Set the current engine, given either by name or as an object."""
+    global _current
+    if isinstance(engine,basestring):
+      engine = ENGINES[engine]()
+    _current = engine
+    return engine
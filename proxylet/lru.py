@@ -0,0 +1,106 @@
+"""
+
+  proxylet.lru:  simple bounded least-recently-used cache
+
+"""
+
+from itertools import count
+
+
+class LRUCache(object):
+    """Dictionary-like cache holding at most 'size' entries.
+
+    Each entry is stamped with the time it was last used.  When the cache
+    is full, the least recently used quarter of the entries is evicted in
+    one go.  This keeps get(), which is usually on a hot path, to a single
+    dict lookup and a counter increment.
+    """
+
+    def __init__(self,size):
+        self.size = size
+        # Maps keys to [value,stamp] lists
+        self._data = {}
+        self._clock = count().next
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self,key):
+        return key in self._data
+
+    def get(self,key,default=None):
+        entry = self._data.get(key)
+        if entry is None:
+          return default
+        entry[1] = self._clock()
+        return entry[0]
+
+    def put(self,key,value):
+        data = self._data
+        entry = data.get(key)
+        if entry is not None:
+          entry[0] = value
+          entry[1] = self._clock()
+          return
+        if len(data) >= self.size:
+          if self.size <= 0:
+            return
+          self._evict()
+        data[key] = [value,self._clock()]
+
+    def clear(self):
+        self._data.clear()
+
+    def _evict(self):
+        data = self._data
+        byAge = sorted(data.iteritems(),key=lambda item: item[1][1])
+        for (key,_) in byAge[:max(1,self.size // 4)]:
+          del data[key]
+
+
+class SizedLRUCache(LRUCache):
+    """LRUCache bounded by the total size of its values, not their number.
+
+    The size of each value is found by calling 'sizeof' on it, and the
+    total is kept to at most 'size'.  When a new value would take it over
+    this limit, the least recently used entries are evicted until it is
+    under three quarters of the limit, again so that the cost of sorting
+    the entries is spread over many insertions.  Values larger than the
+    whole limit are never stored.
+    """
+
+    def __init__(self,size,sizeof=len):
+        LRUCache.__init__(self,size)
+        self.sizeof = sizeof
+        self.total = 0
+
+    def put(self,key,value):
+        nbytes = self.sizeof(value)
+        self.pop(key)
+        if nbytes > self.size:
+          return
+        if self.total + nbytes > self.size:
+          self._evict(self.size * 3 // 4 - nbytes)
+        self._data[key] = [value,self._clock(),nbytes]
+        self.total += nbytes
+
+    def pop(self,key,default=None):
+        """Remove an entry, returning its value."""
+        entry = self._data.pop(key,None)
+        if entry is None:
+          return default
+        self.total -= entry[2]
+        return entry[0]
+
+    def clear(self):
+        LRUCache.clear(self)
+        self.total = 0
+
+    def _evict(self,target):
+        data = self._data
+        byAge = sorted(data.iteritems(),key=lambda item: item[1][1])
+        for (key,entry) in byAge:
+          if self.total <= target:
+            break
+          del data[key]
+          self.total -= entry[2]
@@ -0,0 +1,263 @@
+"""
+
+  proxylet.metrics:  counters and latency histograms for proxylet
+
+A Metrics object collects statistics about the traffic passing through a
+proxylet.Server, and renders them in the Prometheus text exposition format.
+Pass one to the Server to enable it:
+
+    metrics = Metrics()
+    Server(host,port,mapper,metrics=metrics).serve()
+
+The metrics can then be fetched from the reserved path "/_proxylet/metrics"
+on the proxy itself.  Requests for this path never reach the mapper.
+
+Most metrics are labelled with the route that handled the request.  This
+is the local root URL of a Relocator, or "host:port" for mappings without
+one (or the name of the group, for an UpstreamGroup), and "none" for
+requests that were not mapped at all.
+
+Recording is kept cheap enough to leave on all the time: each update is
+a dictionary lookup and an addition, and histograms have fixed buckets
+found by bisection.
+
+"""
+
+import time
+from bisect import bisect_left
+
+
+#  Default histogram buckets for durations, in seconds.
+LATENCY_BUCKETS = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,
+                   0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+
+class Counter(object):
+    """Monotonically increasing value, one per combination of labels."""
+
+    type = "counter"
+
+    def __init__(self,name,help,labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self,labels=(),amount=1):
+        values = self.values
+        try:
+          values[labels] += amount
+        except KeyError:
+          values[labels] = amount
+
+    def snapshot(self):
+        """Get a copy of the current values, keyed by label values."""
+        return dict(self.values)
+
+    def merge(self,values):
+        """Add in the values from another snapshot."""
+        for (labels,value) in values.iteritems():
+          self.inc(labels,value)
+
+    def samples(self):
+        """Yield (suffix,labels,value) for each sample to be exported."""
+        for (labels,value) in sorted(self.values.iteritems()):
+          yield ("",self._pairs(labels),value)
+
+    def _pairs(self,labels):
+        return zip(self.labelnames,labels)
+
+
+class Gauge(Counter):
+    """Value that can go up as well as down."""
+
+    type = "gauge"
+
+    def dec(self,labels=(),amount=1):
+        self.inc(labels,-amount)
+
+    def set(self,labels,value):
+        self.values[labels] = value
+
+
+class Histogram(Counter):
+    """Distribution of observed values over a fixed set of buckets.
+
+    For each combination of labels we keep a list of per-bucket counts,
+    with an extra bucket at the end for values above the largest bound,
+    followed by the sum of all the observed values.  The counts are only
+    made cumulative when the histogram is exported.
+    """
+
+    type = "histogram"
+
+    def __init__(self,name,help,labelnames=(),buckets=LATENCY_BUCKETS):
+        Counter.__init__(self,name,help,labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self,labels,value):
+        try:
+          data = self.values[labels]
+        except KeyError:
+          data = self.values[labels] = [0] * (len(self.buckets) + 2)
+        data[bisect_left(self.buckets,value)] += 1
+        data[-1] += value
+
+    def snapshot(self):
+        return dict([(labels,list(data)) for (labels,data) in self.values.iteritems()])
+
+    def merge(self,values):
+        size = len(self.buckets) + 2
+        for (labels,data) in values.iteritems():
+          if len(data) != size:
+            continue
+          try:
+            mine = self.values[labels]
+          except KeyError:
+            self.values[labels] = list(data)
+          else:
+            for i in xrange(size):
+              mine[i] += data[i]
+
+    def samples(self):
+        bounds = [_formatValue(b) for b in self.buckets] + ["+Inf"]
+        for (labels,data) in sorted(self.values.iteritems()):
+          pairs = self._pairs(labels)
+          total = 0
+          for i in xrange(len(bounds)):
+            total += data[i]
+            yield ("_bucket",pairs + [("le",bounds[i])],total)
+          yield ("_sum",pairs,data[-1])
+          yield ("_count",pairs,total)
+
+
+class Metrics(object):
+    """The set of metrics recorded for a proxylet.Server.
+
+    The Dispatcher calls the record* methods as requests are handled.
+    Durations are observed in histograms with the given 'buckets'.
+    """
+
+    path = "/_proxylet/metrics"
+
+    def __init__(self,path=None,buckets=LATENCY_BUCKETS):
+        if path is not None:
+          self.path = path
+        self.requests = Counter("proxylet_requests_total",
+                  "Responses sent to clients, by route and status code.",
+                  ("route","code"))
+        self.firstByte = Histogram("proxylet_first_byte_seconds",
+                  "Time from receiving a request to sending the first byte of its response.",
+                  ("route",),buckets)
+        self.duration = Histogram("proxylet_response_seconds",
+                  "Time from receiving a request to sending the last byte of its response.",
+                  ("route",),buckets)
+        self.bytesIn = Counter("proxylet_request_bytes_total",
+                  "Bytes of request data received from clients.",
+                  ("route",))
+        self.bytesOut = Counter("proxylet_response_bytes_total",
+                  "Bytes of response data sent to clients.",
+                  ("route",))
+        self.connections = Gauge("proxylet_active_connections",
+                  "Client connections currently open.")
+        self.connectionsTotal = Counter("proxylet_connections_total",
+                  "Client connections accepted.")
+        self.upstreamConnects = Counter("proxylet_upstream_connects_total",
+                  "New connections opened to upstream servers.",
+                  ("route",))
+        self.errors = Counter("proxylet_errors_total",
+                  "Errors while handling requests, by route and kind.",
+                  ("route","kind"))
+        self.cacheLookups = Counter("proxylet_cache_lookups_total",
+                  "Lookups in the response cache, by route and result.",
+                  ("route","result"))
+        self.timeouts = Counter("proxylet_timeouts_total",
+                  "Timeouts while handling connections, by route and kind.",
+                  ("route","kind"))
+        self.families = [self.requests,self.firstByte,self.duration,
+                         self.bytesIn,self.bytesOut,self.connections,
+                         self.connectionsTotal,self.upstreamConnects,
+                         self.errors,self.cacheLookups,self.timeouts]
+
+    def recordConnect(self):
+        self.connections.inc()
+        self.connectionsTotal.inc()
+
+    def recordDisconnect(self):
+        self.connections.dec()
+
+    def recordRequest(self,route,nbytes):
+        self.bytesIn.inc((route,),nbytes)
+
+    def recordFirstByte(self,route,start):
+        self.firstByte.observe((route,),time.time() - start)
+
+    def recordResponse(self,route,code,start,nbytes):
+        self.requests.inc((route,str(code)))
+        self.duration.observe((route,),time.time() - start)
+        self.bytesOut.inc((route,),nbytes)
+
+    def recordUpstreamConnect(self,route):
+        self.upstreamConnects.inc((route,))
+
+    def recordError(self,route,kind):
+        self.errors.inc((route,kind))
+
+    def recordCacheLookup(self,route,result):
+        self.cacheLookups.inc((route,result))
+
+    def recordTimeout(self,route,kind):
+        self.timeouts.inc((route,kind))
+
+    def snapshot(self):
+        """Get a copy of all the values, suitable for marshalling."""
+        return dict([(f.name,f.snapshot()) for f in self.families])
+
+    def merge(self,snapshot,gauges=True):
+        """Add in the values from a snapshot of another Metrics object.
+
+        If 'gauges' is false, gauges in the snapshot are ignored; this is
+        useful when the values were taken from a process that has exited.
+        """
+        for family in self.families:
+          values = snapshot.get(family.name)
+          if values and (gauges or family.type != "gauge"):
+            family.merge(values)
+
+    def render(self):
+        """Render all metrics in the Prometheus text format."""
+        lines = []
+        for family in self.families:
+          lines.append("# HELP %s %s\n" % (family.name,family.help))
+          lines.append("# TYPE %s %s\n" % (family.name,family.type))
+          for (suffix,pairs,value) in family.samples():
+            if pairs:
+              labels = ",".join(['%s="%s"' % (n,_escape(v)) for (n,v) in pairs])
+              lines.append("%s%s{%s} %s\n" % (family.name,suffix,labels,_formatValue(value)))
+            else:
+              lines.append("%s%s %s\n" % (family.name,suffix,_formatValue(value)))
+        return "".join(lines)
+
+
+def routeLabel(mapping):
+    """Get the route label for a (host,port,rewriter) mapping."""
+    if mapping is None:
+      return "none"
+    (host,port,rewriter) = mapping
+    local = getattr(rewriter,"local",None)
+    if local is not None:
+      return local.url
+    if port is None:
+      return str(host)
+    return "%s:%s" % (host,port)
+
+
+def _escape(value):
+    value = str(value)
+    return value.replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
+
+
+def _formatValue(value):
+    if isinstance(value,float):
+      return repr(value)
+    return str(value)
@@ -0,0 +1,263 @@
+"""
+
+  proxylet.pool:  keep-alive connection pooling for upstream servers
+
+Opening a new connection to the backend for every client connection means
+a TCP handshake for almost every request.  Instead, connections to upstream
+servers are checked out of a ConnectionPool for the duration of a single
+request/response pair, and checked back in once the response has been
+read in full.  If the response framing allows, the connection is then kept
+open and handed out again for a later request.
+
+By default all Dispatchers share the process-wide pool 'defaultPool'.
+
+"""
+
+import time
+import errno
+import select
+import socket
+from streams import StreamWrapper
+from engines import getEngine
+from timeouts import Timeout, callWithTimeout
+
+
+#  Maximum size of request data kept for resending on a fresh connection.
+REPLAY_LIMIT = 64 * 1024
+
+#  Methods whose requests can safely be sent to the server a second time.
+IDEMPOTENT_METHODS = frozenset(["GET","HEAD","OPTIONS","PUT","DELETE"])
+
+
+class UpstreamLost(socket.error):
+    """Raised when a reused connection is found dead before any response.
+
+    The server may have acted on the request before closing the connection,
+    so this is raised in place of resending a request that isn't safe to
+    repeat.  Nothing of the response has been read at this point.
+    """
+
+
+class PooledConnection(StreamWrapper):
+    """A connection to an upstream server, checked out from a pool.
+
+    If the underlying socket was reused from the pool, the server may have
+    closed it while it sat idle.  For requests that are safe to repeat (see
+    IDEMPOTENT_METHODS), call allowReplay() before writing the request, and
+    up to REPLAY_LIMIT bytes of the data written are remembered until the
+    first response data arrives.  Should the connection turn out to be dead
+    before then, it is transparently replaced with a fresh one and the
+    request is sent again.  The replacement is always done by the reader,
+    so that the request is never interleaved with a concurrent write; while
+    it is in progress, writes are recorded and sent along with the rest of
+    the request.  If the request can't be resent, UpstreamLost is raised
+    instead.
+
+    Call release() once the response has been read, indicating whether
+    the connection is in a fit state to be reused.  If 'onrelease' is set,
+    it is then called with the connection and the response status code.
+    """
+
+    onrelease = None
+
+    def __init__(self,pool,address,sock=None,timeout=None):
+        self.pool = pool
+        self.address = address
+        self.timeout = timeout
+        self.reused = (sock is not None)
+        if sock is None:
+          sock = callWithTimeout(timeout,"connect",getEngine().connect,address)
+        StreamWrapper.__init__(self,sock)
+        self.sock = sock
+        self.released = False
+        self._failed = False
+        self._replaySize = 0
+        self._replay = None
+        # True until the first response data arrives on a reused socket
+        self._awaiting = self.reused
+
+    def allowReplay(self):
+        """Allow the request to be resent if the connection is found dead."""
+        if self._awaiting:
+          self._replay = []
+
+    def readline(self,size=None):
+        return self._read("readline",size)
+
+    def read(self,size=None):
+        return self._read("read",size)
+
+    def _read(self,method,size):
+        try:
+          data = getattr(self.stream,method)(size)
+        except Timeout:
+          # The server is slow rather than gone, so don't resend
+          raise
+        except socket.error:
+          if not self._awaiting:
+            raise
+          data = ""
+        if data == "" and self._awaiting:
+          if self._replay is None:
+            self._awaiting = False
+            raise UpstreamLost(errno.ECONNRESET,"upstream connection lost")
+          self._resend()
+          data = getattr(self.stream,method)(size)
+        self._awaiting = False
+        self._replay = None
+        return data
+
+    def write(self,data):
+        if not self._awaiting:
+          return self.stream.write(data)
+        if self._replay is not None:
+          self._replay.append(data)
+          self._replaySize += len(data)
+          if self._replaySize > REPLAY_LIMIT:
+            # Too big to resend, so a dead connection can't be recovered
+            self._replay = None
+        # If the connection is dead, the reader finds out and reports it
+        if not self._failed:
+          try:
+            self.stream.write(data)
+          except socket.error:
+            self._failed = True
+
+    def _resend(self):
+        """Replace a dead connection and resend the request data."""
+        self._failed = True
+        self.reused = False
+        # Further data may be recorded while we're reconnecting or writing,
+        # and if it grows too big the replay is abandoned.
+        replay = self._replay
+        self.stream.close()
+        self.sock = callWithTimeout(self.timeout,"connect",
+                                    getEngine().connect,self.address)
+        StreamWrapper.__init__(self,self.sock)
+        i = 0
+        while True:
+          if self._replay is not replay:
+            self._awaiting = False
+            raise UpstreamLost(errno.ECONNRESET,"upstream connection lost")
+          if i >= len(replay):
+            break
+          self.stream.write(replay[i])
+          i += 1
+        self._failed = False
+
+    def release(self,reusable=True,status=None):
+        """Return the connection to the pool."""
+        if not self.released:
+          self.released = True
+          self.pool.checkin(self,reusable)
+          if self.onrelease is not None:
+            self.onrelease(self,status)
+
+
+def _isStale(sock):
+    """Check whether an idle socket has become unusable.
+
+    An idle connection should never be readable; if it is, then the
+    server has either closed it or sent some unexpected data.
+    """
+    if getattr(sock,"recvbuffer",""):
+      return True
+    try:
+      (r,_,_) = select.select([sock.fileno()],[],[],0)
+    except (select.error,socket.error,ValueError):
+      return True
+    return bool(r)
+
+
+class ConnectionPool(object):
+    """Pool of keep-alive connections to upstream servers.
+
+    Connections are keyed by their (host,port) address.  The following
+    limits apply separately to each address:
+
+        * max_idle:      the number of idle connections kept for reuse
+        * max_per_host:  the number of connections open at once, or None
+                         for no limit; further checkouts will wait until
+                         a connection is released
+        * idle_timeout:  seconds after which an idle connection is closed
+    """
+
+    def __init__(self,max_idle=10,max_per_host=None,idle_timeout=60):
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        # Maps addresses to a list of (socket,timestamp) pairs,
+        # with the most recently used at the end.
+        self._idle = {}
+        self._limits = {}
+
+    def checkout(self,address,timeout=None):
+        """Get a PooledConnection to the given (host,port) address.
+
+        If a new connection has to be made, Timeout is raised should it
+        take longer than 'timeout' seconds.
+        """
+        limit = self._getLimit(address)
+        if limit is not None:
+          limit.acquire()
+        try:
+          sock = self._getIdle(address)
+          return PooledConnection(self,address,sock,timeout)
+        except:
+          if limit is not None:
+            limit.release()
+          raise
+
+    def checkin(self,conn,reusable=True):
+        """Return a connection to the pool, closing it if not reusable."""
+        address = conn.address
+        idle = self._expire(address)
+        if reusable and len(idle) < self.max_idle:
+          idle.append((conn.sock,time.time()))
+        else:
+          conn.close()
+        limit = self._getLimit(address)
+        if limit is not None:
+          limit.release()
+
+    def close(self):
+        """Close all idle connections."""
+        for idle in self._idle.itervalues():
+          for (sock,_) in idle:
+            sock.close()
+        self._idle.clear()
+
+    def _getLimit(self,address):
+        if self.max_per_host is None:
+          return None
+        try:
+          return self._limits[address]
+        except KeyError:
+          limit = getEngine().semaphore(self.max_per_host)
+          self._limits[address] = limit
+          return limit
+
+    def _getIdle(self,address):
+        idle = self._expire(address)
+        while idle:
+          (sock,_) = idle.pop()
+          if not _isStale(sock):
+            return sock
+          sock.close()
+        return None
+
+    def _expire(self,address):
+        """Close expired idle connections, returning those that remain."""
+        try:
+          idle = self._idle[address]
+        except KeyError:
+          idle = self._idle[address] = []
+          return idle
+        cutoff = time.time() - self.idle_timeout
+        while idle and idle[0][1] < cutoff:
+          (sock,_) = idle.pop(0)
+          sock.close()
+        return idle
+
+
+defaultPool = ConnectionPool()
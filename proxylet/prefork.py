@@ -0,0 +1,285 @@
+"""
+
+  proxylet.prefork:  run proxylet in several worker processes
+
+A proxylet.Server runs in a single process, so it can only use a single
+CPU core.  The PreforkServer class forks a number of worker processes that
+each run their own Server on the same address, under a supervising parent
+process that restarts any worker that dies:
+
+    PreforkServer(host,port,mapper,workers=4).serve()
+
+Where the platform supports SO_REUSEPORT, each worker binds a listening
+socket of its own and the kernel spreads new connections between them.
+Otherwise the parent binds a single socket which all workers accept from.
+
+The parent process does nothing but supervise, so it must not have used
+eventlet before calling serve(); each worker starts its own eventlet hub.
+
+If metrics are enabled, each worker periodically saves a snapshot of its
+metrics to a private directory, and requests for the metrics path are
+answered with the totals over all workers.  Counts from workers that have
+exited are kept, so the totals don't go backwards when one is restarted.
+
+"""
+
+import os
+import time
+import errno
+import signal
+import socket
+import marshal
+import shutil
+import tempfile
+import traceback
+
+from metrics import Metrics
+from engines import getEngine
+
+
+#  Workers that die within this many seconds are restarted after a delay.
+RESTART_DELAY = 1.0
+
+
+class WorkerMetrics(Metrics):
+    """Metrics for a single worker process, reporting totals for all workers.
+
+    The worker's own metrics are saved every 'interval' seconds to the
+    directory 'statedir', in a file named by the worker's index.  When
+    rendered, the live values are combined with those saved by the other
+    workers, so the other workers' values may be slightly out of date.
+    """
+
+    def __init__(self,statedir,index,interval=1.0,**kwds):
+        Metrics.__init__(self,**kwds)
+        self.statedir = statedir
+        self.index = index
+        self.interval = interval
+        self._buckets = self.duration.buckets
+
+    def start(self):
+        """Start saving snapshots in the background."""
+        engine = getEngine()
+        def saveLoop():
+            while True:
+              engine.sleep(self.interval)
+              self.save()
+        engine.spawn(saveLoop)
+
+    def save(self):
+        _saveSnapshot(_workerFile(self.statedir,self.index),self.snapshot())
+
+    def render(self):
+        total = Metrics(self.path,self._buckets)
+        total.merge(self.snapshot())
+        mine = os.path.basename(_workerFile(self.statedir,self.index))
+        for nm in os.listdir(self.statedir):
+          if nm != mine and not nm.endswith(".tmp"):
+            snapshot = _loadSnapshot(os.path.join(self.statedir,nm))
+            if snapshot is not None:
+              total.merge(snapshot)
+        return total.render()
+
+
+class PreforkServer(object):
+    """Supervisor for a set of proxylet.Server worker processes.
+
+    'workers' gives the number of worker processes, by default one per
+    CPU.  If 'reuseport' is None, SO_REUSEPORT is used if available; set
+    it to False to always share a single inherited listening socket.  If
+    'metrics' is true, each worker records metrics and reports the totals
+    as described above.  Any remaining keyword arguments are passed on to
+    the Server in each worker.
+
+    Call "serve" to start the workers and supervise them until "halt" is
+    called, or the parent receives SIGTERM or SIGINT.  The workers are then
+    sent SIGTERM, on which they drain their connections for up to
+    'drain_timeout' seconds before exiting.  If 'loader' is given, SIGHUP
+    makes each worker replace its mapper with the result of loader().
+    """
+
+    def __init__(self,host,port,mapper,workers=None,reuseport=None,
+                      metrics=False,backlog=128,drain_timeout=30,
+                      loader=None,**kwds):
+        self.host = host
+        self.port = int(port)
+        self.mapper = mapper
+        if workers is None:
+          workers = _cpuCount()
+        self.workers = workers
+        if reuseport is None:
+          reuseport = hasattr(socket,"SO_REUSEPORT")
+        self.reuseport = reuseport
+        self.metrics = metrics
+        self.backlog = backlog
+        self.drain_timeout = drain_timeout
+        self.loader = loader
+        self.serverArgs = kwds
+        self._running = False
+        self._children = {}
+
+    def serve(self):
+        self._running = True
+        listener = None
+        if not self.reuseport:
+          listener = _listen(self.host,self.port,False,self.backlog)
+        statedir = None
+        retired = None
+        if self.metrics:
+          statedir = tempfile.mkdtemp(prefix="proxylet-metrics-")
+          retired = Metrics()
+        oldHandlers = {}
+        for signum in (signal.SIGTERM,signal.SIGINT):
+          oldHandlers[signum] = signal.signal(signum,self._onSignal)
+        if self.loader is not None:
+          oldHandlers[signal.SIGHUP] = signal.signal(signal.SIGHUP,self._onReload)
+        try:
+          for index in xrange(self.workers):
+            self._spawn(index,listener,statedir)
+          while self._running:
+            try:
+              (pid,_) = os.wait()
+            except OSError, e:
+              if e.errno == errno.EINTR:
+                continue
+              raise
+            try:
+              (index,started) = self._children.pop(pid)
+            except KeyError:
+              continue
+            if statedir is not None:
+              self._retire(statedir,index,retired)
+            if self._running:
+              if time.time() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+              self._spawn(index,listener,statedir)
+        finally:
+          self._stopWorkers()
+          for (signum,handler) in oldHandlers.iteritems():
+            signal.signal(signum,handler)
+          if listener is not None:
+            listener.close()
+          if statedir is not None:
+            shutil.rmtree(statedir,True)
+
+    def halt(self):
+        self._running = False
+        self._signalWorkers(signal.SIGTERM)
+
+    def _onSignal(self,signum,frame):
+        self.halt()
+
+    def _onReload(self,signum,frame):
+        self._signalWorkers(signal.SIGHUP)
+
+    def _signalWorkers(self,signum):
+        for pid in self._children:
+          try:
+            os.kill(pid,signum)
+          except OSError:
+            pass
+
+    def _stopWorkers(self):
+        self._signalWorkers(signal.SIGTERM)
+        while self._children:
+          try:
+            (pid,_) = os.wait()
+          except OSError, e:
+            if e.errno == errno.EINTR:
+              continue
+            break
+          self._children.pop(pid,None)
+        self._children.clear()
+
+    def _spawn(self,index,listener,statedir):
+        pid = os.fork()
+        if pid == 0:
+          code = 1
+          try:
+            try:
+              self._runWorker(index,listener,statedir)
+              code = 0
+            except:
+              traceback.print_exc()
+          finally:
+            os._exit(code)
+        self._children[pid] = (index,time.time())
+
+    def _runWorker(self,index,listener,statedir):
+        from proxylet import Server
+        for signum in (signal.SIGINT,signal.SIGHUP):
+          signal.signal(signum,signal.SIG_DFL)
+        if listener is None:
+          listener = _listen(self.host,self.port,True,self.backlog)
+        metrics = None
+        if statedir is not None:
+          metrics = WorkerMetrics(statedir,index)
+        server = Server(self.host,self.port,self.mapper,metrics=metrics,
+                        **self.serverArgs)
+        if metrics is not None:
+          metrics.start()
+        server.drainOnSignal(self.drain_timeout)
+        if self.loader is not None:
+          server.reloadOnSignal(self.loader)
+        try:
+          server.serve(server.engine.wrapListener(listener))
+        finally:
+          if metrics is not None:
+            metrics.save()
+
+    def _retire(self,statedir,index,retired):
+        """Keep the counts from a worker that has exited."""
+        fnm = _workerFile(statedir,index)
+        snapshot = _loadSnapshot(fnm)
+        if snapshot is not None:
+          retired.merge(snapshot,gauges=False)
+          _saveSnapshot(os.path.join(statedir,"retired"),retired.snapshot())
+          os.unlink(fnm)
+
+
+def _listen(host,port,reuseport,backlog):
+    sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    if reuseport:
+      sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEPORT,1)
+    sock.bind((host,port))
+    sock.listen(backlog)
+    return sock
+
+
+def _cpuCount():
+    try:
+      import multiprocessing
+      return multiprocessing.cpu_count()
+    except (ImportError,NotImplementedError):
+      return 1
+
+
+def _workerFile(statedir,index):
+    return os.path.join(statedir,"worker-%d" % (index,))
+
+
+def _saveSnapshot(fnm,snapshot):
+    # Write to a temporary file and rename it into place, so that
+    # readers never see a partially-written snapshot.
+    tmpnm = fnm + ".tmp"
+    f = open(tmpnm,"wb")
+    try:
+      marshal.dump(snapshot,f)
+    finally:
+      f.close()
+    os.rename(tmpnm,fnm)
+
+
+def _loadSnapshot(fnm):
+    try:
+      f = open(fnm,"rb")
+    except IOError:
+      return None
+    try:
+      try:
+        return marshal.load(f)
+      except (EOFError,ValueError,TypeError):
+        return None
+    finally:
+      f.close()
@@ -28,12 +28,9 @@ to /svn/ to a backend SVN server:
 from paste import httpheaders as hdr
 from urlparse import *
 import re
-try:
-  from cStringIO import StringIO
-except ImportError:
-  from StringIO import StringIO
 
-from streams import HTTPRewriter, XMLRewriter
+from streams import HTTPRewriter, XMLRewriter, RegexRewriter
+from lru import LRUCache
 
 ## Make a "Destination' header handler, since we
 ## need to rewrite it in WebDAV requests.
@@ -56,15 +53,67 @@ class UrlInfo(object):
         self.scheme = info.scheme
 
 
+class _RewritePlan(object):
+    """Precompiled rewriting of URLs from one root to another.
+
+    This gives the same results as Relocator._rewrite, but the full-URL
+    and path prefixes are combined into a single regular expression,
+    and results are memoized in an LRU cache of 'cache_size' entries.
+    """
+
+    __slots__ = ("_match","_urlOut","_pathOut","_hostIn","_hostOut","_cache")
+
+    def __init__(self,inU,outU,cache_size):
+        # Prefixes must end at a path boundary to match.  If the full
+        # url fails this check, the regex falls back to the path.
+        regex = r"(?:(%s)|%s)(?=/|\Z)" % (re.escape(inU.url),re.escape(inU.path))
+        self._match = re.compile(regex).match
+        self._urlOut = outU.url
+        self._pathOut = outU.path
+        self._hostIn = inU.host
+        self._hostOut = outU.host
+        self._cache = LRUCache(cache_size)
+
+    def __call__(self,url):
+        out = self._cache.get(url)
+        if out is None:
+          out = self._rewrite(url)
+          self._cache.put(url,out)
+        return out
+
+    def _rewrite(self,url):
+        m = self._match(url)
+        if m is not None:
+          if m.group(1) is not None:
+            return self._urlOut + url[m.end():]
+          return self._pathOut + url[m.end():]
+        if url == self._hostIn:
+          return self._hostOut
+        return url
+
+
 class Relocator(object):
     """Base class for request/response relocator objects.
     This class takes care of basic header rewriting for relocation.
     Subclasses should implement the inner classes RewriteRequest
     and RewriteResponse as subclasses of HTTPRewriter to provide additional
     functionality.
+
+    URL rewriting is precompiled when the relocator is created, and the
+    most recent 'rewrite_cache_size' results in each direction are cached.
+
+    Compressed bodies are decompressed for rewriting.  If 'compress' is
+    true, rewritten response bodies are compressed again for clients that
+    accept it; see HTTPRewriter for details.
+
+    If 'upstream' is given, it is an UpstreamGroup to send requests to in
+    place of the host and port of the remote root.
     """
 
-    def __init__(self,localRoot,remoteRoot):
+    rewrite_cache_size = 1024
+    compress = False
+
+    def __init__(self,localRoot,remoteRoot,upstream=None):
         self.local = UrlInfo(localRoot)
         self.remote = UrlInfo(remoteRoot)
         port = self.remote.port
@@ -73,13 +122,20 @@ class Relocator(object):
             port = "80"
           if self.remote.scheme.lower() == "https":
             port = "443"
-        self.mapping = (self.remote.host,port,self)
+        if upstream is not None:
+          self.mapping = (upstream,None,self)
+        else:
+          self.mapping = (self.remote.host,port,self)
+        self._rwRemote = _RewritePlan(self.remote,self.local,
+                                      self.rewrite_cache_size)
+        self._rwLocal = _RewritePlan(self.local,self.remote,
+                                     self.rewrite_cache_size)
 
     def rewriteRemote(self,url):
-        return self._rewrite(url,self.remote,self.local)
+        return self._rwRemote(url)
 
     def rewriteLocal(self,url):
-        return self._rewrite(url,self.local,self.remote)
+        return self._rwLocal(url)
 
     def matchesLocal(self,url):
         return self._matches(url,self.local)
@@ -137,6 +193,7 @@ class Relocator(object):
             HTTPRewriter.__init__(self,resp)
             self.parent = parent
             self.request = req
+            self.compress = parent.compress
 
         def rwHeaders(self,headers):
             loc = hdr.LOCATION(headers)
@@ -145,8 +202,8 @@ class Relocator(object):
             # TODO: rewriting of cookie data
 
 
-def _checkContentType(headers,ctype):
-    ct = hdr.CONTENT_TYPE(headers)
+def _checkContentType(fields,ctype):
+    ct = fields.get("Content-Type")
     if ct and ';' in ct:
       ct = ct.split(';',1)[0]
     return (ct == ctype)
@@ -166,7 +223,7 @@ class DAVRelocator(Relocator):
         def rwBody(self,bodyIn):
             if self.stream.reqMethod.upper() not in self.parent._filter_methods:
               return bodyIn
-            if hdr.CONTENT_LENGTH(self.stream.headers) in (None,"","0"):
+            if self.stream.fields.get("Content-Length") in (None,"","0"):
               return bodyIn
             bodyOut = XMLRewriter(bodyIn)
             bodyOut.rewrite = self.parent.rewriteLocal
@@ -177,7 +234,7 @@ class DAVRelocator(Relocator):
         def rwBody(self,bodyIn):
            if self.request.reqMethod.upper() not in self.parent._filter_methods:
              return bodyIn
-           if not _checkContentType(self.stream.headers,"text/xml"):
+           if not _checkContentType(self.stream.fields,"text/xml"):
              return bodyIn 
            bodyOut = XMLRewriter(bodyIn)
            bodyOut.rewrite = self.parent.rewriteRemote
@@ -199,7 +256,7 @@ class SVNRelocator(Relocator):
         def rwBody(self,bodyIn):
             if self.stream.reqMethod.upper() not in self.parent._filter_methods:
               return bodyIn
-            if hdr.CONTENT_LENGTH(self.stream.headers) in (None,"","0"):
+            if self.stream.fields.get("Content-Length") in (None,"","0"):
               return bodyIn
             bodyOut = XMLRewriter(bodyIn)
             bodyOut.rewrite = self.parent.rewriteLocal
@@ -211,7 +268,7 @@ class SVNRelocator(Relocator):
         def rwBody(self,bodyIn):
            if self.request.reqMethod.upper() not in self.parent._filter_methods:
              return bodyIn
-           if not _checkContentType(self.stream.headers,"text/xml"):
+           if not _checkContentType(self.stream.fields,"text/xml"):
              return bodyIn 
            bodyOut = XMLRewriter(bodyIn)
            bodyOut.rewrite = self.parent.rewriteRemote
@@ -227,19 +284,26 @@ class DrupalRelocator(Relocator):
     that were written to belong under a different path, simply to
     work around broken apps that insist on generating absolute
     paths.
+
+    The page is rewritten as it streams through, so a <form> tag longer
+    than 'form_window' bytes may escape rewriting if it happens to span
+    the boundary between two chunks of data.
     """
 
+    form_window = 4096
+
+    def __init__(self,localRoot,remoteRoot,upstream=None):
+        Relocator.__init__(self,localRoot,remoteRoot,upstream)
+        self._formAction = re.compile(r"""<form action="%s([^"]*)"([^>]*)>""" % (re.escape(self.remote.path),))
+        self._formActionRepl = r"""<form action="%s\1"\2>""" % (self.local.path,)
+
     class RewriteResponse(Relocator.RewriteResponse):
         def rwBody(self,bodyIn):
-          if not _checkContentType(self.stream.headers,"text/html"):
+          if not _checkContentType(self.stream.fields,"text/html"):
             return bodyIn
-          data = []
-          for ln in bodyIn:
-            data.append(ln)
-          data = "".join(data)
-          repl = re.compile(r"""<form action="%s([^"]*)"([^>]*)>""" % (self.parent.remote.path,))
-          data = repl.sub(r"""<form action="%s\1"\2>""" % (self.parent.local.path,),data)
-          return StringIO(data)
+          p = self.parent
+          return RegexRewriter(bodyIn,p._formAction,p._formActionRepl,
+                               p.form_window)
 
 
 
@@ -0,0 +1,181 @@
+"""
+
+  proxylet.router:  efficient request routing for proxylet
+
+A mapper function that checks each Relocator in turn must do string work
+for every route on every request.  The Router class instead compiles its
+routes into a trie keyed by host and path segment, so finding the right
+mapping takes time proportional to the depth of the requested path rather
+than the number of routes.  A Router can be used directly as the mapper:
+
+    router = Router()
+    router.addRelocator(SVNRelocator("http://www.example.com/svn",
+                                     "http://svn.example.com/"))
+    router.addRoute("/files","files.example.com",80)
+    proxylet.serve(host,port,router)
+
+Route prefixes match whole path segments, so the prefix "/svn" matches
+"/svn" and "/svn/trunk" but not "/svnroot".  Where several prefixes match,
+the longest one wins.  Routes whose prefix is a full URL only match
+requests for that host; they are tried before routes given as a bare path.
+
+"""
+
+from lru import LRUCache
+
+
+class _TrieNode(object):
+    """Node in the path-segment trie, holding the mapping for its prefix."""
+
+    __slots__ = ("mapping","children")
+
+    def __init__(self):
+        self.mapping = None
+        self.children = {}
+
+
+class Router(object):
+    """Mapper that routes requests by host and path prefix.
+
+    If 'cache_size' is nonzero, the most recent routing decisions are
+    remembered in an LRU cache of that many entries, keyed by host and
+    path.  This is worthwhile when a small set of URIs is requested
+    over and over again.
+    """
+
+    def __init__(self,cache_size=0):
+        # Maps lowercased host names to the root of their trie.
+        # Routes that apply to any host are stored under None.
+        self._roots = {}
+        if cache_size:
+          self._cache = LRUCache(cache_size)
+        else:
+          self._cache = None
+
+    def addRelocator(self,relocator,anyHost=False):
+        """Route requests under a Relocator's local root to it.
+
+        The route only applies to requests for the host named in the local
+        root URL, unless 'anyHost' is true; then the path alone is matched,
+        as with Relocator.matchesLocal().
+        """
+        host = relocator.local.host
+        if anyHost:
+          host = None
+        self._add(host,relocator.local.path,relocator.mapping)
+
+    def addRoute(self,prefix,host,port,rewriter=None):
+        """Route requests under the given prefix to host and port.
+
+        The prefix may be a bare path, matching requests for any host,
+        or a full URL matching only requests for that particular host.
+        The host may also be an UpstreamGroup, with a port of None.
+        """
+        (vhost,path) = _splitURL(prefix)
+        if port is not None:
+          port = int(port)
+        self._add(vhost,path,(host,port,rewriter))
+
+    def __call__(self,req):
+        (host,path) = _splitURL(req.reqURI)
+        if host is None:
+          host = _getHost(req)
+        cache = self._cache
+        if cache is None:
+          return self.lookup(host,path)
+        key = (host,path)
+        mapping = cache.get(key,_MISSING)
+        if mapping is _MISSING:
+          mapping = self.lookup(host,path)
+          cache.put(key,mapping)
+        return mapping
+
+    def lookup(self,host,path):
+        """Find the mapping for the given host and path, or None."""
+        if host is not None:
+          root = self._roots.get(host)
+          if root is not None:
+            mapping = _walk(root,path)
+            if mapping is not None:
+              return mapping
+        root = self._roots.get(None)
+        if root is not None:
+          return _walk(root,path)
+        return None
+
+    def _add(self,host,path,mapping):
+        if host is not None:
+          host = host.lower()
+        try:
+          node = self._roots[host]
+        except KeyError:
+          node = self._roots[host] = _TrieNode()
+        for seg in _segments(path):
+          try:
+            node = node.children[seg]
+          except KeyError:
+            child = _TrieNode()
+            node.children[seg] = child
+            node = child
+        node.mapping = mapping
+        if self._cache is not None:
+          self._cache.clear()
+
+
+_MISSING = object()
+
+
+def _segments(path):
+    """Split a path into its non-empty segments."""
+    return [seg for seg in path.split("/") if seg]
+
+
+def _walk(node,path):
+    """Find the mapping for the longest prefix of path in the trie."""
+    best = node.mapping
+    for seg in path.split("/"):
+      if not seg:
+        continue
+      node = node.children.get(seg)
+      if node is None:
+        break
+      if node.mapping is not None:
+        best = node.mapping
+    return best
+
+
+def _splitURL(url):
+    """Split a URL into (host,path), with host None for a bare path.
+
+    Any port number, query string or fragment is discarded.
+    """
+    host = None
+    if "://" in url:
+      rest = url.split("://",1)[1]
+      idx = rest.find("/")
+      if idx < 0:
+        (host,url) = (rest,"/")
+      else:
+        (host,url) = (rest[:idx],rest[idx:])
+      host = _stripPort(host)
+    for c in "?#":
+      idx = url.find(c)
+      if idx >= 0:
+        url = url[:idx]
+    return (host,url or "/")
+
+
+def _getHost(req):
+    host = req.fields.get("Host")
+    if not host:
+      return None
+    return _stripPort(host)
+
+
+def _stripPort(host):
+    if host.startswith("["):
+      # IPv6 literal address
+      idx = host.find("]")
+      if idx >= 0:
+        return host[:idx+1].lower()
+    return host.split(":",1)[0].lower()
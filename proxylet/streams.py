@@ -3,35 +3,103 @@
   proxylet.streams:  various stream wrappers for proxylet
 
 We utilize a very small portion of the filelike API  to implement streams,
-just readline() and the iterator built on it, write() and close().
-
-Some useful classes include HTTPRequest, HTTPResponse, HTTPRewriter and
-XMLRewriter.
+just readline() and the iterator built on it, read(), write() and close().
+
+Unlike file.read(), the read() method of a stream returns as soon as some
+data is available, giving at most the requested number of bytes and ""
+only at end-of-stream.  Messages are read in blocks using read(), and the
+HeadParser and ChunkParser classes pick the message head and any chunk
+framing out of each block as it arrives.  Data read past the end of a
+message is handed back with unread(), to be read again as the start of
+the next one.  Message bodies are relayed in blocks of up to BLOCK_SIZE
+bytes, so binary data is never split up at arbitrary newlines.
+
+Streams that transform their input are written as generators, and passing
+data through a pipeline of them costs a single generator resumption for
+each stage, since iterating over a GeneratorStream gives the generator
+itself.  The simpler wrappers use __slots__, as several are created for
+every message.
+
+Some useful classes include HTTPRequest, HTTPResponse, HTTPRewriter,
+RegexRewriter and XMLRewriter.
 
 """
 
-from paste import httpheaders as hdr
+import re
+import zlib
+from itertools import chain
 from xml.parsers import expat
 
 from eventlet.greenio import GreenFile
 
+from buffers import SpoolBuffer, SPOOL_THRESHOLD
+
+
+#  Default size of the blocks in which message bodies are relayed.
+BLOCK_SIZE = 64 * 1024
+
+#  Size of the blocks in which message heads are read.
+HEAD_BLOCK_SIZE = 8 * 1024
+
+#  Default limits on the size of a message head and its number of headers.
+MAX_HEADER_SIZE = 64 * 1024
+MAX_HEADERS = 100
+
+
+class SocketFile(GreenFile):
+    """GreenFile whose read() method returns any data that is available.
+
+    GreenFile.read(size) blocks until the full 'size' bytes have been
+    received, which would stall bodies that are produced slowly.  This
+    version behaves like socket.recv() instead.
+    """
+
+    def read(self,size=None):
+        if size is None:
+          return GreenFile.read(self)
+        return self.sock.recv(size)
+
+    def readinto(self,buf):
+        # Data already buffered by readline() must be returned first
+        sock = self.sock
+        data = sock.recvbuffer
+        if data:
+          n = min(len(buf),len(data))
+          buf[:n] = data[:n]
+          sock.recvbuffer = data[n:]
+          return n
+        return sock.recv_into(buf)
+
+    def unread(self,data):
+        sock = self.sock
+        sock.recvbuffer = data + sock.recvbuffer
+
 
 class StreamWrapper(object):
     """Base class for wrapping of streams."""
 
+    __slots__ = ("stream",)
+
     def __init__(self,stream):
         if not hasattr(stream,"readline") and hasattr(stream,"recv"):
-            stream = GreenFile(stream)
+            stream = SocketFile(stream)
         self.stream = stream
 
     def readline(self,size=None):
         return self.stream.readline(size)
 
+    def read(self,size=None):
+        return self.stream.read(size)
+
+    def readinto(self,buf):
+        return self.stream.readinto(buf)
+
+    def unread(self,data):
+        """Push data back onto the stream, to be read again next."""
+        self.stream.unread(data)
+
     def __iter__(self):
-        ln = self.readline()
-        while ln != "":
-          yield ln
-          ln = self.readline()
+        return iter(self.readline,"")
 
     def write(self,data):
         return self.stream.write(data)
@@ -40,20 +108,71 @@ class StreamWrapper(object):
         self.stream.close()
 
 
+class GeneratorStream(StreamWrapper):
+    """Stream whose output is produced by the generator _generateLines().
+
+    Subclasses implement _generateLines(), which is called when the stream
+    is created but, being a generator, doesn't run until the first read.
+    Iterating over the stream gives the generator directly, rather than
+    going through readline() for each item.
+
+    Each call to readline() gives the next item, or at most 'size' bytes
+    of it; the rest is kept for the following call.
+    """
+
+    __slots__ = ("_lines","_rest")
+
+    def __init__(self,stream):
+        StreamWrapper.__init__(self,stream)
+        self._lines = self._generateLines()
+        self._rest = ""
+
+    def readline(self,size=None):
+        ln = self._rest
+        if ln:
+          self._rest = ""
+        else:
+          ln = next(self._lines,"")
+        if size is not None and 0 <= size < len(ln):
+          self._rest = ln[size:]
+          ln = ln[:size]
+        return ln
+
+    def __iter__(self):
+        if self._rest:
+          (rest,self._rest) = (self._rest,"")
+          return chain((rest,),self._lines)
+        return iter(self._lines)
+
+
 class Nullify(StreamWrapper):
     """/dev/null equivalent for streams."""
 
+    __slots__ = ()
+
     def readline(self,size=None):
-        for ln in self.stream:
+        while self.stream.read(BLOCK_SIZE) != "":
           pass
         return ""
 
+    def read(self,size=None):
+        return self.readline()
+
     def write(self,data):
         return
 
 
 class StringStream(StreamWrapper):
-    """Stream giving contents of a string."""
+    """Stream giving contents of a string.
+
+    The string is never copied; reads slice it from the current position.
+    """
+
+    __slots__ = ("_pos",)
+
+    def __init__(self,data):
+        StreamWrapper.__init__(self,data)
+        self._pos = 0
 
     def write(self,data):
         raise RuntimeError("StringStream cannot be written")
@@ -62,21 +181,35 @@ class StringStream(StreamWrapper):
         raise RuntimeError("StringStream cannot be closed")
 
     def readline(self,size=None):
-        idx = self.stream.find("\n")
-        if idx < 0:
-          idx = len(self.stream)
+        data = self.stream
+        pos = self._pos
+        end = data.find("\n",pos) + 1
+        if end == 0:
+          end = len(data)
+        if size is not None and end - pos > size:
+          end = pos + size
+        self._pos = end
+        return data[pos:end]
+
+    def read(self,size=None):
+        data = self.stream
+        pos = self._pos
+        if size is None:
+          end = len(data)
         else:
-          idx += 1
-        if size is not None and idx > size:
-          idx = size
-        out = self.stream[:idx]
-        self.stream = self.stream[idx:]
-        return out
+          end = min(pos + size,len(data))
+        self._pos = end
+        return data[pos:end]
+
+    def unread(self,data):
+        self._pos -= len(data)
 
 
 class CallOnClose(StreamWrapper):
     """Invoke a callback when reading from a stream has finished."""
 
+    __slots__ = ("onclose",)
+
     def __init__(self,stream,onclose):
         StreamWrapper.__init__(self,stream)
         self.onclose = onclose
@@ -87,10 +220,61 @@ class CallOnClose(StreamWrapper):
           self.onclose()
         return ln
 
+    def read(self,size=None):
+        data = self.stream.read(size)
+        if data == "":
+          self.onclose()
+        return data
+
+    def readinto(self,buf):
+        n = self.stream.readinto(buf)
+        if n == 0:
+          self.onclose()
+        return n
+
+
+class CountBytes(StreamWrapper):
+    """Count the bytes read from and written to a stream.
+
+    The totals are kept in the attributes 'bytesIn' and 'bytesOut'.
+    """
+
+    __slots__ = ("bytesIn","bytesOut")
+
+    def __init__(self,stream):
+        StreamWrapper.__init__(self,stream)
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def readline(self,size=None):
+        ln = self.stream.readline(size)
+        self.bytesIn += len(ln)
+        return ln
+
+    def read(self,size=None):
+        data = self.stream.read(size)
+        self.bytesIn += len(data)
+        return data
+
+    def readinto(self,buf):
+        n = self.stream.readinto(buf)
+        self.bytesIn += n
+        return n
+
+    def unread(self,data):
+        self.bytesIn -= len(data)
+        self.stream.unread(data)
+
+    def write(self,data):
+        self.bytesOut += len(data)
+        return self.stream.write(data)
+
 
 class ReadNBytes(StreamWrapper):
     """Read up to N bytes from the stream."""
 
+    __slots__ = ("nbytes",)
+
     def __init__(self,stream,nbytes):
         self.nbytes = nbytes
         StreamWrapper.__init__(self,stream)
@@ -104,68 +288,751 @@ class ReadNBytes(StreamWrapper):
         self.nbytes = self.nbytes - len(ln)
         return ln
 
+    def read(self,size=None):
+        if self.nbytes == 0:
+          return ""
+        if size is None or size > self.nbytes:
+          size = self.nbytes
+        data = self.stream.read(size)
+        self.nbytes = self.nbytes - len(data)
+        return data
+
+    def readinto(self,buf):
+        if self.nbytes == 0:
+          return 0
+        if len(buf) > self.nbytes:
+          buf = memoryview(buf)[:self.nbytes]
+        n = self.stream.readinto(buf)
+        self.nbytes = self.nbytes - n
+        return n
+
+    def unread(self,data):
+        self.nbytes = self.nbytes + len(data)
+        self.stream.unread(data)
+
+
+class ReadChunked(StreamWrapper):
+    """Read a message body sent with chunked transfer-encoding.
+
+    The chunk framing is stripped off, so reading from this stream gives
+    the decoded body data.  The underlying stream is read in blocks of up
+    to BLOCK_SIZE bytes, and a ChunkParser finds the chunk data in each.
+    Anything read past the terminating zero-length chunk is pushed back,
+    leaving the underlying stream positioned at the start of the next
+    message.  Any trailer headers are collected as (name,value) pairs in
+    the 'trailers' attribute.
+    """
+
+    __slots__ = ("trailers","_parser","_pending")
+
+    def __init__(self,stream):
+        StreamWrapper.__init__(self,stream)
+        self._parser = ChunkParser()
+        self.trailers = self._parser.trailers
+        # Decoded data not yet returned, last piece first
+        self._pending = []
+
+    def readline(self,size=None):
+        return self.read(size)
+
+    def read(self,size=None):
+        pending = self._pending
+        while not pending:
+          if self._parser.done:
+            return ""
+          data = self.stream.read(BLOCK_SIZE)
+          if data == "":
+            raise IOError("connection closed inside chunked body")
+          (pieces,used) = self._parser.feed(data)
+          if used < len(data):
+            self.stream.unread(data[used:])
+          for (start,end) in reversed(pieces):
+            if end - start == len(data):
+              pending.append(data)
+            else:
+              pending.append(data[start:end])
+        data = pending.pop()
+        if size is not None and len(data) > size:
+          pending.append(data[size:])
+          data = data[:size]
+        return data
+
+    def relay(self,dest,buf):
+        """Copy the body to 'dest' with its chunk framing intact.
+
+        The body is read into the writable buffer 'buf' and written out
+        from there as it is, the parser only being used to find its end.
+        """
+        stream = self.stream
+        parser = self._parser
+        view = memoryview(buf)
+        while not parser.done:
+          n = stream.readinto(view)
+          if n == 0:
+            raise IOError("connection closed inside chunked body")
+          (_,used) = parser.feed(buf,n)
+          dest.write(view[:used])
+          if used < n:
+            stream.unread(bytes(buf[used:n]))
+
+
+class WriteChunked(GeneratorStream):
+    """Apply chunked transfer-encoding to the data from a stream.
+
+    Each non-empty line read from the underlying stream is emitted as a
+    single chunk.  Once it is exhausted the terminating zero-length chunk
+    is emitted, along with any (name,value) pairs in the list 'trailers'.
+    Since this list is only examined at the end of the stream, it may be
+    filled in while the body is being read.
+    """
+
+    __slots__ = ("trailers",)
+
+    def __init__(self,stream,trailers=None):
+        GeneratorStream.__init__(self,stream)
+        if trailers is None:
+          trailers = []
+        self.trailers = trailers
+
+    def _generateLines(self):
+        for data in self.stream:
+          # A zero-length chunk would terminate the body prematurely
+          if data:
+            yield "%x\r\n%s\r\n" % (len(data),data)
+        lines = ["0\r\n"]
+        for (name,value) in self.trailers:
+          lines.append(name + ": " + value + "\r\n")
+        lines.append("\r\n")
+        yield "".join(lines)
+
+
+#  The zlib window sizes selecting each supported content-coding.
+_ZLIB_WBITS = {"gzip": 16 + zlib.MAX_WBITS, "x-gzip": 16 + zlib.MAX_WBITS,
+               "deflate": zlib.MAX_WBITS}
+
+
+class DecodeContent(GeneratorStream):
+    """Decode data compressed with the gzip or deflate content-coding.
+
+    The data is decompressed as it is read, and at most 'blocksize' bytes
+    are decompressed from each block at a time, so that a small block of
+    highly compressed data can't take up an unbounded amount of memory.
+    Some servers send "deflate" data without the zlib header; this is
+    detected and handled.  Corrupt data raises an IOError.
+    """
+
+    __slots__ = ("coding","blocksize")
+
+    def __init__(self,stream,coding,blocksize=BLOCK_SIZE):
+        GeneratorStream.__init__(self,stream)
+        self.coding = coding.lower()
+        self.blocksize = blocksize
+
+    def _generateLines(self):
+        wbits = _ZLIB_WBITS[self.coding]
+        decoder = zlib.decompressobj(wbits)
+        started = False
+        blocksize = self.blocksize
+        try:
+          for data in self.stream:
+            if not started and self.coding == "deflate":
+              started = True
+              try:
+                out = decoder.decompress(data,blocksize)
+              except zlib.error:
+                # Raw deflate data, without the zlib wrapper
+                decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                out = decoder.decompress(data,blocksize)
+            else:
+              out = decoder.decompress(data,blocksize)
+            while True:
+              if out:
+                yield out
+              if not decoder.unconsumed_tail:
+                break
+              out = decoder.decompress(decoder.unconsumed_tail,blocksize)
+          out = decoder.flush()
+          if out:
+            yield out
+        except zlib.error, e:
+          raise IOError("invalid %s data: %s" % (self.coding,e))
+
+
+class EncodeContent(GeneratorStream):
+    """Compress data with the gzip or deflate content-coding.
+
+    The output for each block read from the underlying stream is flushed
+    through immediately, so compression never holds back data that the
+    client could already be processing.
+    """
+
+    __slots__ = ("coding","level")
 
-class HTTPStream(StreamWrapper):
+    def __init__(self,stream,coding,level=6):
+        GeneratorStream.__init__(self,stream)
+        self.coding = coding.lower()
+        self.level = level
+
+    def _generateLines(self):
+        wbits = _ZLIB_WBITS[self.coding]
+        encoder = zlib.compressobj(self.level,zlib.DEFLATED,wbits)
+        for data in self.stream:
+          if data:
+            out = encoder.compress(data) + encoder.flush(zlib.Z_SYNC_FLUSH)
+            yield out
+        yield encoder.flush()
+
+
+def acceptedCoding(values):
+    """Choose the content-coding to use given Accept-Encoding elements.
+
+    Returns "gzip" or "deflate", preferring gzip at equal quality, or None
+    if the client doesn't accept either of them.
+    """
+    quality = {}
+    for elem in values:
+      params = elem.split(";")
+      coding = params[0].strip().lower()
+      q = 1.0
+      for param in params[1:]:
+        (name,_,value) = param.partition("=")
+        if name.strip().lower() == "q":
+          try:
+            q = float(value)
+          except ValueError:
+            q = 0.0
+      quality[coding] = q
+    best = None
+    bestQ = 0.0
+    for coding in ("gzip","deflate"):
+      q = quality.get(coding)
+      if q is None:
+        q = quality.get("*",0.0)
+      if q > bestQ:
+        (best,bestQ) = (coding,q)
+    return best
+
+
+class Headers(object):
+    """Case-insensitive index over a list of (name,value) header pairs.
+
+    The pairs themselves are kept in the plain list 'items', preserving
+    their order and any duplicates, so the same list can still be used
+    with the paste.httpheaders module.  Lookups go through a dictionary
+    of lowercased names instead of scanning the list.  The methods below
+    keep the index up to date, but after changing the list directly, call
+    invalidate() to have the index rebuilt at the next lookup.
+    """
+
+    __slots__ = ("items","_index")
+
+    def __init__(self,items=None):
+        if items is None:
+          items = []
+        self.items = items
+        self._index = None
+
+    def invalidate(self):
+        """Note that 'items' has been changed other than through us."""
+        self._index = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self,name):
+        return name.lower() in self._getIndex()
+
+    def get(self,name,default=None):
+        """Get the first value of the named header."""
+        idxs = self._getIndex().get(name.lower())
+        if not idxs:
+          return default
+        return self.items[idxs[0]][1]
+
+    def getall(self,name):
+        """Get a list of all values of the named header."""
+        idxs = self._getIndex().get(name.lower(),())
+        items = self.items
+        return [items[i][1] for i in idxs]
+
+    def getlist(self,name):
+        """Get the comma-separated elements of a multi-valued header."""
+        elems = []
+        for value in self.getall(name):
+          for elem in value.split(","):
+            elem = elem.strip()
+            if elem:
+              elems.append(elem)
+        return elems
+
+    def add(self,name,value):
+        """Add a header, keeping any existing values."""
+        items = self.items
+        items.append((name,value))
+        index = self._index
+        if index is not None:
+          try:
+            index[name.lower()].append(len(items) - 1)
+          except KeyError:
+            index[name.lower()] = [len(items) - 1]
+
+    def set(self,name,value):
+        """Set the value of a header, replacing any existing values.
+
+        The first existing header is replaced in place, so the position
+        of the header in the message is preserved.
+        """
+        value = str(value)
+        idxs = self._getIndex().get(name.lower())
+        if not idxs:
+          self.add(name,value)
+          return
+        items = self.items
+        items[idxs[0]] = (items[idxs[0]][0],value)
+        if len(idxs) > 1:
+          for i in reversed(idxs[1:]):
+            del items[i]
+          # The positions of any later headers have changed
+          self._index = None
+
+    def remove(self,name):
+        """Remove all values of the named header."""
+        idxs = self._getIndex().get(name.lower())
+        if idxs:
+          items = self.items
+          for i in reversed(idxs):
+            del items[i]
+          self._index = None
+
+    def parseLine(self,ln):
+        """Parse a single "Name: value" header line and add it."""
+        (name,_,value) = ln.partition(":")
+        self.add(name.strip(),value.strip())
+
+    def serialize(self,terminator="\r\n"):
+        """Format the headers for output, followed by the terminator."""
+        lines = ["%s: %s\r\n" % item for item in self.items]
+        lines.append(terminator)
+        return "".join(lines)
+
+    def _getIndex(self):
+        index = self._index
+        if index is None:
+          index = self._index = {}
+          items = self.items
+          for i in xrange(len(items)):
+            name = items[i][0].lower()
+            try:
+              index[name].append(i)
+            except KeyError:
+              index[name] = [i]
+        return index
+
+
+class HTTPParseError(IOError):
+    """Raised when a message can't be parsed.
+
+    The attributes 'status' and 'reason' give the error response that
+    should be sent to a client whose request caused it.
+    """
+
+    def __init__(self,message,status=400,reason="Bad Request"):
+        IOError.__init__(self,message)
+        self.status = status
+        self.reason = reason
+
+
+class HeadParser(object):
+    """Incremental parser for the head of a HTTP request or response.
+
+    Data is given to feed() in pieces of any size, as it is received, and
+    each line is parsed as soon as it is complete.  feed() returns None
+    until the blank line ending the head has been seen.  It then returns
+    the number of bytes of the piece that belong to the head, and the
+    following attributes are available:
+
+        * headline:  the request or status line, with its line ending
+        * bits:      the (method,uri,protocol) of a request, or the
+                     (protocol,status,reason) of a response
+        * headers:   the headers, as a list of (name,value) pairs
+        * sepline:   the blank line ending the head
+
+    If 'request' is true a request is expected, otherwise a response.  The
+    head may be at most 'max_size' bytes long, with at most 'max_headers'
+    headers.  Any problem with it raises HTTPParseError.
+    """
+
+    __slots__ = ("request","max_size","max_headers","headline","bits",
+                 "headers","sepline","size","_line")
+
+    def __init__(self,request,max_size=MAX_HEADER_SIZE,max_headers=MAX_HEADERS):
+        self.request = request
+        self.max_size = max_size
+        self.max_headers = max_headers
+        self.headline = None
+        self.bits = None
+        self.headers = []
+        self.sepline = None
+        # Bytes of the head received so far, and any incomplete line
+        self.size = 0
+        self._line = []
+
+    def feed(self,data):
+        pos = 0
+        end = len(data)
+        while pos < end:
+          stop = data.find("\n",pos) + 1
+          if stop == 0:
+            stop = end
+          self.size += stop - pos
+          if self.size > self.max_size:
+            self._tooLarge()
+          if stop - pos == end:
+            ln = data
+          else:
+            ln = data[pos:stop]
+          pos = stop
+          if not ln.endswith("\n"):
+            self._line.append(ln)
+            return None
+          if self._line:
+            self._line.append(ln)
+            ln = "".join(self._line)
+            self._line = []
+          if self._parseLine(ln):
+            return pos
+        return None
+
+    def _tooLarge(self):
+        if self.request and self.headline is None:
+          raise HTTPParseError("request line too long",414,"URI Too Long")
+        raise HTTPParseError("message head too large",431,
+                             "Request Header Fields Too Large")
+
+    def _parseLine(self,ln):
+        if self.headline is None:
+          # Blank lines ahead of a message are ignored (RFC 7230, 3.5)
+          if not ln.isspace():
+            self.headline = ln
+            self.bits = self._parseHeadline(ln)
+          return False
+        if ln.isspace():
+          self.sepline = ln
+          return True
+        headers = self.headers
+        if ln[0] in " \t":
+          # An obsolete line folding continues the previous header
+          if not headers:
+            raise HTTPParseError("invalid header line: %r" % (ln,))
+          (name,value) = headers[-1]
+          headers[-1] = (name,(value + " " + ln.strip()).strip())
+          return False
+        (name,sep,value) = ln.partition(":")
+        if not sep or _TOKEN.match(name) is None:
+          raise HTTPParseError("invalid header line: %r" % (ln,))
+        if len(headers) >= self.max_headers:
+          raise HTTPParseError("too many headers",431,
+                               "Request Header Fields Too Large")
+        headers.append((name,value.strip()))
+        return False
+
+    def _parseHeadline(self,ln):
+        if self.request:
+          m = _REQUEST_LINE.match(ln)
+          if m is None:
+            raise HTTPParseError("invalid request line: %r" % (ln,))
+          return m.groups()
+        m = _STATUS_LINE.match(ln)
+        if m is None:
+          raise HTTPParseError("invalid status line: %r" % (ln,))
+        return (m.group(1),int(m.group(2)),(m.group(3) or "").strip())
+
+
+#  A token, such as a header name or request method (RFC 7230, 3.2.6).
+_TOKEN = re.compile(r"[!#$%&'*+.^_`|~0-9A-Za-z-]+\Z")
+
+_REQUEST_LINE = re.compile(r"([!#$%&'*+.^_`|~0-9A-Za-z-]+)[ \t]+(\S+)[ \t]+(HTTP/\d+\.\d+)[ \t]*\r?\n\Z")
+
+_STATUS_LINE = re.compile(r"(HTTP/\d+\.\d+)[ \t]+(\d{3})(?:[ \t]+([^\r\n]*))?\r?\n\Z")
+
+
+#  The states of a ChunkParser.
+(_CHUNK_SIZE,_CHUNK_DATA,_CHUNK_END,_CHUNK_TRAILER) = range(4)
+
+_CHUNK_SIZE_RE = re.compile(r"[0-9A-Fa-f]+\Z")
+
+
+class ChunkParser(object):
+    """Incremental parser for chunked transfer-encoding framing.
+
+    Data is given to feed() in pieces of any size, as it is received.  It
+    returns a list of (start,end) offsets of the chunk data in the piece,
+    and the number of bytes of the piece that belong to the body.  This is
+    less than its length only once the body has ended, which is shown by
+    the 'done' attribute.  Trailer headers are collected as (name,value)
+    pairs in 'trailers'.  The piece may be a string or a bytearray, of
+    which only the first 'end' bytes are used if that is given.
+
+    Each chunk size line, and the trailers as a whole, may be at most
+    'max_size' bytes long.  Broken framing raises HTTPParseError.
+    """
+
+    __slots__ = ("done","trailers","max_size","_state","_remaining",
+                 "_size","_line")
+
+    def __init__(self,max_size=MAX_HEADER_SIZE):
+        self.done = False
+        self.trailers = []
+        self.max_size = max_size
+        self._state = _CHUNK_SIZE
+        self._remaining = 0
+        # Bytes of the current line (or the trailers), and any incomplete line
+        self._size = 0
+        self._line = []
+
+    def feed(self,data,end=None):
+        if end is None:
+          end = len(data)
+        pieces = []
+        pos = 0
+        while pos < end and not self.done:
+          if self._state == _CHUNK_DATA:
+            stop = min(end,pos + self._remaining)
+            pieces.append((pos,stop))
+            self._remaining -= stop - pos
+            pos = stop
+            if self._remaining == 0:
+              self._state = _CHUNK_END
+            continue
+          stop = data.find("\n",pos,end) + 1
+          if stop == 0:
+            stop = end
+          self._size += stop - pos
+          if self._size > self.max_size:
+            raise HTTPParseError("chunk framing too large")
+          ln = bytes(data[pos:stop])
+          pos = stop
+          if not ln.endswith("\n"):
+            self._line.append(ln)
+            break
+          if self._line:
+            self._line.append(ln)
+            ln = "".join(self._line)
+            self._line = []
+          self._parseLine(ln)
+        return (pieces,pos)
+
+    def _parseLine(self,ln):
+        state = self._state
+        if state == _CHUNK_SIZE:
+          self._size = 0
+          # Chunk extensions are permitted after a semicolon; we ignore them
+          size = ln.split(";",1)[0].strip()
+          if _CHUNK_SIZE_RE.match(size) is None:
+            raise HTTPParseError("invalid chunk size: %r" % (ln,))
+          self._remaining = int(size,16)
+          if self._remaining == 0:
+            self._state = _CHUNK_TRAILER
+          else:
+            self._state = _CHUNK_DATA
+        elif state == _CHUNK_END:
+          self._size = 0
+          if not ln.isspace():
+            raise HTTPParseError("missing line break after chunk data")
+          self._state = _CHUNK_SIZE
+        elif ln.isspace():
+          self.done = True
+        else:
+          (name,sep,value) = ln.partition(":")
+          if not sep:
+            raise HTTPParseError("invalid trailer line: %r" % (ln,))
+          self.trailers.append((name.strip(),value.strip()))
+
+
+class HTTPStream(GeneratorStream):
     """Wrapper for reading a single http request/response from a stream.
     Call parse() to read the headers from the stream into the "headers"
     attribute, which can be manipulated using the paste.httpheaders module.
+    The "fields" attribute gives a Headers object over the same list, for
+    fast case-insensitive lookups; call its invalidate() method after
+    changing the list by other means.
+
+    If the message uses chunked transfer-encoding then the "chunked"
+    attribute will be true.  The "body" attribute always gives the decoded
+    body data, and it is re-encoded with fresh chunk framing on output.
+    The framing used to read the body is fixed by parse(), so "chunked"
+    and the headers may then be changed to alter the output framing.
+    Any trailer headers are available in "trailers" once the body has
+    been read.
+
+    The head is read in blocks and parsed by an instance of the class
+    "headParser", which defaults to HeadParser.  It may be at most
+    "max_header_size" bytes long, with at most "max_headers" headers; a
+    head that breaks these limits or is malformed raises HTTPParseError.
+    Any data read beyond it is pushed back onto the stream with unread().
+
+    The body is read in blocks of up to "blocksize" bytes, which defaults
+    to the module-level BLOCK_SIZE and may be changed on the class or on
+    individual instances before parsing.
+
+    If the "relay" attribute is set to a writable stream, and neither the
+    body nor its framing have been changed, the body is not yielded at all
+    but written straight to that stream as it is read.  The data is read
+    into the writable buffer "relayBuffer" (or a new one of "blocksize"
+    bytes) and written out from there without being copied into strings,
+    so the stream must not hold on to the data it is given.
     """
 
+    blocksize = BLOCK_SIZE
+    headParser = HeadParser
+    max_header_size = MAX_HEADER_SIZE
+    max_headers = MAX_HEADERS
+    relay = None
+    relayBuffer = None
+    _isRequest = False
+
     def __init__(self,stream):
-        StreamWrapper.__init__(self,stream)
+        GeneratorStream.__init__(self,stream)
         self.headers = []
-        self._lines = self._generateLines()
+        self._fields = None
+        self.trailers = []
+        self.chunked = False
+        self.complete = False
+        self._delimited = True
+        self._bodyStream = None
 
     def parse(self):
-        self._headline = self.stream.readline()
-        self.parseHeaders()
-        self.body = self._generateBody()
-
-    def parseHeaders(self):
-        for ln in self.stream:
-          if ln.isspace():
-            self._sepline = ln
-            break
-          self.parseHeader(ln)
-
-    def parseHeader(self,ln):
-        bits = ln.split(":")
-        name = bits[0]
-        value = (":".join(bits[1:]))[1:].strip()
-        self.headers.append((name,value))
+        parser = self.headParser(self._isRequest,self.max_header_size,
+                                 self.max_headers)
+        stream = self.stream
+        used = None
+        while used is None:
+          data = stream.read(HEAD_BLOCK_SIZE)
+          if data == "":
+            if parser.size == 0:
+              raise IOError("connection closed before message was received")
+            raise IOError("connection closed inside message head")
+          used = parser.feed(data)
+        if used < len(data):
+          stream.unread(data[used:])
+        self._headline = parser.headline
+        self._sepline = parser.sepline
+        self._bits = parser.bits
+        self.headers = parser.headers
+        self.parseHeadline()
+        fields = self.fields
+        if "Transfer-Encoding" in fields:
+          # The transfer-coding overrides any Content-Length, which must
+          # not be passed on lest the next hop frame the message by it
+          # instead (RFC 7230, 3.3.3).
+          if self._isRequest and not self._isChunked():
+            raise HTTPParseError("request body isn't chunked")
+          fields.remove("Content-Length")
+        else:
+          lengths = set([cl.strip() for cl in fields.getall("Content-Length")])
+          if len(lengths) > 1:
+            raise HTTPParseError("conflicting Content-Length headers")
+          cl = HTTPStream._getContentLength(self)
+          if cl is not None and not cl.isdigit():
+            raise HTTPParseError("invalid Content-Length: %r" % (cl,))
+        self.chunked = self._hasBody() and self._isChunked()
+        self.body = self._rawBody = self._generateBody()
+        self._rawChunked = self.chunked
+
+    def parseHeadline(self):
+        pass
+
+    def _getFields(self):
+        fields = self._fields
+        if fields is None or fields.items is not self.headers:
+          fields = self._fields = Headers(self.headers)
+        return fields
+    fields = property(_getFields)
 
     def _generateLines(self):
         if not hasattr(self,"body"):
           self.parse()
         yield self._headline
-        for (name,value) in self.headers:
-          yield name + ": " + value + "\r\n"
-        yield self._sepline
-        for ln in self.body:
+        # Send the remaining header lines in a single write
+        yield self.fields.serialize(self._sepline)
+        body = self.body
+        if self.relay is not None and self._canRelay():
+          self._relayBody(self.relay)
+          return
+        if self.chunked:
+          body = WriteChunked(body,self.trailers)
+        for ln in body:
           yield ln
 
     def _generateBody(self):
-        cl = self._getContentLength()
-        if cl is None:
-          stream = self.stream
+        # Determine the framing immediately, since the headers may
+        # be rewritten before we start reading the body.
+        if not self._hasBody():
+          return self._readBody(None)
+        if self.chunked:
+          stream = ReadChunked(self.stream)
         else:
-          stream = ReadNBytes(self.stream,int(cl))
-        for ln in stream:
-          yield ln
+          cl = self._getContentLength()
+          if cl is None:
+            # The body extends until the connection is closed
+            stream = self.stream
+            self._delimited = False
+          else:
+            stream = ReadNBytes(self.stream,int(cl))
+        self._bodyStream = stream
+        return self._readBody(stream)
+
+    def _canRelay(self):
+        """Check whether the body can be relayed exactly as it was read."""
+        if self._bodyStream is None or self.body is not self._rawBody:
+          return False
+        return self.chunked == self._rawChunked
+
+    def _relayBody(self,dest):
+        buf = self.relayBuffer
+        if buf is None:
+          buf = bytearray(self.blocksize)
+        stream = self._bodyStream
+        if isinstance(stream,ReadChunked):
+          stream.relay(dest,buf)
+          self.trailers.extend(stream.trailers)
+        else:
+          view = memoryview(buf)
+          n = stream.readinto(view)
+          while n:
+            dest.write(view[:n])
+            n = stream.readinto(view)
+        self.complete = True
+
+    def _readBody(self,stream):
+        if stream is not None:
+          blocksize = self.blocksize
+          data = stream.read(blocksize)
+          while data != "":
+            yield data
+            data = stream.read(blocksize)
+          if isinstance(stream,ReadChunked):
+            self.trailers.extend(stream.trailers)
+        self.complete = True
+
+    def _hasBody(self):
+        return True
+
+    def _isChunked(self):
+        te = self.fields.getlist("Transfer-Encoding")
+        return bool(te) and te[-1].lower() == "chunked"
 
     def _getContentLength(self):
-        cl = hdr.CONTENT_LENGTH(self.headers)
-        if cl == "":
-          cl = None
+        cl = self.fields.get("Content-Length")
+        if cl is not None:
+          cl = cl.strip()
+          if cl == "":
+            cl = None
         return cl
 
-    def readline(self,size=None):
-        #TODO: this ignores <size> and is therefore pointless
-        try:
-          return self._lines.next()
-        except StopIteration:
-          return ""
-
 
 class HTTPRequest(HTTPStream):
     """Read a single HTTP request from the stream.
@@ -177,29 +1044,42 @@ class HTTPRequest(HTTPStream):
         * headers:    the HTTP headers, as a list of (name,value) pairs
 
     If the request is invalid, then the attribute 'valid' will be
-    set to false and no more of the stream is read.
+    set to false and no more of the stream is read.  The HTTPParseError
+    describing the problem is then given by the attribute 'error'.
     """
 
+    _isRequest = True
+
     def __init__(self,stream):
         HTTPStream.__init__(self,stream)
         self.valid = True
-        self.parse()
-        self.parseReqLine()
-        if hdr.HOST(self.headers) is None:
-          self.valid = False
-        if not self.valid:
-          # We need to read the rest of the broken request off the stream,
-          # but don't actually pass it on to the calling code
-          self._lines = Nullify(self.stream)
-
-    def parseReqLine(self):
-        bits = self._headline.split()
-        if len(bits) != 3:
+        self.error = None
+        try:
+          self.parse()
+          # HTTP/1.1 requires a Host header, earlier versions do not
+          if "Host" not in self.fields:
+            if self.reqProtocol.upper() != "HTTP/1.0":
+              raise HTTPParseError("missing Host header")
+        except HTTPParseError, e:
+          # The connection can't be used any further, so the rest of
+          # the request is left unread.
           self.valid = False
-          return
-        self.reqMethod = bits[0]
-        self.reqURI = bits[1]
-        self.reqProtocol = bits[2]
+          self.error = e
+          self._lines = iter(())
+
+    def parseHeadline(self):
+        (self.reqMethod,self.reqURI,self.reqProtocol) = self._bits
+
+    def keepAlive(self):
+        """Check whether the client expects the connection to stay open.
+
+        HTTP/1.1 clients do unless they send "Connection: close", while
+        earlier versions must ask for it with "Connection: keep-alive".
+        """
+        conn = [c.lower() for c in self.fields.getlist("Connection")]
+        if "close" in conn:
+          return False
+        return _isHTTP11(self.reqProtocol) or "keep-alive" in conn
 
     def _generateLines(self):
         lines = HTTPStream._generateLines(self)
@@ -216,65 +1096,303 @@ class HTTPRequest(HTTPStream):
         if cl is None:
           # If there's no content-length and no transfer-encoding, assume
           # there's no request body and truncate the stream.
-          if not hdr.TRANSFER_ENCODING(self.headers):
+          if "Transfer-Encoding" not in self.fields:
             cl = 0
         return cl
 
 
 class HTTPResponse(HTTPStream):
-    """Read a single HTTP response from the stream."""
-    # No special behavior needed at this stage
-    pass
+    """Read a single HTTP response from the stream.
+
+    The status line will be made available in the following attributes
+    once the response has been parsed:
 
+        * respProtocol:  the HTTP version of the response
+        * respStatus:    the numeric status code
+        * respReason:    the reason phrase
+
+    A status line that can't be parsed raises HTTPParseError.
+
+    If the HTTPRequest that produced this response is given, it is used
+    to determine whether a body is expected (responses to HEAD have no
+    body).  Any interim 1xx responses are passed through unchanged ahead
+    of the final response.  If the "interim" attribute is set to a
+    writable stream, they are instead written to it as soon as each one
+    has been read, so that a client waiting for "100 Continue" before
+    sending its request body gets it while the final response is awaited.
+    """
+
+    interim = None
+
+    def __init__(self,stream,request=None):
+        HTTPStream.__init__(self,stream)
+        self.request = request
+        self._interim = []
 
-class HTTPRewriter(StreamWrapper):
+    def parse(self):
+        HTTPStream.parse(self)
+        while self._isInterim():
+          head = self._headline + self.fields.serialize(self._sepline)
+          if self.interim is not None:
+            self.interim.write(head)
+          else:
+            self._interim.append(head)
+          self.headers = []
+          HTTPStream.parse(self)
+
+    def parseHeadline(self):
+        (self.respProtocol,self.respStatus,self.respReason) = self._bits
+
+    def _generateLines(self):
+        lines = HTTPStream._generateLines(self)
+        headline = lines.next()
+        for ln in self._interim:
+          yield ln
+        yield headline
+        for ln in lines:
+          yield ln
+
+    def canReuse(self):
+        """Check whether the connection can carry another request.
+
+        This is only the case once the response has been read in full,
+        if its end was marked by the message framing rather than by the
+        connection closing, and if neither side asked for it to be closed
+        (or, for HTTP/1.0, if either didn't ask for it to be kept open).
+        """
+        if not self.complete or not self._delimited:
+          return False
+        conn = [c.lower() for c in self.fields.getlist("Connection")]
+        if "close" in conn:
+          return False
+        if self.respProtocol.upper() == "HTTP/1.0" and "keep-alive" not in conn:
+          return False
+        if self.request is not None and not self.request.keepAlive():
+          return False
+        return True
+
+    def _isInterim(self):
+        if self.respStatus is None or self.respStatus == 101:
+          return False
+        return 100 <= self.respStatus < 200
+
+    def _hasBody(self):
+        if self.respStatus in (204,304) or self._isInterim():
+          return False
+        if self.request is not None:
+          if getattr(self.request,"reqMethod","").upper() == "HEAD":
+            return False
+        return True
+
+
+class HTTPRewriter(GeneratorStream):
     """Rewrite a HTTP stream.
 
     Subclasses should implement one or both of the methods 'rwHeaders'
     and 'rwBody', which will be invoked at the appropriate times.
 
-    Special care is taken to keep the content-length header accurate,
-    if it is present.  This may mean that the entire body must be read
-    before any can be output.
+    Special care is taken to keep the message framing accurate if the body
+    is rewritten.  Where the message had a content-length header and it is
+    a response to a HTTP/1.1 request, the header is dropped and the new
+    body is streamed out using chunked transfer-encoding.  Otherwise the
+    content-length must be recalculated, which means that the entire body
+    must be read before any can be output.  It is collected in a SpoolBuffer,
+    which moves it to disk once it grows beyond "spool_threshold" bytes.
+
+    If the body was compressed with the gzip or deflate content-coding, it
+    is decompressed as it streams into rwBody, and is only sent out that
+    way if rwBody rewrites it.  A body with any other content-coding can't
+    be rewritten, so rwBody is not called for it at all.
+
+    If the "compress" attribute is true, a rewritten response body is
+    compressed again on its way out.  The coding is chosen according to
+    the Accept-Encoding header of the request, and only bodies with one of
+    the "compress_types" and at least "compress_min_size" bytes long (if
+    the original length is known) are compressed.
     """
 
-    def __init__(self,stream):
-        StreamWrapper.__init__(self,stream)
-        self._lines = self._generateLines()
-
-    def readline(self,size=None):
-        #TODO: this ignores <size> and is therefore pointless
-        try:
-          return self._lines.next()
-        except StopIteration:
-          return ""
+    compress = False
+    compress_types = ("text/","application/xml","application/xhtml+xml",
+                      "application/json","application/javascript")
+    compress_min_size = 1024
+    compress_level = 6
+    spool_threshold = SPOOL_THRESHOLD
 
     def _generateLines(self):
         if not hasattr(self.stream,"body"):
           self.stream.parse()
         if hasattr(self,"rwHeaders"):
           self.rwHeaders(self.stream.headers)
+          self.stream.fields.invalidate()
         # Yield the response line immediately, so the client knows
         # that there's something coming.
         yield self.stream.readline()
-        # Ensure that content-length is correct, reading body if necessary
-        hasCL = hdr.CONTENT_LENGTH(self.stream.headers)
-        hasCL = hasCL not in (None,"","0")
-        if hasattr(self,"rwBody"):
-          self.stream.body = self.rwBody(self.stream.body)
-          if hasCL:
-            body = []
-            newCL = 0
+        # Ensure that the framing is correct, reading body if necessary
+        fields = self.stream.fields
+        origCL = fields.get("Content-Length")
+        hasCL = origCL not in (None,"","0") and self.stream._hasBody()
+        coding = self._getCoding()
+        spool = None
+        if hasattr(self,"rwBody") and coding is not False:
+          origBody = self.stream.body
+          if coding is None:
+            body = origBody
+          else:
+            body = DecodeContent(origBody,coding)
+          newBody = self.rwBody(body)
+          if newBody is body:
+            # Nothing was rewritten, so the body and framing are unaffected
+            pass
+          else:
+            if coding is not None:
+              fields.remove("Content-Encoding")
+            self.stream.body = self._encodeBody(newBody,coding,origCL)
+            if hasCL and self._canChunk():
+              fields.remove("Content-Length")
+              fields.set("Transfer-Encoding","chunked")
+              self.stream.chunked = True
+            elif hasCL:
+              spool = SpoolBuffer(self.spool_threshold)
+        try:
+          if spool is not None:
             for ln in self.stream.body:
-              body.append(ln)
-              newCL += len(ln)
-            self.stream.body = body
-            hdr.CONTENT_LENGTH.update(self.stream.headers,newCL)
-        for ln in self.stream:
-          yield ln
+              spool.write(ln)
+            self.stream.body = spool
+            fields.set("Content-Length",spool.size)
+          for ln in self.stream:
+            yield ln
+        finally:
+          # Free the buffer even if the body is never sent in full
+          if spool is not None:
+            spool.close()
+
+    def _getCoding(self):
+        """Get the content-coding that must be undone to rewrite the body.
+
+        This is None if the body isn't encoded, or False if it is encoded
+        in a way that we can't decode.
+        """
+        if not self.stream._hasBody():
+          return None
+        codings = [c.lower() for c in self.stream.fields.getlist("Content-Encoding")]
+        codings = [c for c in codings if c != "identity"]
+        if not codings:
+          return None
+        if len(codings) == 1 and codings[0] in _ZLIB_WBITS:
+          return codings[0]
+        return False
+
+    def _encodeBody(self,body,coding,origCL):
+        """Compress a rewritten response body, if appropriate.
+
+        Here 'coding' is the content-coding the body had originally, and
+        'origCL' its original Content-Length.
+        """
+        if not self.compress:
+          return body
+        req = getattr(self.stream,"request",None)
+        if req is None or not hasattr(req,"fields"):
+          return body
+        fields = self.stream.fields
+        ctype = fields.get("Content-Type") or ""
+        ctype = ctype.split(";",1)[0].strip().lower()
+        if not ctype.startswith(self.compress_types):
+          return body
+        # Bodies that were compressed to begin with are always worth it
+        if coding is None and origCL is not None and origCL.strip().isdigit():
+          if int(origCL) < self.compress_min_size:
+            return body
+        # The response now depends on Accept-Encoding, whatever it was
+        vary = [v.lower() for v in fields.getlist("Vary")]
+        if "accept-encoding" not in vary and "*" not in vary:
+          fields.add("Vary","Accept-Encoding")
+        newCoding = acceptedCoding(req.fields.getlist("Accept-Encoding"))
+        if newCoding is None:
+          return body
+        fields.set("Content-Encoding",newCoding)
+        return EncodeContent(body,newCoding,self.compress_level)
+
+    def _canChunk(self):
+        """Check whether the body may be sent with chunked encoding.
+
+        This is only safe for responses where both the client's request
+        and the server's response are HTTP/1.1 or later.
+        """
+        req = getattr(self.stream,"request",None)
+        if req is None or not hasattr(req,"reqProtocol"):
+          return False
+        if not _isHTTP11(req.reqProtocol):
+          return False
+        return _isHTTP11(getattr(self.stream,"respProtocol",""))
+
+
+def _isHTTP11(protocol):
+    """Check whether a protocol string is HTTP/1.1 or later."""
+    try:
+      (name,version) = protocol.split("/",1)
+      (major,minor) = [int(v) for v in version.split(".",1)]
+    except ValueError:
+      return False
+    return name.upper() == "HTTP" and (major,minor) >= (1,1)
         
 
-class XMLRewriter(StreamWrapper):
+class RegexRewriter(GeneratorStream):
+    """Apply a regular expression substitution to a stream of text.
+
+    The substitution is applied to each chunk of data as it arrives, so
+    output can begin before the whole stream has been read.  To catch
+    matches that span a chunk boundary, the last 'window' bytes of each
+    chunk are held back and scanned again along with the next chunk.
+    Matches longer than the window may therefore be missed.
+
+    The replacement 'repl' is either a template string, as for re.sub,
+    or a function taking the match object and returning a string.
+    """
+
+    __slots__ = ("pattern","repl","window")
+
+    def __init__(self,stream,pattern,repl,window=4096):
+        GeneratorStream.__init__(self,stream)
+        self.pattern = pattern
+        self.repl = repl
+        self.window = window
+
+    def _generateLines(self):
+        carry = ""
+        for chunk in self.stream:
+          data = carry + chunk
+          (out,carry) = self._substitute(data,len(data) - self.window)
+          if out:
+            yield out
+        if carry:
+          (out,_) = self._substitute(carry,len(carry))
+          yield out
+
+    def _substitute(self,data,limit):
+        """Rewrite matches starting before 'limit'.
+
+        Returns the output for the rewritten portion of the data, and
+        the remainder that must be held back for the next chunk.
+        """
+        repl = self.repl
+        out = []
+        pos = 0
+        for m in self.pattern.finditer(data):
+          if m.start() >= limit:
+            break
+          out.append(data[pos:m.start()])
+          if callable(repl):
+            out.append(repl(m))
+          else:
+            out.append(m.expand(repl))
+          pos = m.end()
+        if limit > pos:
+          out.append(data[pos:limit])
+          pos = limit
+        return ("".join(out),data[pos:])
+
+
+class XMLRewriter(GeneratorStream):
     """Rewrite a stream containing XML.
 
     This class is used to read from a stream yielding chunks of
@@ -294,78 +1412,141 @@ class XMLRewriter(StreamWrapper):
         for ln in rw:
           do_something(ln)
 
+    The document is not re-serialized.  Expat reports the byte offset of
+    each element, and the input is copied to the output unchanged except
+    for the text of the selected attributes and elements, and then only
+    where the rewriting function actually changed them.  The rewriting
+    function is given the unescaped UTF-8 text, and its result is escaped
+    again on the way out.  Elements whose content contains markup are left
+    alone, as are elements written as empty tags.  If the document turns
+    out not to be well-formed, the rest of it is passed through untouched.
+
     Note that we don't do any fancy processing of XML namespaces
     or things like that - very basic processing only.  Maybe in
     the next version...
     """
 
     def __init__(self,stream):
-        StreamWrapper.__init__(self,stream)
-        self._output = []
+        GeneratorStream.__init__(self,stream)
         self.rw_content = {}
         self.rw_attrs = {}
+        self._parser = None
+        # The input that has not yet been copied to the output starts at
+        # offset self._pos in the document, which is self._pos - self._base
+        # in the string self._data.
+        self._data = ""
+        self._base = 0
+        self._pos = 0
+        self._output = []
+        # While collecting an element's text: (offset,list of text)
         self._content = None
-        self._lines = self._generateLines()
-
-    def readline(self,size=None):
-        #TODO: this ignores <size> and is therefore pointless
-        try:
-          return self._lines.next()
-        except StopIteration:
-          return ""
 
     def _generateLines(self):
-        parser = expat.ParserCreate()
-        parser.XmlDeclHandler = self.XmlDecl
+        parser = self._parser = expat.ParserCreate()
+        parser.returns_unicode = False
+        parser.buffer_text = True
         parser.StartElementHandler = self.StartElement
         parser.EndElementHandler = self.EndElement
-        parser.CharacterDataHandler = self.CharacterData
-        for chunk in self.stream:
+        chunks = iter(self.stream)
+        try:
+          for chunk in chunks:
+            self._data += chunk
             parser.Parse(chunk)
-            for result in self._output:
-                yield result
-            self._output = []
-        parser.Parse("",True)
-        for result in self._output:
-           yield result
-
-    def XmlDecl(self,version,encoding,standalone):
-        self._output.append('<?xml version="')
-        self._output.append(str(version))
-        if encoding is not None:
-          self._output.append('" encoding="')
-          self._output.append(str(encoding))
-        self._output.append('"?>')
+            # A tag that expat hasn't finished reading may still need to
+            # be rewritten, so nothing from its "<" onwards is sent yet.
+            # Nor is the text of an element being collected.
+            start = self._pos - self._base
+            idx = self._data.rfind("<",start)
+            if idx < 0:
+              idx = len(self._data)
+            end = self._base + idx
+            if self._content is not None and self._content[0] < end:
+              end = self._content[0]
+            self._copy(end)
+            # Only now is the remaining input sliced off, once per chunk
+            self._data = self._data[self._pos - self._base:]
+            self._base = self._pos
+            if self._output:
+              yield "".join(self._output)
+              self._output = []
+          parser.Parse("",True)
+        except expat.ExpatError:
+          self._content = None
+        self._copy(self._base + len(self._data))
+        self._data = ""
+        if self._output:
+          yield "".join(self._output)
+          self._output = []
+        # Anything after a well-formedness error is passed straight on
+        for chunk in chunks:
+          yield chunk
+
+    def _copy(self,end):
+        """Copy the input up to offset 'end' to the output."""
+        if end > self._pos:
+          base = self._base
+          self._output.append(self._data[self._pos-base:end-base])
+          self._pos = end
+
+    def _replace(self,start,end,text):
+        """Output 'text' in place of the input between the given offsets."""
+        self._copy(start)
+        self._output.append(text)
+        self._pos = end
 
     def StartElement(self,name,attributes):
-        # Start collecting content if we need to rewrite it
-        if self.rw_content.get(name):
-            self._content = ""
-        # Rewrite any attributes 
-        arw = self.rw_attrs.get(name,{})
-        for a in arw:
-            try:
-              val = attributes[a]
-              attributes[a] = self.rewrite(val)
-            except KeyError:
-              pass
-        # Write out the corresponding start tag
-        atts = ['%s="%s"' % (k,v) for (k,v) in attributes.iteritems()]
-        atts = [name] + atts
-        self._output.append("<%s>" % (" ".join(atts),))
+        # Content with markup in it is not rewritten
+        self._content = None
+        arw = self.rw_attrs.get(name)
+        crw = self.rw_content.get(name)
+        if not (arw or crw):
+          return
+        base = self._base
+        tag = _START_TAG.match(self._data,self._parser.CurrentByteIndex - base)
+        if tag is None:
+          return
+        if arw:
+          for m in _ATTRIBUTE.finditer(self._data,tag.start() + len(name) + 1,tag.end()):
+            if arw.get(m.group(1)):
+              val = attributes[m.group(1)]
+              newVal = self.rewrite(val)
+              if newVal != val:
+                quote = m.group(2)[0]
+                self._replace(base + m.start(2),base + m.end(2),
+                              quote + _escapeXML(newVal,quote) + quote)
+        if crw and not tag.group().endswith("/>"):
+          self._content = (base + tag.end(),[])
+          self._parser.CharacterDataHandler = self.CharacterData
 
     def EndElement(self,name):
-        # Were we collecting content?  If so, rewrite it
-        c = self._content
-        if c is not None:
-          self._content = None
-          self.CharacterData(self.rewrite(c))
-        self._output.append("</%s>" % (name,))
+        content = self._content
+        if content is None:
+          return
+        self._content = None
+        self._parser.CharacterDataHandler = None
+        (start,text) = content
+        text = "".join(text)
+        newText = self.rewrite(text)
+        if newText != text:
+          self._replace(start,self._parser.CurrentByteIndex,_escapeXML(newText))
 
     def CharacterData(self,data):
         if self._content is not None:
-            self._content += data
-        else:
-            self._output.append(data)
+          self._content[1].append(data)
+
+
+#  A start tag in XML; attribute values may contain ">" but not quotes.
+_START_TAG = re.compile(r"""<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*/?>""")
+
+#  An attribute within a start tag, giving its name and quoted value.
+_ATTRIBUTE = re.compile(r"""([^\s=/>]+)\s*=\s*("[^"]*"|'[^']*')""")
+
+_XML_QUOTES = {'"': "&quot;", "'": "&apos;"}
 
 
+def _escapeXML(text,quote=None):
+    """Escape text for XML content, or for an attribute in 'quote's."""
+    text = text.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+    if quote is not None:
+      text = text.replace(quote,_XML_QUOTES[quote])
+    return text
@@ -0,0 +1,302 @@
+"""
+
+  proxylet.timeouts:  reclaiming threads from slow or idle peers
+
+Without timeouts, a client that sends its headers a byte at a time, or a
+server that never answers, would hold a thread, its sockets and buffers
+forever.  A Dispatcher therefore applies the timeouts given by a Timeouts
+object, each of which may be set to None to disable it:
+
+    * header:      seconds for a client to send a complete request head,
+                   counted from the first byte of the request
+    * body:        seconds that reading a request or response body may
+                   wait for more data
+    * connect:     seconds to wait for a connection to an upstream server
+    * first_byte:  seconds to wait for the start of an upstream response
+    * keepalive:   seconds that an idle client connection is kept open
+                   waiting for the first byte of another request
+    * send:        seconds that writing to a client or upstream server
+                   may wait for it to accept more data
+
+A client that takes too long over its request head is sent a 408 Request
+Timeout, and a request whose upstream server can't be reached or doesn't
+answer in time gets a 504 Gateway Timeout.  Otherwise the connections are
+simply closed.  Either way, the connection to the client is not reused.
+
+Timeouts are raised into the blocked thread as a Timeout exception.  Many
+reads and writes are timed for each request, so rather than setting a new
+timer for each one, a Watchdog keeps a single timer that is only moved
+when it fires before the current deadline.  Writes are timed by a Watchdog
+of their own, since a thread may write to one connection while its reads
+from another are being timed.
+
+"""
+
+import time
+import socket
+
+from engines import getEngine
+from streams import StreamWrapper
+
+
+class Timeouts(object):
+    """The timeouts applied to each connection, in seconds."""
+
+    def __init__(self,header=60,body=60,connect=30,first_byte=60,keepalive=75,
+                      send=60):
+        self.header = header
+        self.body = body
+        self.connect = connect
+        self.first_byte = first_byte
+        self.keepalive = keepalive
+        self.send = send
+
+
+#  The timeouts used when none are given.
+defaultTimeouts = Timeouts()
+
+
+class Timeout(socket.timeout):
+    """Raised in a thread when a timeout expires.
+
+    The attribute 'kind' gives the name of the timeout, as in Timeouts.
+    """
+
+    def __init__(self,kind):
+        socket.timeout.__init__(self,"%s timeout" % (kind,))
+        self.kind = kind
+
+
+def callWithTimeout(seconds,kind,func,*args):
+    """Call func, raising Timeout if it blocks for more than 'seconds'."""
+    if seconds is None:
+      return func(*args)
+    engine = getEngine()
+    timer = engine.callLater(seconds,engine.current().throw,Timeout(kind))
+    try:
+      return func(*args)
+    finally:
+      timer.cancel()
+
+
+class Watchdog(object):
+    """Times out the blocking calls made by a thread.
+
+    Call expect() to have blocking calls time out after 'seconds', either
+    from now or, if 'idle' is true, from the start of each call.  Calls
+    that should be timed are bracketed by enter() and leave().  If a call
+    is still blocked at the deadline, Timeout is raised in 'thread'.
+
+    afterData() arranges for a different timeout to be expected once the
+    first data has been received, which is signalled by calling gotData().
+
+    wake() raises an exception in the thread if it is blocked in a timed
+    call.  This is for when the socket it waits on has been shut down,
+    which normally wakes the thread by itself.  But eventlet keeps a single
+    set of callbacks for each socket, so once another thread stops waiting
+    to write to it, a thread waiting to read is no longer woken.
+    """
+
+    def __init__(self,thread=None):
+        self.thread = thread
+        self.kind = None
+        self.deadline = None
+        self.idle = None
+        self.pending = None
+        self._blocked = False
+        self._timer = None
+        self._due = None
+        self._wakeup = None
+
+    def expect(self,seconds,kind,idle=False):
+        self.kind = kind
+        if seconds is None:
+          self.deadline = self.idle = None
+        elif idle:
+          self.idle = seconds
+          self.deadline = time.time() + seconds
+        else:
+          self.idle = None
+          self.deadline = time.time() + seconds
+        if self._blocked:
+          self._schedule()
+
+    def afterData(self,seconds,kind,idle=False):
+        self.pending = (seconds,kind,idle)
+
+    def gotData(self):
+        (seconds,kind,idle) = self.pending
+        self.pending = None
+        self.expect(seconds,kind,idle)
+
+    def cancel(self):
+        self.deadline = self.idle = self.pending = None
+
+    def enter(self):
+        # The thread counts as blocked even if no timeout is expected yet,
+        # since another thread may set one while it waits.
+        if self.idle is not None:
+          self.deadline = time.time() + self.idle
+        elif self.deadline is not None and self.deadline <= time.time():
+          self.deadline = None
+          raise Timeout(self.kind)
+        self._blocked = True
+        self._schedule()
+
+    def leave(self):
+        self._blocked = False
+        if self._wakeup is not None:
+          self._wakeup.cancel()
+          self._wakeup = None
+
+    def wake(self,exc):
+        # Dropped if the thread returns from the call by itself first
+        if self._blocked and self._wakeup is None:
+          self._wakeup = getEngine().interrupt(self.thread,exc)
+
+    def _schedule(self):
+        if self.deadline is None:
+          return
+        if self._timer is not None:
+          if self._due <= self.deadline:
+            return
+          self._timer.cancel()
+        self._due = self.deadline
+        self._timer = getEngine().callLater(self.deadline - time.time(),self._expire)
+
+    def _expire(self):
+        self._timer = None
+        if self.deadline is None or not self._blocked:
+          return
+        if self.deadline > time.time():
+          self._schedule()
+          return
+        self.deadline = None
+        self._blocked = False
+        self.thread.throw(Timeout(self.kind))
+
+
+class TimedSocket(object):
+    """Socket whose receiving calls are timed by a Watchdog.
+
+    Data already buffered by readline() is returned without waiting.
+    If 'sendWatchdog' is given, sending is timed by it.
+    """
+
+    def __init__(self,sock,watchdog,sendWatchdog=None):
+        self.sock = sock
+        self.watchdog = watchdog
+        self.sendWatchdog = sendWatchdog
+
+    def _getBuffer(self):
+        return self.sock.recvbuffer
+
+    def _setBuffer(self,data):
+        self.sock.recvbuffer = data
+
+    recvbuffer = property(_getBuffer,_setBuffer)
+
+    def recv(self,size):
+        watchdog = self.watchdog
+        if self.sock.recvbuffer:
+          data = self.sock.recv(size)
+        else:
+          watchdog.enter()
+          try:
+            data = self.sock.recv(size)
+          finally:
+            watchdog.leave()
+        if data and watchdog.pending is not None:
+          watchdog.gotData()
+        return data
+
+    def recv_into(self,buf,size=0):
+        watchdog = self.watchdog
+        watchdog.enter()
+        try:
+          n = self.sock.recv_into(buf,size)
+        finally:
+          watchdog.leave()
+        if n and watchdog.pending is not None:
+          watchdog.gotData()
+        return n
+
+    def sendall(self,data):
+        watchdog = self.sendWatchdog
+        if watchdog is None:
+          return self.sock.sendall(data)
+        watchdog.enter()
+        try:
+          return self.sock.sendall(data)
+        finally:
+          watchdog.leave()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self,flag):
+        # Blocking is left to the engine's socket
+        pass
+
+    def shutdown(self,how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+
+class TimedStream(StreamWrapper):
+    """Stream whose reads are timed by a Watchdog.
+
+    If 'sendWatchdog' is given, writes are timed by it.
+    """
+
+    __slots__ = ("watchdog","sendWatchdog")
+
+    def __init__(self,stream,watchdog,sendWatchdog=None):
+        StreamWrapper.__init__(self,stream)
+        self.watchdog = watchdog
+        self.sendWatchdog = sendWatchdog
+
+    def readline(self,size=None):
+        watchdog = self.watchdog
+        watchdog.enter()
+        try:
+          ln = self.stream.readline(size)
+        finally:
+          watchdog.leave()
+        if ln and watchdog.pending is not None:
+          watchdog.gotData()
+        return ln
+
+    def read(self,size=None):
+        watchdog = self.watchdog
+        watchdog.enter()
+        try:
+          data = self.stream.read(size)
+        finally:
+          watchdog.leave()
+        if data and watchdog.pending is not None:
+          watchdog.gotData()
+        return data
+
+    def readinto(self,buf):
+        watchdog = self.watchdog
+        watchdog.enter()
+        try:
+          n = self.stream.readinto(buf)
+        finally:
+          watchdog.leave()
+        if n and watchdog.pending is not None:
+          watchdog.gotData()
+        return n
+
+    def write(self,data):
+        watchdog = self.sendWatchdog
+        if watchdog is None:
+          return self.stream.write(data)
+        watchdog.enter()
+        try:
+          return self.stream.write(data)
+        finally:
+          watchdog.leave()
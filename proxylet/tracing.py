@@ -0,0 +1,232 @@
+"""
+
+  proxylet.tracing:  timing each stage of the requests passing through
+
+When a request is slow, its total time says little about where that time
+went.  A Tracer records when each request passes through the stages of
+being proxied, so that the time can be pinned on the right one.  Pass one
+to the Server, along with where to send the results:
+
+    tracer = Tracer([TraceFile("/var/log/proxylet.trace")],sample=0.01)
+    Server(host,port,mapper,tracer=tracer).serve()
+
+Only a fraction 'sample' of requests are traced.  The Dispatcher asks the
+tracer for a Span when it has read a request, and gets None for requests
+that aren't sampled; for those, and when no tracer is given at all, the
+cost is a single test at each stage.
+
+A Span holds the time at which each stage of its request was reached, as
+a list of (stage,time) marks in the order they were made:
+
+    * map:                  the mapper has chosen where to send it
+    * cache:                the response cache has been consulted
+    * connect:              a connection to the upstream server is ready
+    * request_sent:         the request has been sent upstream
+    * dequeue:              earlier responses on the connection have been
+                            sent, and this one is being processed
+    * upstream_first_byte:  the first byte of the response has arrived
+    * response_head:        the response head has been parsed, and its
+                            first line is ready to send
+    * first_write:          the first data has been written to the client
+
+Stages that don't apply to a request are left out, and since requests and
+responses are handled by separate threads the marks of the two may be
+interleaved.  Time spent in stages that are repeated throughout the body
+is added up in the totals of the span instead:
+
+    * upstream_read:   blocked reading from the upstream server
+    * upstream_write:  writing the request to the upstream server
+    * client_write:    writing the response to the client
+    * rewrite:         producing the response from the upstream data,
+                       such as by rewriting, decompressing or compressing
+
+Finished spans are passed to each of the tracer's sinks, which are plain
+callables.  TraceFile writes them to a compact file for offline analysis.
+
+"""
+
+import os
+import time
+import random
+import traceback
+from itertools import count
+
+from streams import StreamWrapper
+
+
+class Span(object):
+    """The timings of a single request.
+
+    Besides the 'marks' and 'totals' described above, the attributes give
+    a sequence number 'id', the 'start' and 'end' times, the request
+    'method' and 'uri', the 'route' it was mapped to, the response
+    'status', and the kind of 'error' (if any) that cut it short.  Other
+    details may be added to the dictionary 'tags'.
+    """
+
+    __slots__ = ("id","start","end","method","uri","route","status",
+                 "error","marks","totals","tags")
+
+    def __init__(self,id,method,uri):
+        self.id = id
+        self.start = time.time()
+        self.end = None
+        self.method = method
+        self.uri = uri
+        self.route = "none"
+        self.status = None
+        self.error = None
+        self.marks = []
+        self.totals = {}
+        self.tags = {}
+
+    def mark(self,stage):
+        """Note that the given stage has been reached."""
+        self.marks.append((stage,time.time()))
+
+    def add(self,stage,seconds):
+        """Add to the time spent in the given stage."""
+        totals = self.totals
+        try:
+          totals[stage] += seconds
+        except KeyError:
+          totals[stage] = seconds
+
+
+class Tracer(object):
+    """Starts a Span for a sample of requests, and reports finished ones.
+
+    A fraction 'sample' of requests are traced.  Each finished span is
+    passed to each of the callables in 'sinks'; errors raised by a sink
+    are printed and otherwise ignored.
+    """
+
+    def __init__(self,sinks=(),sample=1.0):
+        self.sinks = list(sinks)
+        self.sample = sample
+        self._ids = count(1)
+
+    def start(self,req):
+        """Start a Span for the given request, if it is to be traced."""
+        if self.sample < 1 and random.random() >= self.sample:
+          return None
+        return Span(self._ids.next(),req.reqMethod,req.reqURI)
+
+    def finish(self,span):
+        span.end = time.time()
+        for sink in self.sinks:
+          try:
+            sink(span)
+          except Exception:
+            traceback.print_exc()
+
+    def flush(self):
+        """Flush any sinks that buffer their output."""
+        for sink in self.sinks:
+          flush = getattr(sink,"flush",None)
+          if flush is not None:
+            flush()
+
+
+class TracedStream(StreamWrapper):
+    """Stream that adds the time spent reading and writing to a Span.
+
+    The times are added to the stages 'prefix' + "_read" and "_write",
+    and the stage 'prefix' + "_first_byte" is marked when data is first
+    read from the stream.
+    """
+
+    __slots__ = ("span","_read","_write","_first")
+
+    def __init__(self,stream,span,prefix):
+        StreamWrapper.__init__(self,stream)
+        self.span = span
+        self._read = prefix + "_read"
+        self._write = prefix + "_write"
+        self._first = prefix + "_first_byte"
+
+    def readline(self,size=None):
+        start = time.time()
+        ln = self.stream.readline(size)
+        self._gotData(start,ln)
+        return ln
+
+    def read(self,size=None):
+        start = time.time()
+        data = self.stream.read(size)
+        self._gotData(start,data)
+        return data
+
+    def readinto(self,buf):
+        start = time.time()
+        n = self.stream.readinto(buf)
+        self._gotData(start,n)
+        return n
+
+    def write(self,data):
+        start = time.time()
+        try:
+          return self.stream.write(data)
+        finally:
+          self.span.add(self._write,time.time() - start)
+
+    def _gotData(self,start,data):
+        span = self.span
+        span.add(self._read,time.time() - start)
+        if data and self._first is not None:
+          span.mark(self._first)
+          self._first = None
+
+
+class TraceFile(object):
+    """Sink writing spans to a file, one line per span.
+
+    Each line has tab-separated fields giving the id, start time, total
+    duration, route, method, status, error and URI of the span, followed
+    by its marks and totals.  Durations are whole microseconds, and the
+    time of each mark is given relative to the start.  A "-" stands for
+    a missing value, and the marks and totals are written as "stage=n"
+    pairs separated by commas:
+
+        17  1192510801.251394  5310  http://localhost/svn  PROPFIND  207  -
+            /svn/trunk  map=12,connect=240,...  upstream_read=3902,...
+
+    Lines are collected and appended to the file 'batch' at a time, each
+    batch in a single write, so several processes can share the file.
+    Call flush() to write out any lines still pending.
+    """
+
+    def __init__(self,path,batch=64):
+        self.path = path
+        self.batch = batch
+        self._fd = os.open(path,os.O_WRONLY | os.O_APPEND | os.O_CREAT,0644)
+        self._pending = []
+
+    def __call__(self,span):
+        start = span.start
+        marks = ",".join(["%s=%d" % (stage,(t - start) * 1000000)
+                          for (stage,t) in span.marks])
+        totals = ",".join(["%s=%d" % (stage,seconds * 1000000)
+                           for (stage,seconds) in sorted(span.totals.iteritems())])
+        fields = (str(span.id),"%.6f" % (start,),
+                  "%d" % ((span.end - start) * 1000000,),
+                  span.route,span.method,str(span.status or "-"),
+                  span.error or "-",span.uri,marks or "-",totals or "-")
+        self._pending.append("\t".join([_clean(f) for f in fields]) + "\n")
+        if len(self._pending) >= self.batch:
+          self.flush()
+
+    def flush(self):
+        if self._pending:
+          data = "".join(self._pending)
+          self._pending = []
+          os.write(self._fd,data)
+
+    def close(self):
+        self.flush()
+        os.close(self._fd)
+
+
+def _clean(value):
+    """Keep a field from breaking up the line it is written on."""
+    return str(value).replace("\t"," ").replace("\n"," ").replace("\r"," ")
@@ -0,0 +1,229 @@
+"""
+
+  proxylet.upstream:  load balancing over groups of upstream servers
+
+A mapping normally names a single upstream server, but its host may also
+be an UpstreamGroup, which spreads requests over several replicas of the
+same backend.  The port is then given as None:
+
+    group = UpstreamGroup([("app1",8080),("app2",8080)],"least_outstanding")
+    router.addRoute("/app",group,None)
+
+Relocators accept a group in place of the host and port of their remote
+root, so the URL rewriting still works as before:
+
+    SVNRelocator("http://www.example.com/svn","http://svn/repo",upstream=group)
+
+A server is chosen for each request by one of the following policies:
+
+    * round_robin:        each server in turn
+    * least_outstanding:  the server with the fewest requests in progress
+    * consistent_hash:    a server chosen by hashing the request URI, so
+                          that each URI keeps going to the same server for
+                          as long as it is up
+
+Servers are taken out of rotation in two ways.  If 'health_path' is given,
+each server is sent a GET for that path every 'health_interval' seconds
+and is considered down until it answers with a 2xx or 3xx status; without
+it, being able to connect is enough.  And whenever 'max_fails' requests in
+a row fail to connect or get a 5xx response, the server is ejected for
+'eject_time' seconds.  If every server is down, requests are sent to them
+anyway, as there's nothing better to do.  Should connecting to the chosen
+server fail, the next one is tried before giving up.
+
+"""
+
+import time
+import socket
+from bisect import bisect
+from hashlib import md5
+
+from engines import getEngine
+from streams import HTTPResponse
+from timeouts import callWithTimeout
+
+
+#  The selection policies, by name.
+POLICIES = ("round_robin","least_outstanding","consistent_hash")
+
+#  Number of points on the hash ring for each server.
+HASH_REPLICAS = 100
+
+
+class Upstream(object):
+    """A single server in an UpstreamGroup, and what we know of its state."""
+
+    __slots__ = ("address","outstanding","healthy","failures","ejectedUntil")
+
+    def __init__(self,host,port):
+        self.address = (host,int(port))
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.ejectedUntil = 0
+
+    def available(self,now):
+        return self.healthy and now >= self.ejectedUntil
+
+
+class UpstreamGroup(object):
+    """A group of equivalent upstream servers, used as a mapping's host.
+
+    'servers' is a list of (host,port) pairs, and 'policy' is one of the
+    names in POLICIES.  For the consistent_hash policy, 'hash_key' may be
+    a function taking the request and returning the string to hash; by
+    default the request URI is used.  The remaining arguments control the
+    health checking described above; set 'health_interval' to zero to
+    disable active checks.  The group appears in metrics as 'name'.
+    """
+
+    def __init__(self,servers,policy="round_robin",name=None,hash_key=None,
+                      health_path=None,health_interval=5.0,health_timeout=2.0,
+                      max_fails=3,eject_time=30.0):
+        if policy not in POLICIES:
+          raise ValueError("unknown policy: %r" % (policy,))
+        self.members = [Upstream(host,port) for (host,port) in servers]
+        if not self.members:
+          raise ValueError("an upstream group needs at least one server")
+        self.policy = policy
+        if name is None:
+          name = "+".join(["%s:%d" % m.address for m in self.members])
+        self.name = name
+        self.hash_key = hash_key
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.max_fails = max_fails
+        self.eject_time = eject_time
+        self._next = 0
+        self._ring = None
+        if policy == "consistent_hash":
+          self._ring = self._buildRing()
+        self._checking = False
+
+    def __str__(self):
+        return self.name
+
+    def checkout(self,pool,req,timeout=None):
+        """Get a PooledConnection from the pool to a server for req.
+
+        If the connection fails or takes more than 'timeout' seconds, the
+        other servers are tried in turn before the error is raised.
+        """
+        if not self._checking and self.health_interval:
+          self.startChecks()
+        tried = []
+        lastError = None
+        while True:
+          member = self._select(req,tried)
+          if member is None:
+            raise lastError
+          try:
+            conn = pool.checkout(member.address,timeout)
+          except socket.error, e:
+            self._recordFailure(member)
+            tried.append(member)
+            lastError = e
+            continue
+          member.outstanding += 1
+          conn.onrelease = lambda conn,status,member=member: self._release(member,status)
+          return conn
+
+    def startChecks(self):
+        """Start checking the health of the servers in the background.
+
+        This is done automatically on the first checkout, in the engine
+        that is current at the time.
+        """
+        self._checking = True
+        getEngine().spawn(self._checkLoop)
+
+    def stopChecks(self):
+        self._checking = False
+
+    def _select(self,req,exclude):
+        members = [m for m in self.members if m not in exclude]
+        now = time.time()
+        available = [m for m in members if m.available(now)]
+        if not available:
+          available = members
+          if not available:
+            return None
+        if self.policy == "consistent_hash":
+          return self._selectHashed(req,available)
+        idx = self._next % len(available)
+        self._next += 1
+        if self.policy == "round_robin":
+          return available[idx]
+        # Start from a rotating position, so that ties are spread out
+        available = available[idx:] + available[:idx]
+        return min(available,key=lambda m: m.outstanding)
+
+    def _selectHashed(self,req,available):
+        if self.hash_key is None:
+          key = req.reqURI
+        else:
+          key = self.hash_key(req)
+        ring = self._ring
+        idx = bisect(ring,(_hash(key),))
+        for i in xrange(len(ring)):
+          member = self.members[ring[(idx + i) % len(ring)][1]]
+          if member in available:
+            return member
+        return available[0]
+
+    def _buildRing(self):
+        ring = []
+        for (i,member) in enumerate(self.members):
+          for j in xrange(HASH_REPLICAS):
+            ring.append((_hash("%s:%d-%d" % (member.address + (j,))),i))
+        ring.sort()
+        return ring
+
+    def _release(self,member,status):
+        member.outstanding -= 1
+        if status is None:
+          return
+        if status >= 500:
+          self._recordFailure(member)
+        else:
+          member.failures = 0
+
+    def _recordFailure(self,member):
+        member.failures += 1
+        if member.failures >= self.max_fails:
+          member.failures = 0
+          member.ejectedUntil = time.time() + self.eject_time
+
+    def _checkLoop(self):
+        engine = getEngine()
+        while self._checking:
+          for member in self.members:
+            engine.spawn(self._checkMember,member)
+          engine.sleep(self.health_interval)
+
+    def _checkMember(self,member):
+        try:
+          healthy = callWithTimeout(self.health_timeout,"health",
+                                    self._probe,member)
+        except (IOError,socket.error):
+          healthy = False
+        member.healthy = healthy
+
+    def _probe(self,member):
+        """Check whether a server is healthy."""
+        sock = getEngine().connect(member.address)
+        try:
+          if self.health_path is None:
+            return True
+          sock.sendall("GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n"
+                       % (self.health_path,member.address[0]))
+          resp = HTTPResponse(sock)
+          resp.parse()
+          return resp.respStatus is not None and 200 <= resp.respStatus < 400
+        finally:
+          sock.close()
+
+
+def _hash(key):
+    return int(md5(key).hexdigest()[:8],16)
@@ -36,4 +36,7 @@ setup(name='proxylet',
       install_requires = [
         'Paste','eventlet'
       ],
+      extras_require = {
+        'asyncio': ['trollius'],
+      },
       )
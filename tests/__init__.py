@@ -0,0 +1,5 @@
+#
+#  Tests for proxylet.  Run them from the top of the source tree with:
+#
+#      python -m unittest discover
+#
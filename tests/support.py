@@ -0,0 +1,178 @@
+"""
+
+  tests.support:  running proxylet and stand-in backends within a test
+
+The tests run in the main greenthread of the eventlet hub.  Backends and
+proxies are started in their own greenthreads on ephemeral ports, and are
+driven by the blocking calls that the test makes on its client sockets.
+
+"""
+
+import time
+import socket
+import threading
+
+from eventlet import api
+
+import proxylet
+from proxylet.engines import getEngine
+from proxylet.pool import ConnectionPool
+from proxylet.streams import StreamWrapper, HTTPRequest, HTTPResponse
+
+
+def listen():
+    """Open a listening socket on an ephemeral port, returning (sock,port)."""
+    sock = api.tcp_listener(("127.0.0.1",0))
+    return (sock,sock.getsockname()[1])
+
+
+def waitFor(check,timeout=5):
+    """Let other greenthreads run until check() is true, or time runs out."""
+    deadline = time.time() + timeout
+    while not check():
+      if time.time() > deadline:
+        raise AssertionError("timed out waiting for %r" % (check,))
+      api.sleep(0.01)
+
+
+class Backend(object):
+    """Stand-in upstream server.
+
+    Each connection is handled by calling handler(backend,stream,index),
+    where 'index' counts the connections from zero.  By default every
+    request is answered with a short 200 response.  The (method,uri,body)
+    of each request read by respond() are recorded in 'requests'.
+    """
+
+    def __init__(self,handler=None):
+        (self.listener,self.port) = listen()
+        if handler is None:
+          handler = serveRequests
+        self.handler = handler
+        self.connections = 0
+        self.requests = []
+        self._thread = api.spawn(self._serve)
+
+    def _serve(self):
+        while True:
+          (sock,_) = self.listener.accept()
+          index = self.connections
+          self.connections += 1
+          api.spawn(self._handle,sock,index)
+
+    def _handle(self,sock,index):
+        stream = StreamWrapper(sock)
+        try:
+          self.handler(self,stream,index)
+        except (IOError,socket.error):
+          pass
+        sock.close()
+
+    def read(self,stream):
+        """Read a request, recording it."""
+        req = HTTPRequest(stream)
+        body = "".join(req.body)
+        self.requests.append((req.reqMethod,req.reqURI,body))
+        return req
+
+    def close(self):
+        api.kill(self._thread)
+        self.listener.close()
+
+
+def serveRequests(backend,stream,index):
+    """Answer each request on the connection with "ok"."""
+    while True:
+      backend.read(stream)
+      stream.write("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+
+class Proxy(object):
+    """A proxylet.Server running in its own greenthread.
+
+    Unless given, the server gets a connection pool of its own and maps
+    every request to the given backend.  The time at which serve()
+    returned is kept in 'returned'.
+
+    If the current engine isn't eventlet, the server runs on it in an OS
+    thread of its own instead, leaving this thread's eventlet hub to the
+    backends and clients.
+    """
+
+    def __init__(self,backend=None,mapper=None,**kwds):
+        if mapper is None:
+          mapper = lambda req: ("127.0.0.1",backend.port,None)
+        kwds.setdefault("pool",ConnectionPool())
+        self.returned = None
+        self.errors = []
+        engine = getEngine()
+        if engine.name == "eventlet":
+          (listener,self.port) = listen()
+          self.server = proxylet.Server("127.0.0.1",self.port,mapper,**kwds)
+          api.spawn(self._serve,listener)
+          api.sleep(0)
+        else:
+          sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+          sock.bind(("127.0.0.1",0))
+          sock.listen(50)
+          self.port = sock.getsockname()[1]
+          self.server = proxylet.Server("127.0.0.1",self.port,mapper,**kwds)
+          thread = threading.Thread(target=self._serve,
+                                    args=(engine.wrapListener(sock),))
+          thread.setDaemon(True)
+          thread.start()
+
+    def _serve(self,listener):
+        try:
+          self.server.serve(listener)
+        except Exception, e:
+          self.errors.append(e)
+        self.returned = time.time()
+
+    def connect(self):
+        return Client(self.port)
+
+
+class Client(object):
+    """A client connection to a proxy."""
+
+    def __init__(self,port):
+        self.sock = api.connect_tcp(("127.0.0.1",port))
+        self.stream = StreamWrapper(self.sock)
+
+    def send(self,data):
+        self.sock.sendall(data)
+
+    def request(self,method,uri,headers=(),body=None,protocol="HTTP/1.1"):
+        """Send a request and read its response, returning (resp,body)."""
+        self.send(requestData(method,uri,headers,body,protocol))
+        return self.response(method)
+
+    def response(self,method="GET"):
+        req = _FakeRequest(method)
+        resp = HTTPResponse(self.stream,req)
+        resp.parse()
+        return (resp,"".join(resp.body))
+
+    def close(self):
+        self.sock.close()
+
+
+def requestData(method,uri,headers=(),body=None,protocol="HTTP/1.1"):
+    """Format a request, adding Host and Content-Length headers."""
+    lines = ["%s %s %s\r\n" % (method,uri,protocol),"Host: test\r\n"]
+    for (name,value) in headers:
+      lines.append("%s: %s\r\n" % (name,value))
+    if body is not None:
+      lines.append("Content-Length: %d\r\n" % (len(body),))
+    lines.append("\r\n")
+    if body is not None:
+      lines.append(body)
+    return "".join(lines)
+
+
+class _FakeRequest(object):
+    """Just enough of a request for HTTPResponse to frame the body."""
+
+    def __init__(self,method):
+        self.reqMethod = method
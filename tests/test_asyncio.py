@@ -0,0 +1,56 @@
+import unittest
+
+from proxylet.engines import AsyncioEngine, getEngine, useEngine, \
+                             _importAsyncio
+
+from tests import test_pool, test_server
+
+
+def haveAsyncio():
+    try:
+      _importAsyncio()
+    except ImportError:
+      return False
+    return True
+
+
+class OnAsyncio(object):
+    """Mixin running each test with a fresh asyncio engine."""
+
+    def setUp(self):
+        self.engine = getEngine()
+        useEngine(AsyncioEngine())
+
+    def tearDown(self):
+        useEngine(self.engine)
+
+
+@unittest.skipIf(not haveAsyncio(),"needs asyncio or trollius")
+class TestRelay(OnAsyncio,test_server.TestRelay):
+    pass
+
+
+@unittest.skipIf(not haveAsyncio(),"needs asyncio or trollius")
+class TestUpstreamErrors(OnAsyncio,test_server.TestUpstreamErrors):
+    pass
+
+
+@unittest.skipIf(not haveAsyncio(),"needs asyncio or trollius")
+class TestStaleConnections(OnAsyncio,test_pool.TestStaleConnections):
+
+    def setUp(self):
+        OnAsyncio.setUp(self)
+        test_pool.TestStaleConnections.setUp(self)
+
+    def tearDown(self):
+        test_pool.TestStaleConnections.tearDown(self)
+        OnAsyncio.tearDown(self)
+
+
+@unittest.skipIf(not haveAsyncio(),"needs asyncio or trollius")
+class TestReuse(OnAsyncio,test_pool.TestReuse):
+    pass
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+
+from eventlet import api
+
+from proxylet.bench import SCENARIOS, makeMapper, backends
+
+from tests.support import Proxy, listen
+
+
+class TestScenarios(unittest.TestCase):
+
+    def setUp(self):
+        (sock,self.port) = listen()
+        sock.close()
+        self.backend = api.spawn(backends.serve,self.port)
+        api.sleep(0)
+
+    def tearDown(self):
+        api.kill(self.backend)
+
+    def test_slow(self):
+        proxy = Proxy(mapper=makeMapper("slow",0,self.port))
+        client = proxy.connect()
+        for (method,path,headers,body) in SCENARIOS["slow"]:
+          (resp,data) = client.request(method,path,headers)
+          self.assertEqual(resp.respStatus,200)
+        (resp,data) = client.request("GET","/drip/3")
+        self.assertEqual(data,"d" * 3 * backends.DRIP_SIZE)
+        client.close()
+        proxy.server.halt()
+
+
+if __name__ == "__main__":
+    unittest.main()
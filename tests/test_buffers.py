@@ -0,0 +1,50 @@
+import unittest
+
+from proxylet.buffers import MemoryBudget, SpoolBuffer
+
+
+class TestSpoolBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.budget = MemoryBudget(1000)
+
+    def test_in_memory(self):
+        buf = SpoolBuffer(100,self.budget)
+        buf.write("a" * 30)
+        buf.write("b" * 20)
+        self.assertFalse(buf.spilled())
+        self.assertEqual(len(buf),50)
+        self.assertEqual(self.budget.used,50)
+        self.assertEqual("".join(buf),"a" * 30 + "b" * 20)
+        self.assertEqual(self.budget.used,0)
+
+    def test_spill(self):
+        buf = SpoolBuffer(100,self.budget)
+        data = "".join([chr(65 + i % 26) * 7 for i in xrange(40)])
+        for i in xrange(0,len(data),7):
+          buf.write(data[i:i+7])
+        self.assertTrue(buf.spilled())
+        self.assertEqual(self.budget.used,0)
+        self.assertEqual(len(buf),len(data))
+        self.assertEqual("".join(buf),data)
+
+    def test_budget_exhausted(self):
+        other = SpoolBuffer(1000,self.budget)
+        other.write("x" * 990)
+        buf = SpoolBuffer(100,self.budget)
+        buf.write("y" * 20)
+        self.assertTrue(buf.spilled())
+        self.assertEqual("".join(buf),"y" * 20)
+        other.close()
+        self.assertEqual(self.budget.used,0)
+
+    def test_close_unread(self):
+        buf = SpoolBuffer(100,self.budget)
+        buf.write("z" * 50)
+        buf.close()
+        buf.close()
+        self.assertEqual(self.budget.used,0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import gc
+import unittest
+
+from eventlet import api
+
+from proxylet.cache import ResponseCache, Follower
+from proxylet.streams import StringStream, HTTPRequest, HTTPResponse
+
+from tests.support import Backend, Proxy, waitFor
+
+
+def request(uri="/page"):
+    return HTTPRequest(StringStream("GET %s HTTP/1.1\r\nHost: test\r\n\r\n" % (uri,)))
+
+
+def response(req,body="hello"):
+    data = "HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: %d\r\n\r\n%s" % (len(body),body)
+    return HTTPResponse(StringStream(data),req)
+
+
+def chunkedResponse(req,chunks):
+    data = ["HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nTransfer-Encoding: chunked\r\n\r\n"]
+    for chunk in chunks:
+      data.append("%x\r\n%s\r\n" % (len(chunk),chunk))
+    data.append("0\r\n\r\n")
+    return HTTPResponse(StringStream("".join(data)),req)
+
+
+class TestInflight(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache()
+
+    def _wrap(self,req,resp):
+        key = self.cache.keyFor(req)
+        self.assertEqual(self.cache.follow(key,req),None)
+        return (key,self.cache.wrap(key,req,resp,resp))
+
+    def test_store(self):
+        req = request()
+        (key,wrapped) = self._wrap(req,response(req))
+        "".join(wrapped)
+        (status,stream,keepAlive) = self.cache.lookup(key,request())
+        self.assertEqual(status,200)
+        self.assertTrue(stream.read().endswith("\r\n\r\nhello"))
+
+    def test_unregistered_when_discarded(self):
+        req = request()
+        (key,wrapped) = self._wrap(req,response(req))
+        inflight = self.cache._inflight[key]
+        del wrapped
+        gc.collect()
+        self.assertEqual(self.cache._inflight,{})
+        self.assertTrue(inflight.failed)
+        self.assertEqual(inflight.waitForHeaders(),None)
+
+    def test_reservation_abandoned(self):
+        req = request()
+        key = self.cache.keyFor(req)
+        self.assertEqual(self.cache.follow(key,req),None)
+        self.assertTrue(key in self.cache._inflight)
+        self.cache.abandon(key,req)
+        self.assertEqual(self.cache._inflight,{})
+
+    def test_unregistered_when_abandoned(self):
+        req = request()
+        (key,wrapped) = self._wrap(req,response(req))
+        lines = iter(wrapped)
+        lines.next()
+        self.assertTrue(key in self.cache._inflight)
+        lines.close()
+        self.assertEqual(self.cache._inflight,{})
+
+    def test_follow(self):
+        req = request()
+        (key,wrapped) = self._wrap(req,response(req))
+        lines = iter(wrapped)
+        for i in xrange(3):
+          lines.next()
+        (status,follower,keepAlive) = self.cache.follow(key,request())
+        self.assertEqual(status,200)
+        for ln in lines:
+          pass
+        self.assertEqual(self.cache._inflight,{})
+        data = "".join(follower)
+        self.assertTrue("Content-Length: 5\r\n" in data)
+        self.assertTrue(data.endswith("\r\n\r\nhello"))
+
+    def test_follower_attached_before_limit(self):
+        self.cache.max_entry = 3
+        req = request()
+        (key,wrapped) = self._wrap(req,chunkedResponse(req,["he","ll","o"]))
+        lines = iter(wrapped)
+        for i in xrange(3):
+          lines.next()
+        (status,follower,keepAlive) = self.cache.follow(key,request())
+        for ln in lines:
+          pass
+        inflight = follower.inflight
+        self.assertFalse(inflight.joinable)
+        self.assertEqual(inflight.blocks,["he","ll","o"])
+        data = "".join(follower)
+        self.assertTrue(data.endswith("2\r\nhe\r\n2\r\nll\r\n1\r\no\r\n0\r\n\r\n"))
+        self.assertEqual(inflight.blocks,[])
+        self.assertEqual(inflight.followers,set())
+        self.assertEqual(self.cache._inflight,{})
+
+    def _follow(self,chunks):
+        req = request()
+        (key,wrapped) = self._wrap(req,chunkedResponse(req,chunks))
+        lines = iter(wrapped)
+        for i in xrange(3):
+          lines.next()
+        (status,follower,keepAlive) = self.cache.follow(key,request())
+        return (lines,follower)
+
+    def test_sent_blocks_released(self):
+        self.cache.max_entry = 3
+        (lines,follower) = self._follow(["ab","cd","ef","gh"])
+        inflight = follower.inflight
+        body = iter(follower)
+        body.next()
+        for i in xrange(2):
+          lines.next()
+        self.assertEqual(inflight.blocks,["ab","cd","ef"])
+        self.assertEqual(body.next(),"2\r\nab\r\n")
+        self.assertEqual(body.next(),"2\r\ncd\r\n")
+        self.assertEqual(inflight.blocks,["ef"])
+        self.assertEqual(inflight.buffered,2)
+
+    def test_lagging_follower_dropped(self):
+        self.cache.max_entry = 3
+        self.cache.max_lag = 4
+        (lines,slow) = self._follow(["ab","cd","ef","gh"])
+        fast = Follower(slow.inflight,request())
+        fast.setFraming(request())
+        fastBody = iter(fast)
+        fastBody.next()
+        for i in xrange(2):
+          lines.next()
+          fastBody.next()
+        self.assertEqual(slow.inflight.followers,set([fast]))
+        self.assertEqual(slow.inflight.blocks,["ef"])
+        for ln in lines:
+          pass
+        self.assertTrue("".join(fastBody).endswith("2\r\nef\r\n2\r\ngh\r\n0\r\n\r\n"))
+        self.assertRaises(IOError,"".join,slow)
+
+    def test_follower_closed_unsent(self):
+        (lines,follower) = self._follow(["ab","cd"])
+        inflight = follower.inflight
+        follower.close()
+        self.assertEqual(inflight.followers,set())
+
+
+def slowCacheable(backend,stream,index):
+    """Answer each request with a cacheable response, after a delay."""
+    while True:
+      backend.read(stream)
+      api.sleep(0.2)
+      stream.write("HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 5\r\n\r\nhello")
+
+
+class TestCollapsing(unittest.TestCase):
+
+    def test_concurrent_misses(self):
+        backend = Backend(slowCacheable)
+        proxy = Proxy(backend,cache=ResponseCache())
+        clients = [proxy.connect() for i in xrange(3)]
+        for client in clients:
+          client.send("GET /page HTTP/1.1\r\nHost: test\r\n\r\n")
+        for client in clients:
+          (resp,body) = client.response()
+          self.assertEqual(resp.respStatus,200)
+          self.assertEqual(body,"hello")
+          client.close()
+        self.assertEqual(len(backend.requests),1)
+        waitFor(lambda: not proxy.server.cache._inflight)
+        proxy.server.halt()
+        backend.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+from proxylet.lru import LRUCache, SizedLRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_and_put(self):
+        cache = LRUCache(4)
+        cache.put("a",1)
+        self.assertEqual(cache.get("a"),1)
+        self.assertEqual(cache.get("b"),None)
+        self.assertEqual(cache.get("b",2),2)
+        cache.put("a",3)
+        self.assertEqual(cache.get("a"),3)
+        self.assertEqual(len(cache),1)
+
+    def test_size_limit(self):
+        cache = LRUCache(8)
+        for i in xrange(100):
+          cache.put(i,i)
+          self.assertTrue(len(cache) <= 8)
+        self.assertTrue(99 in cache)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(4)
+        for key in "abcd":
+          cache.put(key,key)
+        cache.get("a")
+        cache.get("c")
+        cache.put("e","e")
+        self.assertEqual(sorted(cache._data),["a","c","d","e"])
+        cache.get("d")
+        cache.put("a","a")
+        cache.put("f","f")
+        self.assertEqual(sorted(cache._data),["a","d","e","f"])
+
+    def test_evicts_a_quarter(self):
+        cache = LRUCache(8)
+        for i in xrange(8):
+          cache.put(i,i)
+        cache.put(8,8)
+        self.assertEqual(sorted(cache._data),[2,3,4,5,6,7,8])
+
+    def test_zero_size(self):
+        cache = LRUCache(0)
+        cache.put("a",1)
+        self.assertEqual(len(cache),0)
+        self.assertEqual(cache.get("a"),None)
+
+
+class TestSizedLRUCache(unittest.TestCase):
+
+    def test_total_size(self):
+        cache = SizedLRUCache(100)
+        cache.put("a","x" * 30)
+        cache.put("b","x" * 20)
+        self.assertEqual(cache.total,50)
+        cache.put("a","x" * 10)
+        self.assertEqual(cache.total,30)
+        self.assertEqual(cache.pop("b"),"x" * 20)
+        self.assertEqual(cache.total,10)
+        cache.clear()
+        self.assertEqual(cache.total,0)
+
+    def test_evicts_least_recently_used(self):
+        cache = SizedLRUCache(100)
+        for key in "abcd":
+          cache.put(key,"x" * 25)
+        cache.get("a")
+        cache.put("e","x" * 25)
+        self.assertEqual(sorted(cache._data),["a","d","e"])
+        self.assertTrue(cache.total <= 75)
+
+    def test_value_too_large(self):
+        cache = SizedLRUCache(100)
+        cache.put("a","x" * 10)
+        cache.put("b","x" * 101)
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.total,10)
+
+
+if __name__ == "__main__":
+    unittest.main()
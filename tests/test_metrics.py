@@ -0,0 +1,96 @@
+import unittest
+
+from proxylet.metrics import Metrics, Counter, Histogram, routeLabel
+from proxylet.relocate import Relocator
+from proxylet.upstream import UpstreamGroup
+
+from tests.support import Backend, Proxy
+
+
+class TestRender(unittest.TestCase):
+
+    def _render(self,family):
+        metrics = Metrics()
+        metrics.families = [family]
+        return metrics.render().splitlines()
+
+    def test_help_and_type(self):
+        lines = self._render(Counter("hits_total","Number of hits.",("route",)))
+        self.assertEqual(lines,["# HELP hits_total Number of hits.",
+                                "# TYPE hits_total counter"])
+
+    def test_counter(self):
+        counter = Counter("hits_total","Number of hits.",("route","code"))
+        counter.inc(("b:80","200"))
+        counter.inc(("a:80","404"),3)
+        counter.inc(("b:80","200"))
+        self.assertEqual(self._render(counter)[2:],
+                         ['hits_total{route="a:80",code="404"} 3',
+                          'hits_total{route="b:80",code="200"} 2'])
+
+    def test_unlabelled(self):
+        counter = Counter("conns_total","Connections.")
+        counter.inc()
+        self.assertEqual(self._render(counter)[2:],["conns_total 1"])
+
+    def test_histogram_is_cumulative(self):
+        hist = Histogram("size","Sizes.",("route",),buckets=(10,1,5))
+        for value in (0.5,1,3,7,20,20):
+          hist.observe(("r",),value)
+        self.assertEqual(self._render(hist)[2:],
+                         ['size_bucket{route="r",le="1"} 2',
+                          'size_bucket{route="r",le="5"} 3',
+                          'size_bucket{route="r",le="10"} 4',
+                          'size_bucket{route="r",le="+Inf"} 6',
+                          'size_sum{route="r"} 51.5',
+                          'size_count{route="r"} 6'])
+
+    def test_label_escaping(self):
+        counter = Counter("hits_total","Number of hits.",("route",))
+        counter.inc(('a\\b"c\nd',))
+        self.assertEqual(self._render(counter)[2:],
+                         ['hits_total{route="a\\\\b\\"c\\nd"} 1'])
+
+
+class TestRouteLabel(unittest.TestCase):
+
+    def test_unmapped(self):
+        self.assertEqual(routeLabel(None),"none")
+
+    def test_host_and_port(self):
+        self.assertEqual(routeLabel(("backend",8080,None)),"backend:8080")
+
+    def test_relocator(self):
+        relocator = Relocator("http://localhost:8000/app/","http://backend:8080/real")
+        self.assertEqual(routeLabel(relocator.mapping),"http://localhost:8000/app")
+
+    def test_group(self):
+        group = UpstreamGroup([("127.0.0.1",1)],name="pool")
+        self.assertEqual(routeLabel((group,None,None)),"pool")
+
+
+class TestMetricsPath(unittest.TestCase):
+
+    def test_bypasses_mapper(self):
+        backend = Backend()
+        mapped = []
+        def mapper(req):
+          mapped.append(req.reqURI)
+          return ("127.0.0.1",backend.port,None)
+        metrics = Metrics()
+        proxy = Proxy(mapper=mapper,metrics=metrics)
+        client = proxy.connect()
+        (resp,body) = client.request("GET","/page")
+        (resp,body) = client.request("GET",metrics.path)
+        self.assertEqual(resp.respStatus,200)
+        self.assertEqual(mapped,["/page"])
+        self.assertEqual([uri for (_,uri,_) in backend.requests],["/page"])
+        route = "127.0.0.1:%d" % (backend.port,)
+        self.assertTrue('proxylet_requests_total{route="%s",code="200"} 1\n' % (route,) in body)
+        client.close()
+        proxy.server.halt()
+        backend.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+
+from eventlet import api
+
+from proxylet.engines import EventletEngine, getEngine, useEngine
+from proxylet.pool import ConnectionPool, PooledConnection, UpstreamLost, \
+                          REPLAY_LIMIT
+from proxylet.streams import StringStream, HTTPRequest, HTTPResponse
+
+from tests.support import Backend, Proxy, serveRequests
+
+
+def closeWhenReused(backend,stream,index):
+    """Serve one request on the first connection, then drop the next."""
+    if index > 0:
+      return serveRequests(backend,stream,index)
+    backend.read(stream)
+    stream.write("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+    backend.read(stream)
+
+
+class TestStaleConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = Backend(closeWhenReused)
+        self.proxy = Proxy(self.backend)
+        self.client = self.proxy.connect()
+        (resp,body) = self.client.request("GET","/")
+        self.assertEqual(resp.respStatus,200)
+
+    def tearDown(self):
+        self.client.close()
+        self.proxy.server.halt()
+        self.backend.close()
+
+    def test_idempotent_request_is_resent(self):
+        (resp,body) = self.client.request("GET","/again")
+        self.assertEqual(resp.respStatus,200)
+        self.assertEqual(body,"ok")
+        uris = [uri for (_,uri,_) in self.backend.requests]
+        self.assertEqual(uris,["/","/again","/again"])
+        self.assertEqual(self.backend.connections,2)
+
+    def test_post_is_not_resent(self):
+        (resp,body) = self.client.request("POST","/submit",body="data")
+        self.assertEqual(resp.respStatus,502)
+        posts = [r for r in self.backend.requests if r[0] == "POST"]
+        self.assertEqual(posts,[("POST","/submit","data")])
+        self.assertEqual(self.backend.connections,1)
+
+
+class SlowConnectEngine(EventletEngine):
+    """Engine that lets other threads run while it connects."""
+
+    def connect(self,address):
+        self.sleep(0.1)
+        return EventletEngine.connect(self,address)
+
+
+def closeFirst(backend,stream,index):
+    """Close the first connection at once, then serve requests."""
+    if index > 0:
+      return serveRequests(backend,stream,index)
+
+
+class TestResend(unittest.TestCase):
+
+    HEAD = "PUT /up HTTP/1.1\r\nHost: test\r\nContent-Length: %d\r\n\r\n"
+
+    def setUp(self):
+        self.backend = Backend(closeFirst)
+        address = ("127.0.0.1",self.backend.port)
+        sock = getEngine().connect(address)
+        self.conn = PooledConnection(ConnectionPool(),address,sock)
+        self.conn.allowReplay()
+        self.engine = getEngine()
+        useEngine(SlowConnectEngine())
+
+    def tearDown(self):
+        useEngine(self.engine)
+        self.conn.sock.close()
+        self.backend.close()
+
+    def _writeLater(self,data):
+        """Write data while the connection is being replaced."""
+        def write():
+          api.sleep(0.05)
+          self.conn.write(data)
+        api.spawn(write)
+
+    def test_write_during_reconnect_is_resent(self):
+        self.conn.write(self.HEAD % (4,))
+        self._writeLater("data")
+        resp = HTTPResponse(self.conn)
+        resp.parse()
+        self.assertEqual(resp.respStatus,200)
+        self.assertEqual(self.backend.requests,[("PUT","/up","data")])
+
+    def test_replay_abandoned_during_reconnect(self):
+        size = REPLAY_LIMIT + 1
+        self.conn.write(self.HEAD % (size,))
+        self._writeLater("x" * size)
+        self.assertRaises(UpstreamLost,self.conn.read,100)
+
+
+class TestReuse(unittest.TestCase):
+
+    def test_connection_reused_across_clients(self):
+        backend = Backend()
+        proxy = Proxy(backend)
+        for i in xrange(3):
+          client = proxy.connect()
+          (resp,body) = client.request("GET","/%d" % (i,))
+          self.assertEqual(body,"ok")
+          client.close()
+        self.assertEqual(backend.connections,1)
+        self.assertEqual(len(backend.requests),3)
+        proxy.server.halt()
+        backend.close()
+
+
+class TestCanReuse(unittest.TestCase):
+
+    def _response(self,protocol,headers=""):
+        req = HTTPRequest(StringStream("GET / %s\r\nHost: test\r\n%s\r\n" % (protocol,headers)))
+        resp = HTTPResponse(StringStream("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"),req)
+        "".join(resp)
+        return resp
+
+    def test_http11_request(self):
+        self.assertTrue(self._response("HTTP/1.1").canReuse())
+
+    def test_http11_request_asking_to_close(self):
+        self.assertFalse(self._response("HTTP/1.1","Connection: close\r\n").canReuse())
+
+    def test_http10_request(self):
+        self.assertFalse(self._response("HTTP/1.0").canReuse())
+
+    def test_http10_keepalive_request(self):
+        self.assertTrue(self._response("HTTP/1.0","Connection: keep-alive\r\n").canReuse())
+
+
+if __name__ == "__main__":
+    unittest.main()
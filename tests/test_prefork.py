@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from proxylet.metrics import Metrics
+from proxylet.prefork import PreforkServer, WorkerMetrics, _workerFile, \
+                             _saveSnapshot, _loadSnapshot
+
+
+def workerSnapshot(requests,connections):
+    """Get a snapshot of a worker's metrics with the given counts."""
+    metrics = Metrics()
+    metrics.requests.inc(("r","200"),requests)
+    metrics.duration.observe(("r",),0.01)
+    metrics.connections.inc((),connections)
+    return metrics.snapshot()
+
+
+class TestMerge(unittest.TestCase):
+
+    def test_adds_values(self):
+        total = Metrics()
+        total.merge(workerSnapshot(2,1))
+        total.merge(workerSnapshot(3,4))
+        self.assertEqual(total.requests.values,{("r","200"): 5})
+        self.assertEqual(total.connections.values,{(): 5})
+        self.assertEqual(total.duration.values[("r",)][-1],0.02)
+
+    def test_skips_gauges(self):
+        total = Metrics()
+        total.merge(workerSnapshot(2,1),gauges=False)
+        self.assertEqual(total.requests.values,{("r","200"): 2})
+        self.assertEqual(total.connections.values,{})
+
+
+class TestWorkerMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.statedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.statedir)
+
+    def _total(self,metrics):
+        for line in metrics.render().splitlines():
+          if line.startswith('proxylet_requests_total{route="r",code="200"}'):
+            return int(line.split()[-1])
+
+    def test_totals_over_workers(self):
+        _saveSnapshot(_workerFile(self.statedir,1),workerSnapshot(3,1))
+        _saveSnapshot(_workerFile(self.statedir,2),workerSnapshot(4,1))
+        metrics = WorkerMetrics(self.statedir,0)
+        metrics.requests.inc(("r","200"),2)
+        self.assertEqual(self._total(metrics),9)
+        metrics.save()
+        metrics.requests.inc(("r","200"))
+        self.assertEqual(self._total(metrics),10)
+
+    def test_retired_workers(self):
+        server = PreforkServer("127.0.0.1",0,None,workers=2)
+        retired = Metrics()
+        for count in (3,4):
+          _saveSnapshot(_workerFile(self.statedir,1),workerSnapshot(count,2))
+          server._retire(self.statedir,1,retired)
+        snapshot = _loadSnapshot(os.path.join(self.statedir,"retired"))
+        self.assertEqual(snapshot["proxylet_requests_total"],{("r","200"): 7})
+        self.assertEqual(snapshot["proxylet_active_connections"],{})
+        metrics = WorkerMetrics(self.statedir,0)
+        metrics.requests.inc(("r","200"))
+        self.assertEqual(self._total(metrics),8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import zlib
+import unittest
+
+from proxylet.relocate import Relocator, DAVRelocator, UrlInfo, _RewritePlan
+from proxylet.streams import StringStream, HTTPRequest, HTTPResponse
+
+
+LOCAL = "http://localhost:8000/app"
+REMOTE = "http://backend:8080/real"
+
+ENTRY = "<D:response><D:href>http://backend:8080/real/file</D:href></D:response>"
+BODY = '<?xml version="1.0"?><D:multistatus xmlns:D="DAV:">%s</D:multistatus>' % (ENTRY * 50,)
+
+
+class TestRelocator(unittest.TestCase):
+
+    def _propfind(self,relocator):
+        req = HTTPRequest(StringStream("PROPFIND /app/ HTTP/1.1\r\nHost: localhost:8000\r\nAccept-Encoding: gzip\r\n\r\n"))
+        resp = HTTPResponse(StringStream("HTTP/1.1 207 Multi-Status\r\nContent-Type: text/xml\r\nContent-Length: %d\r\n\r\n%s" % (len(BODY),BODY)),req)
+        (req,resp) = relocator(req,resp)
+        data = "".join(resp)
+        return data.split("\r\n\r\n",1)
+
+    def test_mapping(self):
+        relocator = Relocator(LOCAL,REMOTE)
+        self.assertEqual(relocator.mapping[:2],("backend",8080))
+        self.assertEqual(relocator.rewriteRemote(REMOTE + "/x"),LOCAL + "/x")
+        self.assertEqual(relocator.rewriteLocal(LOCAL + "/x"),REMOTE + "/x")
+
+    def test_not_compressed_by_default(self):
+        (head,body) = self._propfind(DAVRelocator(LOCAL,REMOTE))
+        self.assertFalse("Content-Encoding" in head)
+        self.assertEqual(body.count("http://localhost:8000/app/file"),50)
+
+    def test_compress(self):
+        relocator = DAVRelocator(LOCAL,REMOTE)
+        relocator.compress = True
+        (head,body) = self._propfind(relocator)
+        self.assertTrue("Content-Encoding: gzip\r\n" in head)
+        if "Transfer-Encoding: chunked" in head:
+          chunks = []
+          while True:
+            (size,body) = body.split("\r\n",1)
+            size = int(size,16)
+            if not size:
+              break
+            chunks.append(body[:size])
+            body = body[size + 2:]
+          body = "".join(chunks)
+        body = zlib.decompress(body,16 + zlib.MAX_WBITS)
+        self.assertEqual(body.count("http://localhost:8000/app/file"),50)
+
+
+ROOTS = ["http://localhost:8000/app","http://backend:8080/real/",
+         "http://backend:8080","https://secure.example.com/a/b"]
+
+URLS = ["","/","/app","/app/","/app/x","/apple","/app?q=1","/real","/real/x",
+        "/realm","/a/b/c","/a/bc","//x","localhost","backend","backend:8080",
+        "http://localhost:8000","http://localhost:8000/","http://localhost:8000/app",
+        "http://localhost:8000/app/x","http://localhost:8000/apple",
+        "http://backend:8080","http://backend:8080/","http://backend:8080/real",
+        "http://backend:8080/real/x","http://backend:8080/realm",
+        "http://backend:80800/real","https://secure.example.com/a/b/c",
+        "https://secure.example.com/a/bc","secure.example.com"]
+
+
+class TestRewritePlan(unittest.TestCase):
+
+    def test_same_as_rewrite(self):
+        relocator = Relocator(LOCAL,REMOTE)
+        for inRoot in ROOTS:
+          for outRoot in ROOTS:
+            (inU,outU) = (UrlInfo(inRoot),UrlInfo(outRoot))
+            plan = _RewritePlan(inU,outU,8)
+            for url in URLS * 2:
+              expected = relocator._rewrite(url,inU,outU)
+              self.assertEqual(plan(url),expected,(inRoot,outRoot,url))
+
+
+if __name__ == "__main__":
+    unittest.main()
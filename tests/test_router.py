@@ -0,0 +1,95 @@
+import unittest
+
+from proxylet.relocate import Relocator
+from proxylet.router import Router
+from proxylet.streams import StringStream, HTTPRequest
+
+from tests.support import Backend, Proxy
+
+
+def request(uri,host="www.example.com"):
+    return HTTPRequest(StringStream("GET %s HTTP/1.1\r\nHost: %s\r\n\r\n" % (uri,host)))
+
+
+class TestRouter(unittest.TestCase):
+
+    def test_longest_prefix(self):
+        router = Router()
+        router.addRoute("/","root",80)
+        router.addRoute("/svn","svn",80)
+        router.addRoute("/svn/trunk","trunk",80)
+        self.assertEqual(router(request("/svn/trunk/x"))[0],"trunk")
+        self.assertEqual(router(request("/svn/branches"))[0],"svn")
+        self.assertEqual(router(request("/svn?rev=1"))[0],"svn")
+        self.assertEqual(router(request("/other"))[0],"root")
+
+    def test_whole_segments(self):
+        router = Router()
+        router.addRoute("/svn","svn",80)
+        self.assertEqual(router(request("/svnroot")),None)
+        self.assertEqual(router(request("/svn/"))[0],"svn")
+
+    def test_host_route_beats_longer_path(self):
+        router = Router()
+        router.addRoute("/a/b/c","bare",80)
+        router.addRoute("http://www.example.com/a","vhost",80)
+        self.assertEqual(router(request("/a/b/c/d"))[0],"vhost")
+        self.assertEqual(router(request("/a/b/c/d","other.com"))[0],"bare")
+
+    def test_fallback_to_bare_routes(self):
+        router = Router()
+        router.addRoute("/files","files",80)
+        router.addRoute("http://www.example.com/app","app",80)
+        self.assertEqual(router(request("/files/x"))[0],"files")
+        self.assertEqual(router(request("/nothing")),None)
+
+    def test_host_matching(self):
+        router = Router()
+        router.addRoute("http://www.example.com/app","app",80)
+        self.assertEqual(router(request("/app","WWW.Example.com:8000"))[0],"app")
+        self.assertEqual(router(request("http://www.example.com/app/x","other.com"))[0],"app")
+        self.assertEqual(router(request("/app","other.com")),None)
+
+    def test_relocator_is_host_specific(self):
+        relocator = Relocator("http://www.example.com/svn","http://svn.example.com/")
+        router = Router()
+        router.addRelocator(relocator)
+        self.assertTrue(router(request("/svn/trunk")) is relocator.mapping)
+        self.assertEqual(router(request("/svn/trunk","other.com")),None)
+        self.assertTrue(relocator.matchesLocal("/svn/trunk"))
+
+    def test_relocator_any_host(self):
+        relocator = Relocator("http://www.example.com/svn","http://svn.example.com/")
+        router = Router()
+        router.addRelocator(relocator,anyHost=True)
+        self.assertTrue(router(request("/svn/trunk","other.com")) is relocator.mapping)
+
+    def test_cache_cleared_by_new_routes(self):
+        router = Router(cache_size=10)
+        router.addRoute("/a","first",80)
+        self.assertEqual(router(request("/a/b"))[0],"first")
+        self.assertEqual(router(request("/a/b"))[0],"first")
+        router.addRoute("/a/b","second",80)
+        self.assertEqual(router(request("/a/b"))[0],"second")
+
+
+class TestRouterAsMapper(unittest.TestCase):
+
+    def test_routes_and_not_found(self):
+        backend = Backend()
+        router = Router()
+        router.addRoute("/app","127.0.0.1",backend.port)
+        proxy = Proxy(mapper=router)
+        client = proxy.connect()
+        (resp,body) = client.request("GET","/app/page")
+        self.assertEqual(body,"ok")
+        (resp,body) = client.request("GET","/elsewhere")
+        self.assertEqual(resp.respStatus,404)
+        self.assertEqual([uri for (_,uri,_) in backend.requests],["/app/page"])
+        client.close()
+        proxy.server.halt()
+        backend.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+import time
+import socket
+import unittest
+
+from eventlet import api
+
+from proxylet.engines import getEngine
+from proxylet.metrics import Metrics
+from proxylet.streams import HTTPRequest
+
+from tests.support import Backend, Proxy, listen, waitFor
+
+
+def slowAnswer(backend,stream,index):
+    """Answer each request after a short delay."""
+    while True:
+      backend.read(stream)
+      api.sleep(0.2)
+      stream.write("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+
+class TestDrain(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = Backend(slowAnswer)
+        self.proxy = Proxy(self.backend)
+
+    def tearDown(self):
+        self.backend.close()
+
+    def _drain(self):
+        start = time.time()
+        self.proxy.server.drain(timeout=5)
+        waitFor(lambda: self.proxy.returned is not None)
+        self.assertEqual(self.proxy.errors,[])
+        return self.proxy.returned - start
+
+    def test_idle_connection(self):
+        client = self.proxy.connect()
+        (resp,body) = client.request("GET","/")
+        self.assertEqual(resp.respStatus,200)
+        self.assertTrue(self._drain() < 1)
+        self.assertEqual(client.sock.recv(1),"")
+        client.close()
+
+    def test_response_in_flight(self):
+        client = self.proxy.connect()
+        client.send("GET / HTTP/1.1\r\nHost: test\r\n\r\n")
+        waitFor(lambda: self.backend.requests)
+        start = time.time()
+        self.proxy.server.drain(timeout=5)
+        (resp,body) = client.response()
+        self.assertEqual(body,"ok")
+        self.assertEqual(client.sock.recv(1),"")
+        waitFor(lambda: self.proxy.returned is not None)
+        self.assertTrue(self.proxy.returned - start < 1)
+        client.close()
+
+    def test_closed_connection(self):
+        client = self.proxy.connect()
+        client.request("GET","/")
+        client.close()
+        waitFor(lambda: not self.proxy.server._dispatchers)
+        self.assertTrue(self._drain() < 1)
+
+    def test_no_connections(self):
+        self.assertTrue(self._drain() < 1)
+
+
+def chunkedAnswer(backend,stream,index):
+    """Answer each request with a chunked body carrying a trailer."""
+    while True:
+      backend.read(stream)
+      stream.write("HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+      stream.write("5\r\nhello\r\n")
+      stream.write("6\r\n world\r\n0\r\nX-Check: 42\r\n\r\n")
+
+
+def continueFirst(backend,stream,index):
+    """Send "100 Continue" before reading each request body."""
+    while True:
+      req = HTTPRequest(stream)
+      stream.write("HTTP/1.1 100 Continue\r\n\r\n")
+      body = "".join(req.body)
+      backend.requests.append((req.reqMethod,req.reqURI,body))
+      stream.write("HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body),body))
+
+
+class TestRelay(unittest.TestCase):
+
+    def test_continue_forwarded_before_body(self):
+        backend = Backend(continueFirst)
+        proxy = Proxy(backend)
+        client = proxy.connect()
+        client.send("PUT /up HTTP/1.1\r\nHost: test\r\nExpect: 100-continue\r\nContent-Length: 4\r\n\r\n")
+        client.sock.settimeout(1)
+        data = ""
+        while not data.endswith("\r\n\r\n"):
+          data += client.sock.recv(100)
+        client.sock.settimeout(None)
+        self.assertEqual(data,"HTTP/1.1 100 Continue\r\n\r\n")
+        client.send("data")
+        (resp,body) = client.response("PUT")
+        self.assertEqual(resp.respStatus,200)
+        self.assertEqual(body,"data")
+        client.close()
+        proxy.server.halt()
+        backend.close()
+
+    def test_chunked_with_trailers(self):
+        backend = Backend(chunkedAnswer)
+        proxy = Proxy(backend)
+        client = proxy.connect()
+        for i in xrange(2):
+          (resp,body) = client.request("GET","/")
+          self.assertEqual(body,"hello world")
+          self.assertTrue(resp.chunked)
+          self.assertEqual(resp.trailers,[("X-Check","42")])
+        client.close()
+        proxy.server.halt()
+        backend.close()
+
+    def test_pipelined_requests(self):
+        backend = Backend()
+        proxy = Proxy(backend)
+        client = proxy.connect()
+        client.send("".join(["GET /%d HTTP/1.1\r\nHost: test\r\n\r\n" % (i,) for i in xrange(3)]))
+        for i in xrange(3):
+          (resp,body) = client.response()
+          self.assertEqual(body,"ok")
+        self.assertEqual(sorted([uri for (_,uri,_) in backend.requests]),["/0","/1","/2"])
+        client.close()
+        proxy.server.halt()
+        backend.close()
+
+
+class TestUpstreamErrors(unittest.TestCase):
+
+    def test_connection_refused(self):
+        (sock,port) = listen()
+        sock.close()
+        metrics = Metrics()
+        proxy = Proxy(mapper=lambda req: ("127.0.0.1",port,None),metrics=metrics)
+        client = proxy.connect()
+        (resp,body) = client.request("GET","/")
+        self.assertEqual(resp.respStatus,502)
+        self.assertEqual(metrics.errors.values,{("127.0.0.1:%d" % (port,),"upstream_connect"): 1})
+        client.close()
+        proxy.server.halt()
+
+
+class TestSockets(unittest.TestCase):
+
+    def _noDelay(self,sock):
+        return sock.getsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY)
+
+    def test_nodelay(self):
+        backend = Backend()
+        proxy = Proxy(backend)
+        client = proxy.connect()
+        client.request("GET","/")
+        (d,) = proxy.server._dispatchers
+        self.assertTrue(self._noDelay(d._sock))
+        upstream = getEngine().connect(("127.0.0.1",backend.port))
+        self.assertTrue(self._noDelay(upstream))
+        upstream.close()
+        client.close()
+        proxy.server.halt()
+        backend.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
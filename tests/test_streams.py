@@ -0,0 +1,267 @@
+import re
+import unittest
+
+from paste import httpheaders as hdr
+
+from proxylet import buffers
+from proxylet.streams import Headers, HeadParser, ChunkParser, \
+                             HTTPParseError, HTTPRewriter, HTTPRequest, \
+                             HTTPResponse, StringStream, GeneratorStream, \
+                             RegexRewriter, XMLRewriter
+
+
+class Upper(HTTPRewriter):
+    """Upper-case the body, failing after 'fail' chunks if given."""
+
+    fail = None
+
+    def rwBody(self,body):
+        for (i,chunk) in enumerate(body):
+          if i == self.fail:
+            raise IOError("rewriting failed")
+          yield chunk.upper()
+
+
+class TestHeaders(unittest.TestCase):
+
+    def setUp(self):
+        self.fields = Headers([("Host","example.com"),("Accept","a"),
+                               ("Accept","b"),("X-Other","1")])
+
+    def test_lookups(self):
+        fields = self.fields
+        self.assertTrue("host" in fields)
+        self.assertEqual(fields.get("ACCEPT"),"a")
+        self.assertEqual(fields.getall("accept"),["a","b"])
+        self.assertEqual(fields.get("missing","x"),"x")
+
+    def test_index_kept_through_changes(self):
+        fields = self.fields
+        fields.get("host")
+        index = fields._index
+        fields.add("Accept","c")
+        fields.set("Host","example.org")
+        fields.add("Via","proxylet")
+        self.assertTrue(fields._index is index)
+        self.assertEqual(fields.getall("accept"),["a","b","c"])
+        self.assertEqual(fields.get("host"),"example.org")
+        self.assertEqual(fields.get("via"),"proxylet")
+
+    def test_set_and_remove_duplicates(self):
+        fields = self.fields
+        fields.set("accept","c")
+        self.assertEqual(fields.items,[("Host","example.com"),("Accept","c"),
+                                       ("X-Other","1")])
+        self.assertEqual(fields.get("x-other"),"1")
+        fields.remove("HOST")
+        self.assertEqual(fields.get("host"),None)
+        self.assertEqual(fields.get("x-other"),"1")
+        self.assertEqual(fields.get("accept"),"c")
+
+    def test_invalidate(self):
+        fields = self.fields
+        fields.get("host")
+        hdr.HOST.update(fields.items,"example.net")
+        hdr.ACCEPT.delete(fields.items)
+        fields.invalidate()
+        self.assertEqual(fields.get("host"),"example.net")
+        self.assertEqual(fields.get("x-other"),"1")
+        self.assertFalse("accept" in fields)
+
+
+class TestHeadParser(unittest.TestCase):
+
+    HEAD = "GET /path HTTP/1.1\r\nHost: test\r\nX-Long: a\r\n  b\r\n\r\n"
+
+    def test_split_across_pieces(self):
+        parser = HeadParser(True)
+        data = self.HEAD + "body"
+        for i in xrange(len(self.HEAD) - 1):
+          self.assertEqual(parser.feed(data[i]),None)
+        self.assertEqual(parser.feed(data[len(self.HEAD) - 1:]),1)
+        self.assertEqual(parser.bits,("GET","/path","HTTP/1.1"))
+        self.assertEqual(parser.headers,[("Host","test"),("X-Long","a b")])
+        self.assertEqual(parser.headline,"GET /path HTTP/1.1\r\n")
+        self.assertEqual(parser.sepline,"\r\n")
+
+    def test_status_line(self):
+        parser = HeadParser(False)
+        used = parser.feed("HTTP/1.0 404 Not Found\n\nrest")
+        self.assertEqual(used,len("HTTP/1.0 404 Not Found\n\n"))
+        self.assertEqual(parser.bits,("HTTP/1.0",404,"Not Found"))
+
+    def _error(self,data,**kwds):
+        parser = HeadParser(True,**kwds)
+        try:
+          parser.feed(data)
+        except HTTPParseError, e:
+          return e.status
+        self.fail("no error for %r" % (data,))
+
+    def test_errors(self):
+        self.assertEqual(self._error("GET /\r\n\r\n"),400)
+        self.assertEqual(self._error("GET / HTTP/1.1\r\nBad Name: x\r\n\r\n"),400)
+        self.assertEqual(self._error(self.HEAD,max_headers=1),431)
+        self.assertEqual(self._error("GET /" + "x" * 100,max_size=64),414)
+        self.assertEqual(self._error(self.HEAD,max_size=40),431)
+
+
+class TestChunkParser(unittest.TestCase):
+
+    BODY = "3\r\nabc\r\n10;ext=1\r\n0123456789abcdef\r\n0\r\nX-Sum: 1\r\n\r\n"
+
+    def test_split_across_pieces(self):
+        parser = ChunkParser()
+        data = self.BODY + "next"
+        out = []
+        for i in xrange(len(data)):
+          (pieces,used) = parser.feed(data[i])
+          for (start,end) in pieces:
+            out.append(data[i][start:end])
+          if parser.done:
+            break
+        self.assertEqual(i,len(self.BODY) - 1)
+        self.assertEqual(used,1)
+        self.assertEqual("".join(out),"abc0123456789abcdef")
+        self.assertEqual(parser.trailers,[("X-Sum","1")])
+
+    def test_whole_body(self):
+        parser = ChunkParser()
+        (pieces,used) = parser.feed(self.BODY + "next")
+        self.assertTrue(parser.done)
+        self.assertEqual(used,len(self.BODY))
+        self.assertEqual(len(pieces),2)
+
+    def test_bad_size(self):
+        self.assertRaises(HTTPParseError,ChunkParser().feed,"zz\r\nabc\r\n")
+
+    def test_missing_chunk_end(self):
+        self.assertRaises(HTTPParseError,ChunkParser().feed,"3\r\nabcdef\r\n")
+
+
+class TestRewriters(unittest.TestCase):
+
+    def test_regex_across_chunks(self):
+        class Chunks(GeneratorStream):
+            def _generateLines(self):
+                yield "aaa http://rem"
+                yield "ote/x bbb"
+        rw = RegexRewriter(Chunks(None),re.compile("http://remote/"),"/local/",window=16)
+        self.assertEqual("".join(rw),"aaa /local/x bbb")
+
+    def test_xml_untouched_parts_copied(self):
+        doc = ("<?xml version='1.0'?>\n<!-- note -->\n"
+               "<D:multistatus xmlns:D='DAV:'  >"
+               "<D:href>http://remote/a</D:href>"
+               "<D:prop attr = \"v\"/>"
+               "<D:href>http://other/b</D:href>"
+               "</D:multistatus>\n")
+        rw = XMLRewriter(StringStream(doc))
+        rw.rewrite = lambda url: url.replace("http://remote/","http://local/")
+        rw.rw_content["D:href"] = True
+        self.assertEqual("".join(rw),doc.replace("http://remote/","http://local/"))
+
+
+class TestFraming(unittest.TestCase):
+
+    def _request(self,headers,body=""):
+        return HTTPRequest(StringStream("POST / HTTP/1.1\r\nHost: test\r\n%s\r\n%s" % (headers,body)))
+
+    def test_chunked_overrides_content_length(self):
+        req = self._request("Content-Length: 4\r\nTransfer-Encoding: chunked\r\n",
+                            "3\r\nabc\r\n0\r\n\r\nGET /next HTTP/1.1\r\n")
+        self.assertTrue(req.valid)
+        self.assertTrue(req.chunked)
+        data = "".join(req)
+        self.assertFalse("Content-Length" in data)
+        self.assertTrue(data.endswith("\r\n\r\n3\r\nabc\r\n0\r\n\r\n"))
+        self.assertEqual(req.stream.read(),"GET /next HTTP/1.1\r\n")
+
+    def test_request_not_ending_in_chunked(self):
+        req = self._request("Transfer-Encoding: chunked, gzip\r\nContent-Length: 4\r\n","abcd")
+        self.assertFalse(req.valid)
+        self.assertEqual(req.error.status,400)
+
+    def test_conflicting_content_lengths(self):
+        req = self._request("Content-Length: 4\r\nContent-Length: 5\r\n","abcde")
+        self.assertFalse(req.valid)
+        self.assertEqual(req.error.status,400)
+
+    def test_repeated_content_length(self):
+        req = self._request("Content-Length: 4\r\nContent-Length: 4\r\n","abcd")
+        self.assertTrue(req.valid)
+        self.assertEqual("".join(req.body),"abcd")
+
+    def test_response_with_both(self):
+        resp = HTTPResponse(StringStream("HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nContent-Length: 10\r\n\r\n2\r\nok\r\n0\r\n\r\n"))
+        data = "".join(resp)
+        self.assertFalse("Content-Length" in data)
+        self.assertEqual("".join(resp.body),"")
+        self.assertTrue(data.endswith("2\r\nok\r\n0\r\n\r\n"))
+
+
+class Pieces(GeneratorStream):
+
+    def _generateLines(self):
+        yield "abcdef"
+        yield "gh"
+
+
+class TestGeneratorStream(unittest.TestCase):
+
+    def test_readline_size(self):
+        stream = Pieces(None)
+        self.assertEqual(stream.readline(4),"abcd")
+        self.assertEqual(stream.readline(),"ef")
+        self.assertEqual(stream.readline(1),"g")
+        self.assertEqual(list(stream),["h"])
+        self.assertEqual(stream.readline(),"")
+
+
+class TestHTTPRewriter(unittest.TestCase):
+
+    def test_fields_see_rewritten_headers(self):
+        class SetHost(HTTPRewriter):
+            def rwHeaders(self,headers):
+                hdr.HOST.update(headers,"backend")
+        req = HTTPRequest(StringStream("GET / HTTP/1.1\r\nHost: test\r\n\r\n"))
+        self.assertEqual(req.fields.get("host"),"test")
+        data = "".join(SetHost(req))
+        self.assertEqual(req.fields.get("host"),"backend")
+        self.assertTrue("Host: backend\r\n" in data)
+
+    def _rewriter(self,fail=None):
+        req = HTTPRequest(StringStream("GET / HTTP/1.0\r\nHost: test\r\n\r\n"))
+        body = "abc" * 1000
+        resp = HTTPResponse(StringStream("HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body),body)),req)
+        resp.blocksize = 100
+        rewriter = Upper(resp)
+        rewriter.fail = fail
+        return rewriter
+
+    def test_spooled_body(self):
+        used = buffers.memoryBudget.used
+        data = "".join(self._rewriter())
+        self.assertTrue(data.endswith("\r\n\r\n" + "ABC" * 1000))
+        self.assertTrue("Content-Length: 3000\r\n" in data)
+        self.assertEqual(buffers.memoryBudget.used,used)
+
+    def test_spool_released_on_error(self):
+        used = buffers.memoryBudget.used
+        lines = iter(self._rewriter(fail=5))
+        lines.next()
+        self.assertRaises(IOError,lines.next)
+        self.assertEqual(buffers.memoryBudget.used,used)
+
+    def test_spool_released_on_disconnect(self):
+        used = buffers.memoryBudget.used
+        lines = iter(self._rewriter())
+        lines.next()
+        lines.next()
+        self.assertTrue(buffers.memoryBudget.used > used)
+        lines.close()
+        self.assertEqual(buffers.memoryBudget.used,used)
+
+
+if __name__ == "__main__":
+    unittest.main()
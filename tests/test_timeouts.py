@@ -0,0 +1,147 @@
+import socket
+import unittest
+
+from eventlet import api
+
+from proxylet.metrics import Metrics
+from proxylet.streams import HTTPRequest
+from proxylet.timeouts import Timeouts
+
+from tests.support import Backend, Proxy, waitFor
+
+
+def echoBody(backend,stream,index):
+    """Answer each request with its own body."""
+    while True:
+      backend.read(stream)
+      body = backend.requests[-1][2]
+      stream.write("HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body),body))
+
+
+def neverAnswer(backend,stream,index):
+    """Read a request, then wait for the connection to be closed."""
+    backend.read(stream)
+    stream.read()
+
+
+class TestFirstByteTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = None
+        self.proxy = None
+
+    def tearDown(self):
+        self.proxy.server.halt()
+        self.backend.close()
+
+    def _start(self,handler):
+        self.backend = Backend(handler)
+        self.proxy = Proxy(self.backend,timeouts=Timeouts(first_byte=0.2))
+        return self.proxy.connect()
+
+    def test_slow_upload(self):
+        client = self._start(echoBody)
+        client.send("POST /up HTTP/1.1\r\nHost: test\r\nContent-Length: 10\r\n\r\n")
+        for piece in ("ab","cd","ef","gh","ij"):
+          api.sleep(0.1)
+          client.send(piece)
+        (resp,body) = client.response("POST")
+        self.assertEqual(resp.respStatus,200)
+        self.assertEqual(body,"abcdefghij")
+        client.close()
+
+    def test_slow_response(self):
+        client = self._start(neverAnswer)
+        (resp,body) = client.request("POST","/up",body="data")
+        self.assertEqual(resp.respStatus,504)
+        client.close()
+
+
+class TestClientTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = Backend()
+        self.proxy = Proxy(self.backend,timeouts=Timeouts(header=0.2,keepalive=0.2))
+        self.client = self.proxy.connect()
+
+    def tearDown(self):
+        self.client.close()
+        self.proxy.server.halt()
+        self.backend.close()
+
+    def test_slow_head(self):
+        self.client.send("GET / HTTP/1.1\r\nHo")
+        (resp,body) = self.client.response()
+        self.assertEqual(resp.respStatus,408)
+        self.assertEqual(self.client.sock.recv(1),"")
+
+    def test_idle_connection(self):
+        (resp,body) = self.client.request("GET","/")
+        self.assertEqual(resp.respStatus,200)
+        api.sleep(0.4)
+        self.assertEqual(self.client.sock.recv(1),"")
+
+
+#  Enough data to fill the socket buffers between the proxy and its peers.
+LARGE = 64 * 1024 * 1024
+BLOCK = "x" * (64 * 1024)
+
+
+def largeAnswer(backend,stream,index):
+    """Answer a request with a body too large to be buffered."""
+    backend.read(stream)
+    stream.write("HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % (LARGE,))
+    for i in xrange(LARGE / len(BLOCK)):
+      stream.write(BLOCK)
+
+
+def neverRead(backend,stream,index):
+    """Read a request head, then stop reading."""
+    HTTPRequest(stream)
+    api.sleep(2)
+
+
+class TestSendTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = None
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        self.proxy.server.halt()
+        self.backend.close()
+
+    def _start(self,handler):
+        self.backend = Backend(handler)
+        self.proxy = Proxy(self.backend,timeouts=Timeouts(send=0.2),
+                           metrics=self.metrics)
+        return self.proxy.connect()
+
+    def _sendTimeouts(self):
+        values = self.metrics.timeouts.values
+        return sum([n for ((route,kind),n) in values.items() if kind == "send"])
+
+    def test_client_not_reading(self):
+        client = self._start(largeAnswer)
+        client.send("GET / HTTP/1.1\r\nHost: test\r\n\r\n")
+        waitFor(lambda: self._sendTimeouts() == 1)
+        waitFor(lambda: not self.proxy.server._dispatchers)
+        client.close()
+
+    def test_upstream_not_reading(self):
+        client = self._start(neverRead)
+        def upload():
+          client.send("PUT / HTTP/1.1\r\nHost: test\r\nContent-Length: %d\r\n\r\n" % (LARGE,))
+          try:
+            for i in xrange(LARGE / len(BLOCK)):
+              client.send(BLOCK)
+          except socket.error:
+            pass
+        api.spawn(upload)
+        waitFor(lambda: self._sendTimeouts() == 1)
+        waitFor(lambda: not self.proxy.server._dispatchers)
+        client.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
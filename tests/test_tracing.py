@@ -0,0 +1,48 @@
+import unittest
+
+from proxylet.metrics import Metrics
+from proxylet.tracing import Tracer
+
+from tests.support import Backend, Proxy, waitFor
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.spans = []
+        self.backend = Backend()
+
+    def tearDown(self):
+        self.proxy.server.halt()
+        self.backend.close()
+
+    def _get(self,**kwds):
+        self.proxy = Proxy(self.backend,tracer=Tracer([self.spans.append]),**kwds)
+        client = self.proxy.connect()
+        (resp,body) = client.request("GET","/traced")
+        client.close()
+        self.assertEqual(body,"ok")
+        waitFor(lambda: self.spans)
+        return self.spans[0]
+
+    def test_stages(self):
+        span = self._get()
+        self.assertEqual((span.method,span.uri,span.status),("GET","/traced",200))
+        self.assertEqual(span.error,None)
+        stages = [stage for (stage,_) in span.marks]
+        for stage in ("map","connect","request_sent","dequeue",
+                      "upstream_first_byte","response_head","first_write"):
+          self.assertTrue(stage in stages,stage)
+        self.assertTrue(stages.index("response_head") < stages.index("first_write"))
+        for stage in ("upstream_read","client_write","rewrite"):
+          self.assertTrue(stage in span.totals,stage)
+
+    def test_with_metrics(self):
+        metrics = Metrics()
+        span = self._get(metrics=metrics)
+        self.assertEqual(span.status,200)
+        self.assertTrue('code="200"' in metrics.render())
+
+
+if __name__ == "__main__":
+    unittest.main()
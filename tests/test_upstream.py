@@ -0,0 +1,182 @@
+import time
+import socket
+import unittest
+
+from eventlet import api
+
+from proxylet.pool import ConnectionPool
+from proxylet.streams import StringStream, HTTPRequest
+from proxylet.upstream import UpstreamGroup
+
+from tests.support import Backend, listen
+
+
+def request(uri="/"):
+    return HTTPRequest(StringStream("GET %s HTTP/1.1\r\nHost: test\r\n\r\n" % (uri,)))
+
+
+def closedPort():
+    """Get a port that nothing is listening on."""
+    (sock,port) = listen()
+    sock.close()
+    return port
+
+
+class GroupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.backends = [Backend() for i in xrange(3)]
+        self.servers = [("127.0.0.1",b.port) for b in self.backends]
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        for backend in self.backends:
+          backend.close()
+
+    def _group(self,servers=None,**kwds):
+        if servers is None:
+          servers = self.servers
+        kwds.setdefault("health_interval",0)
+        return UpstreamGroup(servers,**kwds)
+
+    def _checkout(self,group,uri="/"):
+        return group.checkout(self.pool,request(uri))
+
+
+class TestSelection(GroupTestCase):
+
+    def test_round_robin(self):
+        group = self._group()
+        chosen = []
+        for i in xrange(6):
+          conn = self._checkout(group)
+          chosen.append(conn.address)
+          conn.release()
+        self.assertEqual(chosen,self.servers * 2)
+
+    def test_least_outstanding(self):
+        group = self._group(policy="least_outstanding")
+        held = [self._checkout(group) for i in xrange(3)]
+        self.assertEqual(sorted([c.address for c in held]),sorted(self.servers))
+        held[1].release()
+        conn = self._checkout(group)
+        self.assertEqual(conn.address,held[1].address)
+        for c in held + [conn]:
+          c.release()
+        self.assertEqual([m.outstanding for m in group.members],[0,0,0])
+
+    def test_consistent_hash(self):
+        group = self._group(policy="consistent_hash")
+        chosen = {}
+        for uri in ["/%d" % (i,) for i in xrange(20)]:
+          for i in xrange(3):
+            conn = self._checkout(group,uri)
+            chosen.setdefault(uri,set()).add(conn.address)
+            conn.release()
+        for addresses in chosen.values():
+          self.assertEqual(len(addresses),1)
+        self.assertTrue(len(set([a for s in chosen.values() for a in s])) > 1)
+
+    def test_consistent_hash_skips_ejected(self):
+        group = self._group(policy="consistent_hash",max_fails=1)
+        conn = self._checkout(group,"/page")
+        first = conn.address
+        conn.release(False,500)
+        conn = self._checkout(group,"/page")
+        self.assertNotEqual(conn.address,first)
+        conn.release()
+        for member in group.members:
+          member.ejectedUntil = 0
+        conn = self._checkout(group,"/page")
+        self.assertEqual(conn.address,first)
+        conn.release()
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError,UpstreamGroup,self.servers,"random")
+
+
+class TestFailover(GroupTestCase):
+
+    def test_next_server_tried(self):
+        down = ("127.0.0.1",closedPort())
+        group = self._group([down] + self.servers[:1],max_fails=2)
+        conn = self._checkout(group)
+        self.assertEqual(conn.address,self.servers[0])
+        conn.release()
+        self.assertEqual(group.members[0].failures,1)
+
+    def test_all_servers_down(self):
+        servers = [("127.0.0.1",closedPort()) for i in xrange(2)]
+        group = self._group(servers)
+        self.assertRaises(socket.error,self._checkout,group)
+        self.assertEqual([m.failures for m in group.members],[1,1])
+
+
+class TestEjection(GroupTestCase):
+
+    def test_ejected_after_errors(self):
+        group = self._group(max_fails=2,eject_time=0.2)
+        bad = group.members[0]
+        for i in xrange(2):
+          conn = self._checkout(group)
+          while conn.address != bad.address:
+            conn.release()
+            conn = self._checkout(group)
+          conn.release(False,503)
+        self.assertFalse(bad.available(time.time()))
+        for i in xrange(4):
+          conn = self._checkout(group)
+          self.assertNotEqual(conn.address,bad.address)
+          conn.release()
+        api.sleep(0.2)
+        self.assertTrue(bad.available(time.time()))
+
+    def test_success_resets_failures(self):
+        group = self._group(self.servers[:1],max_fails=2)
+        conn = self._checkout(group)
+        conn.release(False,502)
+        conn = self._checkout(group)
+        conn.release(True,200)
+        self.assertEqual(group.members[0].failures,0)
+
+    def test_all_ejected_still_used(self):
+        group = self._group(self.servers[:1],max_fails=1)
+        conn = self._checkout(group)
+        conn.release(False,500)
+        self.assertFalse(group.members[0].available(time.time()))
+        conn = self._checkout(group)
+        self.assertEqual(conn.address,self.servers[0])
+        conn.release()
+
+
+def healthAnswer(backend,stream,index):
+    """Answer with the status code in backend.status."""
+    backend.read(stream)
+    stream.write("HTTP/1.1 %d X\r\nContent-Length: 0\r\n\r\n" % (backend.status,))
+
+
+class TestHealthChecks(unittest.TestCase):
+
+    def test_probe(self):
+        backend = Backend(healthAnswer)
+        group = UpstreamGroup([("127.0.0.1",backend.port)],health_interval=0,
+                              health_path="/health")
+        member = group.members[0]
+        backend.status = 503
+        group._checkMember(member)
+        self.assertFalse(member.healthy)
+        backend.status = 200
+        group._checkMember(member)
+        self.assertTrue(member.healthy)
+        self.assertEqual([uri for (_,uri,_) in backend.requests],["/health"] * 2)
+        backend.close()
+
+    def test_connect_only(self):
+        group = UpstreamGroup([("127.0.0.1",closedPort())],health_interval=0)
+        member = group.members[0]
+        group._checkMember(member)
+        self.assertFalse(member.healthy)
+
+
+if __name__ == "__main__":
+    unittest.main()